@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.admin import ModelAdmin
 from reversion.admin import VersionAdmin
-from apimws.models import AnsibleConfiguration, PHPLib, Host, Cluster
+from apimws.models import AnsibleConfiguration, PHPLib, Host, Cluster, AnsibleRun, ProvisioningStage
 
 
 class AnsibleConfigurationAdmin(VersionAdmin):
@@ -10,8 +10,46 @@ class AnsibleConfigurationAdmin(VersionAdmin):
     list_display = ('key', 'value', 'service')
 
 
+class HostAdmin(ModelAdmin):
+
+    model = Host
+    list_display = ('hostname', 'cluster', 'cpus', 'ram', 'disk', 'latency', 'error_rate', 'consecutive_failures',
+                    'circuit_open_until')
+    list_filter = ('cluster', )
+    readonly_fields = ('latency', 'error_rate', 'requests', 'failures', 'consecutive_failures', 'circuit_open_until')
+
+
+class AnsibleRunAdmin(ModelAdmin):
+
+    model = AnsibleRun
+    list_display = ('host', 'command', 'tags', 'started', 'duration', 'exit_code')
+    list_filter = ('command', 'tags', 'exit_code')
+    search_fields = ('host', )
+    date_hierarchy = 'started'
+    ordering = ('-duration', )
+    readonly_fields = ('host', 'command', 'tags', 'started', 'finished', 'duration', 'exit_code', 'output')
+
+    def has_add_permission(self, request):
+        return False
+
+
+class ProvisioningStageAdmin(ModelAdmin):
+
+    model = ProvisioningStage
+    list_display = ('service', 'vm', 'stage', 'status', 'attempts', 'started', 'finished')
+    list_filter = ('status', )
+    search_fields = ('stage', 'vm__name')
+    date_hierarchy = 'started'
+    readonly_fields = ('service', 'vm', 'stage', 'status', 'attempts', 'started', 'finished', 'error')
+
+    def has_add_permission(self, request):
+        return False
+
+
 admin.site.register(AnsibleConfiguration, AnsibleConfigurationAdmin)
+admin.site.register(AnsibleRun, AnsibleRunAdmin)
+admin.site.register(ProvisioningStage, ProvisioningStageAdmin)
 # admin.site.register(ApacheModule, VersionAdmin)
 admin.site.register(PHPLib, VersionAdmin)
 admin.site.register(Cluster, ModelAdmin)
-admin.site.register(Host, ModelAdmin)
+admin.site.register(Host, HostAdmin)
@@ -1,9 +1,22 @@
+import errno
 import logging
+import os
+import re
 import subprocess
+from multiprocessing.pool import ThreadPool
 from celery import shared_task, Task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
+from django.utils.encoding import force_text
 
-from sitesmanagement.models import Site, Snapshot, Service, Vhost
+from apimws.inventory import InventoryBuilder, hostvars_fingerprint, refresh_snapshot_if_stale, ansible_revision
+from apimws.locks import acquire_lock, release_lock
+from apimws.models import PendingAnsibleRun, AnsibleRun
+from apimws.process import run_command
+from mws.task_routing import BULK_PRIORITY, USER_PRIORITY
+from sitesmanagement.models import Site, Snapshot, Service, Vhost, VirtualMachine
 
 
 LOGGER = logging.getLogger('mws')
@@ -13,31 +26,176 @@ class UnexpectedVMStatus(Exception):
     pass
 
 
+class AnsibleHostsError(subprocess.CalledProcessError):
+    """Raised when a command failed in some of the VMs it was executed on. failures maps the name of each one of
+    these VMs to the error raised by the command executed on it."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        error = failures.values()[0]
+        output = "\n".join("%s (returned %s):\n%s" % (host, e.returncode, e.output)
+                           for host, e in sorted(failures.items()))
+        super(AnsibleHostsError, self).__init__(error.returncode, error.cmd, output)
+
+    def __str__(self):
+        return "Command failed on %s" % ", ".join(sorted(self.failures))
+
+
+def ansible_log_path(cmd):
+    """Returns the file where the output of an ansible command is streamed if ANSIBLE_LOG_DIR is set. There is one
+    file per host, or per userv service for commands against several hosts."""
+    log_dir = getattr(settings, 'ANSIBLE_LOG_DIR', None)
+    if not log_dir:
+        return None
+    try:
+        os.makedirs(log_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    service = cmd.index("mws-admin") + 1
+    target = cmd[service + 1] if len(cmd) > service + 1 and not cmd[service + 1].startswith("-") else cmd[service]
+    return os.path.join(log_dir, "%s.log" % target)
+
+
+def run_ansible(cmd):
+    """Executes an ansible userv command, killing it after ANSIBLE_TIMEOUT seconds"""
+    return run_command(cmd, timeout=getattr(settings, 'ANSIBLE_TIMEOUT', 3600), log_path=ansible_log_path(cmd))
+
+
+def record_ansible_run(host, cmd, started, finished, exit_code, output):
+    """Stores the duration and result of a command executed against a host"""
+    command = cmd[cmd.index("mws-admin") + 1] if "mws-admin" in cmd else cmd[0]
+    tags = cmd[cmd.index("--tags") + 1] if "--tags" in cmd else ""
+    AnsibleRun.objects.create(host=host, command=command, tags=tags, started=started, finished=finished,
+                              duration=(finished - started).total_seconds(), exit_code=exit_code,
+                              output=force_text(output or "", errors='replace')[
+                                  -getattr(settings, 'ANSIBLE_RUN_OUTPUT_LIMIT', 20000):])
+
+
+def run_on_vms(vms, command, on_success=None):
+    """
+    Execute a command on several VMs concurrently, at most ANSIBLE_MAX_PARALLEL_VMS at a time.
+
+    :param vms: the target VMs
+    :param command: function that returns the command to execute for a VM
+    :param on_success: function called with each VM where the command succeeded
+    :raises AnsibleHostsError: if the command failed on any of the VMs, once all of them have finished
+    """
+    commands = [(vm, command(vm)) for vm in vms]
+
+    def run(cmd):
+        started = timezone.now()
+        try:
+            output = run_ansible(cmd)
+            error = None
+        except subprocess.CalledProcessError as e:
+            output = e.output
+            error = e
+        return started, timezone.now(), output, error
+
+    parallel = min(len(commands), getattr(settings, 'ANSIBLE_MAX_PARALLEL_VMS', 4))
+    if parallel > 1:
+        pool = ThreadPool(parallel)
+        try:
+            results = pool.map(run, [cmd for vm, cmd in commands])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run(cmd) for vm, cmd in commands]
+
+    # Database access is kept in the calling thread
+    failures = {}
+    for (vm, cmd), (started, finished, output, error) in zip(commands, results):
+        record_ansible_run(vm.network_configuration.name, cmd, started, finished,
+                           error.returncode if error else 0, output)
+        if error is None:
+            if on_success:
+                on_success(vm)
+        else:
+            failures[vm.network_configuration.name] = error
+    if failures:
+        raise AnsibleHostsError(failures)
+
+
 def refresh_object(obj):
     """ Reload an object from the database """
     return obj.__class__._default_manager.get(pk=obj.pk)
 
 
-def launch_ansible(service):
-    if service.status == 'ready':
-        service.status = 'ansible'
-        service.save()
-        launch_ansible_async.delay(service)
-    elif service.status == 'ansible':
-        service.status = 'ansible_queued'
-        service.save()
-    elif service.status == 'ansible_queued':
-        return
-    elif service.status in ['installing', 'postinstall']:
-        return
-    else:
-        raise UnexpectedVMStatus()  # TODO pass the vm object?
+def launch_ansible(service, force=False, bulk=False):
+    """Configures the VMs of the service with ansible. VMs whose host variables have not changed since the last
+    successful run are skipped unless force is True. Runs not requested by a user (bulk) are sent with a lower
+    priority so that they are executed after the ones requested by users.
+
+    At most one ansible run per service is in flight. Requests received while a run is in flight are coalesced
+    into a single follow-up run, launched when the current one finishes, which is forced if any of them was. The
+    status of the service is read and updated with its row locked so concurrent requests and workers cannot launch
+    twice or lose a request."""
+    with transaction.atomic():
+        locked = Service.objects.select_for_update().get(pk=service.pk)
+        status = locked.status
+        if status == 'ready':
+            locked.status = 'ansible'
+            locked.save()
+        elif status in ['ansible', 'ansible_queued']:
+            locked.status = 'ansible_queued'
+            locked.ansible_queued_force = locked.ansible_queued_force or force
+            locked.save()
+        elif status not in ['installing', 'postinstall']:
+            raise UnexpectedVMStatus()  # TODO pass the vm object?
+    service.status = locked.status
+    if status == 'ready':
+        if getattr(settings, 'ANSIBLE_BATCH_WINDOW', None):
+            queue_ansible_batch(locked, force)
+        else:
+            launch_ansible_async.apply_async((locked, ), {'force': force},
+                                             priority=BULK_PRIORITY if bulk else USER_PRIORITY)
+
+
+def finish_ansible_run(service):
+    """
+    Marks the ansible run of a service as finished.
 
+    :param service: the service
+    :return: the updated service, whether another run was requested while this one was in flight, in which case
+             the service is left in the 'ansible' status and the caller must launch the follow-up run, and whether
+             the follow-up run has to be forced
+    """
+    with transaction.atomic():
+        locked = Service.objects.select_for_update().get(pk=service.pk)
+        follow_up = locked.status == 'ansible_queued'
+        force = follow_up and locked.ansible_queued_force
+        locked.status = 'ansible' if follow_up else 'ready'
+        locked.ansible_queued_force = False
+        locked.save()
+    return locked, follow_up, force
 
-def launch_ansible_by_user(user):
-    for site in Site.objects.all():
-        if user in site.list_of_all_type_of_active_users() and not site.is_canceled():
-            launch_ansible_site(site)  # TODO: Change this to other thing more sensible
+
+def services_by_user(user):
+    """
+    Returns the active services of the sites that are not cancelled in which the user is an admin, an ssh user or a
+    supporter, directly or as a member of a Lookup group. The membership of Lookup groups is taken from its local
+    copy (mwsauth.models.LookupGroupMember) so that Lookup is not queried.
+    """
+    if not user.is_active:
+        return Service.objects.none()
+    site_ids = (Q(site_id__in=Site.users.through.objects.filter(user=user).values('site_id')) |
+                Q(site_id__in=Site.ssh_users.through.objects.filter(user=user).values('site_id')) |
+                Q(site_id__in=Site.supporters.through.objects.filter(user=user).values('site_id')) |
+                Q(site_id__in=Site.groups.through.objects.filter(
+                    lookupgroup__members__user=user).values('site_id')) |
+                Q(site_id__in=Site.ssh_groups.through.objects.filter(
+                    lookupgroup__members__user=user).values('site_id')))
+    return Service.objects.filter(site_ids, site__end_date__isnull=True,
+                                  virtual_machines__isnull=False).distinct().order_by('id')
+
+
+def launch_ansible_by_user(user, force=False):
+    """Configures the services the user has access to. Changes that are not in the host variables of the VMs (e.g.
+    the password of the user) need force to be applied."""
+    for service in services_by_user(user):
+        launch_ansible(service, force=force)
 
 
 def launch_ansible_site(site):
@@ -52,7 +210,7 @@ class AnsibleTaskWithFailure(Task):
     abstract = True
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
-        if type(exc) is subprocess.CalledProcessError:
+        if isinstance(exc, subprocess.CalledProcessError):
             LOGGER.error("An error happened when trying to execute Ansible.\nThe task id is %s.\n\n"
                          "The parameters passed to the task were: \nargs: %s\nkwargs: %s\n\nThe traceback is:\n%s\n\n"
                          "The output from the command was: %s\n", task_id, args, kwargs, einfo, exc.output)
@@ -63,30 +221,187 @@ class AnsibleTaskWithFailure(Task):
         if args[0].__class__ == Service:
             service = args[0]
             service.status = 'ready'
-            service.save()
+            Service.objects.filter(pk=service.pk).update(status='ready', ansible_queued_force=False)
 
 
 @shared_task(base=AnsibleTaskWithFailure, default_retry_delay=120, max_retries=2)
-def launch_ansible_async(service, ignore_host_key=False):
-    while service.status != 'ready':
-        try:
-            for vm in service.virtual_machines.all():
-                userv_cmd = ["userv"]
-                if ignore_host_key:
-                    userv_cmd.extend(["--defvar", "ANSIBLE_HOST_KEY_CHECKING=False"])
-                userv_cmd.extend(["mws-admin", "mws_ansible_host", vm.network_configuration.name])
-                subprocess.check_output(userv_cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise launch_ansible_async.retry(exc=e)
-        service = refresh_object(service)
-        if service.status == 'ansible_queued':
-            service.status = 'ansible'
-            service.save()
+def launch_ansible_async(service, ignore_host_key=False, force=False):
+    if service.status == 'ready':
+        return
+    # Make sure ansible does not read an inventory snapshot older than the changes that triggered this run
+    refresh_snapshot_if_stale()
+    builder = InventoryBuilder(service.virtual_machines.all())
+    revision = ansible_revision()
+    pending = []
+    fingerprints = {}
+    for vm in builder.vms:
+        fingerprint = hostvars_fingerprint(builder.hostvars(vm), revision)
+        # A VM with freshly installed OS (ignore_host_key) always needs to be configured, and so does any VM if the
+        # revision of the playbooks is not known
+        if not force and not ignore_host_key and revision and vm.ansible_fingerprint == fingerprint:
+            LOGGER.info("Ansible run on %s skipped, its configuration has not changed",
+                        vm.network_configuration.name)
         else:
-            service.status = 'ready'
-            service.save()
+            pending.append(vm)
+            fingerprints[vm.pk] = fingerprint
+
+    def userv_cmd(vm):
+        cmd = ["userv"]
+        if ignore_host_key:
+            cmd.extend(["--defvar", "ANSIBLE_HOST_KEY_CHECKING=False"])
+        cmd.extend(["mws-admin", "mws_ansible_host", vm.network_configuration.name])
+        return cmd
+
+    def store_fingerprint(vm):
+        VirtualMachine.objects.filter(pk=vm.pk).update(ansible_fingerprint=fingerprints[vm.pk])
+
+    try:
+        run_on_vms(pending, userv_cmd, store_fingerprint)
+    except subprocess.CalledProcessError as e:
+        raise launch_ansible_async.retry(exc=e)
+    service, follow_up, force = finish_ansible_run(service)
+    # Delete Unix Groups marked to be deleted after ansible has finished deleting them from the system
+    service.unix_groups.filter(to_be_deleted=True).delete()
+    if follow_up:
+        # The follow-up run is a new task so that this worker is not held by a single service
+        launch_ansible_async.delay(service, force=force)
+
+
+# Lock held while a launch_ansible_batch task is scheduled, so that there is at most one pending batch
+BATCH_SCHEDULED_LOCK = "ansible-batch-scheduled"
+
+
+def schedule_ansible_batch(countdown):
+    """Schedules a batched ansible run, unless one is already scheduled. The lock expires if the task is lost."""
+    token = acquire_lock(BATCH_SCHEDULED_LOCK,
+                         ttl=countdown + getattr(settings, 'ANSIBLE_BATCH_SCHEDULE_TIMEOUT', 600))
+    if token:
+        launch_ansible_batch.apply_async((token, ), countdown=countdown)
+
+
+def queue_ansible_batch(service, force=False, attempts=0, countdown=None):
+    """Adds the service to the next batched ansible run, which starts ANSIBLE_BATCH_WINDOW seconds after the first
+    service is queued and includes every service queued in the meantime."""
+    entry, created = PendingAnsibleRun.objects.get_or_create(service=service,
+                                                             defaults={'force': force, 'attempts': attempts})
+    if force and not entry.force:
+        PendingAnsibleRun.objects.filter(pk=entry.pk).update(force=True)
+    if countdown is None:
+        countdown = settings.ANSIBLE_BATCH_WINDOW
+    transaction.on_commit(lambda: schedule_ansible_batch(countdown))
+
+
+PLAY_RECAP_RE = re.compile(r'^(\S+)\s+:\s+ok=\d+\s+changed=\d+\s+unreachable=(\d+)\s+failed=(\d+)', re.MULTILINE)
+
+
+def run_ansible_on_hosts(vms):
+    """
+    Execute the ansible MWS guest role in a single ansible invocation against several VMs.
+
+    :param vms: the target VMs
+    :return: a dictionary with the output of ansible for every host where it failed
+    """
+    hosts = [vm.network_configuration.name for vm in vms]
+    cmd = ["userv", "mws-admin", "mws_ansible_hosts", "--limit", ":".join(hosts),
+           "--forks", str(getattr(settings, 'ANSIBLE_BATCH_FORKS', 10))]
+    started = timezone.now()
+    try:
+        output = run_ansible(cmd)
+        exit_code = 0
+    except subprocess.CalledProcessError as e:
+        output = e.output or ""
+        exit_code = e.returncode
+    finished = timezone.now()
+    recap = dict((host, int(unreachable) + int(failed)) for host, unreachable, failed in PLAY_RECAP_RE.findall(output))
+    failures = {}
+    for host in hosts:
+        # Hosts missing from the recap of a failed invocation (e.g. a syntax error) did not get configured either
+        if recap.get(host, exit_code):
+            failures[host] = output
+        record_ansible_run(host, cmd, started, finished, exit_code if host in failures else 0, output)
+    return failures
+
+
+def retry_ansible_batch(entries, error, retry=True):
+    """
+    Queues again the services of a batch whose ansible run failed, with the retries of launch_ansible_async. The
+    services that are not retried, or have been retried too many times, are released and their queued follow-up run
+    is queued.
+    """
+    for entry in entries:
+        service = entry.service
+        if retry and entry.attempts < getattr(settings, 'ANSIBLE_BATCH_MAX_RETRIES', 2):
+            LOGGER.warning("Ansible run of the service %s failed, it will be retried: %s", service.pk, error)
+            queue_ansible_batch(service, entry.force, entry.attempts + 1,
+                                countdown=getattr(settings, 'ANSIBLE_BATCH_RETRY_DELAY', 120))
+            continue
+        LOGGER.error("An error happened when trying to execute Ansible on the service %s.\n\nThe output from the "
+                     "command was: %s\n", service.pk, error)
+        service, follow_up, force = finish_ansible_run(service)
+        if follow_up:
+            queue_ansible_batch(service, force)
+
+
+@shared_task
+def launch_ansible_batch(token=None):
+    """Configures with ansible all the services queued by queue_ansible_batch, ANSIBLE_BATCH_SIZE hosts per
+    ansible invocation"""
+    if token:
+        # Services queued from now on need another batch
+        release_lock(BATCH_SCHEDULED_LOCK, token)
+    claimed = []
+    for entry in PendingAnsibleRun.objects.select_related('service'):
+        # Only one worker can delete each entry, so concurrent batches never include the same service twice
+        if PendingAnsibleRun.objects.filter(pk=entry.pk).delete()[0]:
+            claimed.append(entry)
+    if not claimed:
+        return
+    force = dict((entry.service_id, entry.force) for entry in claimed)
+
+    try:
+        refresh_snapshot_if_stale()
+        builder = InventoryBuilder(VirtualMachine.objects.filter(service_id__in=force.keys()))
+        revision = ansible_revision()
+        pending = []
+        for vm in builder.vms:
+            vm.fingerprint = hostvars_fingerprint(builder.hostvars(vm), revision)
+            if not force[vm.service_id] and revision and vm.ansible_fingerprint == vm.fingerprint:
+                LOGGER.info("Ansible run on %s skipped, its configuration has not changed",
+                            vm.network_configuration.name)
+            else:
+                pending.append(vm)
+
+        failures = {}
+        batch_size = getattr(settings, 'ANSIBLE_BATCH_SIZE', 50)
+        for i in range(0, len(pending), batch_size):
+            failures.update(run_ansible_on_hosts(pending[i:i+batch_size]))
+    except subprocess.CalledProcessError as e:
+        retry_ansible_batch(claimed, e.output)
+        return
+    except Exception as e:
+        # Other errors are not retried, as in launch_ansible_async
+        retry_ansible_batch(claimed, e, retry=False)
+        raise
+
+    for vm in pending:
+        if vm.network_configuration.name not in failures:
+            VirtualMachine.objects.filter(pk=vm.pk).update(ansible_fingerprint=vm.fingerprint)
+
+    failed = []
+    for entry in claimed:
+        service = entry.service
+        failed_hosts = [vm.network_configuration.name for vm in pending
+                        if vm.service_id == service.id and vm.network_configuration.name in failures]
+        if failed_hosts:
+            failed.append((entry, "%s: %s" % (", ".join(failed_hosts), failures[failed_hosts[0]])))
+            continue
+        service, follow_up, force = finish_ansible_run(service)
+        if follow_up:
+            queue_ansible_batch(service, force)
         # Delete Unix Groups marked to be deleted after ansible has finished deleting them from the system
         service.unix_groups.filter(to_be_deleted=True).delete()
+    for entry, error in failed:
+        retry_ansible_batch([entry], error)
 
 
 @shared_task(base=AnsibleTaskWithFailure)
@@ -128,21 +443,17 @@ def execute_playbook_on_vms(service, playbook_args):
     :param service: the service of the target VMs
     :param playbook_args: ansible playbook arguments
     """
-    for vm in service.virtual_machines.all():
-        cmd = ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name]
-        cmd.extend(playbook_args)
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    return
+    run_on_vms(service.virtual_machines.all(),
+               lambda vm: ["userv", "mws-admin", "mws_ansible_host_d", vm.network_configuration.name] + playbook_args)
 
 
 @shared_task(base=AnsibleTaskWithFailure)
 def delete_vhost_ansible(service, vhost_name, vhost_webapp):
     """delete the vhost folder and all its contents"""
-    for vm in service.virtual_machines.all():
-        subprocess.check_output([
-            "userv", "mws-admin", "mws_delete_vhost", vm.network_configuration.name, "--tags", "delete_vhost",
-            "-e", "delete_vhost_name=%s delete_vhost_webapp=%s" % (vhost_name, vhost_webapp)
-        ], stderr=subprocess.STDOUT)
+    run_on_vms(service.virtual_machines.all(), lambda vm: [
+        "userv", "mws-admin", "mws_delete_vhost", vm.network_configuration.name, "--tags", "delete_vhost",
+        "-e", "delete_vhost_name=%s delete_vhost_webapp=%s" % (vhost_name, vhost_webapp)
+    ])
     launch_ansible(service)
     return
 
@@ -151,9 +462,8 @@ def delete_vhost_ansible(service, vhost_name, vhost_webapp):
 def vhost_enable_apache_owned(vhost_id):
     """Changes ownership of the docroot folder to the user www-data"""
     vhost = Vhost.objects.get(id=vhost_id)
-    for vm in vhost.service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name,
-                                 vhost.name, "enable"], stderr=subprocess.STDOUT)
+    run_on_vms(vhost.service.virtual_machines.all(), lambda vm: [
+        "userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name, vhost.name, "enable"])
     vhost.apache_owned = True
     vhost.save()
     vhost_disable_apache_owned.apply_async(args=(vhost_id,), countdown=3600)  # Leave an hour to the user
@@ -163,8 +473,7 @@ def vhost_enable_apache_owned(vhost_id):
 def vhost_disable_apache_owned(vhost_id):
     """Revert the ownership of the docroot folder back to site-admin"""
     vhost = Vhost.objects.get(id=vhost_id)
-    for vm in vhost.service.virtual_machines.all():
-        subprocess.check_output(["userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name,
-                                 vhost.name, "disable"], stderr=subprocess.STDOUT)
+    run_on_vms(vhost.service.virtual_machines.all(), lambda vm: [
+        "userv", "mws-admin", "mws_vhost_owner", vm.network_configuration.name, vhost.name, "disable"])
     vhost.apache_owned = False
     vhost.save()
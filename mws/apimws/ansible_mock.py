@@ -16,7 +16,7 @@ def refresh_object(obj):
     return obj.__class__._default_manager.get(pk=obj.pk)
 
 
-def launch_ansible(service):
+def launch_ansible(service, force=False, bulk=False):
     pass
 
 
@@ -27,7 +27,7 @@ def launch_ansible_site(site):
         launch_ansible(site.test_service)
 
 
-def launch_ansible_by_user(user):
+def launch_ansible_by_user(user, force=False):
     for site in Site.objects.all():
         if user in site.list_of_all_type_of_active_users() and not site.is_canceled():
             launch_ansible_site(site)  # TODO: Change this to other thing more sensible
@@ -48,7 +48,7 @@ class AnsibleTaskWithFailure(Task):
 
 
 @shared_task(base=AnsibleTaskWithFailure, default_retry_delay=120, max_retries=2)
-def launch_ansible_async(service, ignore_host_key=False):
+def launch_ansible_async(service, ignore_host_key=False, force=False):
     while service.status != 'ready':
         service.status = 'ready'
         service.save()
@@ -0,0 +1,95 @@
+"""
+Health of the VM API of the hosts of each cluster, used to choose the host that receives each VM API request.
+
+Every request updates the moving averages of the response time and of the error rate of the host. After
+VM_API_BREAKER_THRESHOLD consecutive failures the circuit breaker of the host opens, and the host is only tried
+after the other hosts of the cluster during VM_API_BREAKER_COOLDOWN seconds. After that one request is sent to it
+again, which closes the breaker if it succeeds or opens it again if it fails.
+
+"""
+import logging
+import random
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from apimws.models import Host
+
+
+LOGGER = logging.getLogger('mws')
+
+
+def host_score(host):
+    """Expected time to get an answer from the host, taking into account the requests that fail. Hosts without
+    measurements yet have the best score so that they are tried."""
+    return (host.latency or 0.0) / (1 - min(host.error_rate, 0.99))
+
+
+def circuit_open(host, now=None):
+    return host.circuit_open_until is not None and host.circuit_open_until > (now or timezone.now())
+
+
+def ordered_hosts(cluster):
+    """
+    Returns the hosts of the cluster in the order they have to be tried.
+
+    The first one is the best of two hosts chosen at random among the ones with the circuit breaker closed, which
+    spreads the requests among the healthy hosts while avoiding the slow ones. It is followed by the rest of the
+    healthy hosts, the best first, and by the hosts with the circuit breaker open, the ones closing earlier first.
+    """
+    now = timezone.now()
+    hosts = list(cluster.hosts.all())
+    available = sorted([host for host in hosts if not circuit_open(host, now)], key=host_score)
+    broken = sorted([host for host in hosts if circuit_open(host, now)], key=lambda host: host.circuit_open_until)
+    if len(available) > 1:
+        first = min(random.sample(available, 2), key=host_score)
+        available.remove(first)
+        available.insert(0, first)
+    return available + broken
+
+
+def smoothing():
+    return getattr(settings, 'VM_API_HEALTH_SMOOTHING', 0.3)
+
+
+HEALTH_FIELDS = ['latency', 'error_rate', 'requests', 'failures', 'consecutive_failures', 'circuit_open_until']
+
+
+def update_health(host, update):
+    """Applies update to the current row of the host, locked so that the requests answered concurrently by the host
+    (from other threads or workers) are all taken into account, and copies the result to host"""
+    with transaction.atomic():
+        current = Host.objects.select_for_update().get(pk=host.pk)
+        update(current, smoothing())
+        current.requests += 1
+        current.save(update_fields=HEALTH_FIELDS)
+    for field in HEALTH_FIELDS:
+        setattr(host, field, getattr(current, field))
+    return host
+
+
+def record_success(host, elapsed):
+    """Records a request answered by the host in elapsed seconds"""
+    def update(current, alpha):
+        current.latency = elapsed if current.latency is None else alpha * elapsed + (1 - alpha) * current.latency
+        current.error_rate = (1 - alpha) * current.error_rate
+        current.consecutive_failures = 0
+        current.circuit_open_until = None
+    update_health(host, update)
+
+
+def record_failure(host):
+    """Records a request that the host did not answer, opening its circuit breaker if it keeps failing"""
+    threshold = getattr(settings, 'VM_API_BREAKER_THRESHOLD', 3)
+
+    def update(current, alpha):
+        current.error_rate = alpha + (1 - alpha) * current.error_rate
+        current.failures += 1
+        current.consecutive_failures += 1
+        if current.consecutive_failures >= threshold:
+            current.circuit_open_until = timezone.now() + timedelta(
+                seconds=getattr(settings, 'VM_API_BREAKER_COOLDOWN', 60))
+    update_health(host, update)
+    if host.consecutive_failures >= threshold:
+        LOGGER.warning("The VM API of the host %s failed %d times in a row, it will be avoided until %s",
+                       host.hostname, host.consecutive_failures, host.circuit_open_until)
@@ -0,0 +1,495 @@
+"""
+The :py:mod:`~apimws.inventory` module builds the ansible dynamic inventory
+for a set of :py:class:`~sitesmanagement.models.VirtualMachine` objects.
+
+Rather than walking the object graph VM by VM (which costs dozens of queries
+per host), :py:class:`.InventoryBuilder` loads every related object it needs
+in a fixed number of set-based queries and then assembles the host variables
+in memory.
+
+When ``MWS_INVENTORY_SNAPSHOT`` is set, the inventory is also materialized to
+that JSON file every time a model it depends on changes, so that ansible can
+read it with ``scripts/mws_inventory.py`` without booting Django or touching
+the database.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import defaultdict
+from celery import shared_task
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from apimws.lv import update_lv_list
+from apimws.models import AnsibleConfiguration, PHPLib, PHPPackage
+from mwsauth.models import MWSUser
+from mwsauth.utils import get_users_of_a_group
+from sitesmanagement.models import VirtualMachine, Site, Service, Vhost, DomainName, UnixGroup
+
+
+LOGGER = logging.getLogger('mws')
+
+
+group = "mwsclients"
+# We start Unix Group IDs by the 2^16-2 which is the last one free in Debian
+# and assign them to groups in decrease order
+INITIAL_GID = 4294967293
+
+
+# At this moment we only support OV Quovadis
+CERT_CHAIN = '''-----BEGIN CERTIFICATE-----
+MIIFTDCCAzSgAwIBAgIUSJgt4qkssznhyPkzNYJ10+T4glUwDQYJKoZIhvcNAQEL
+BQAwRTELMAkGA1UEBhMCQk0xGTAXBgNVBAoTEFF1b1ZhZGlzIExpbWl0ZWQxGzAZ
+BgNVBAMTElF1b1ZhZGlzIFJvb3QgQ0EgMjAeFw0xMzA2MDExMzM1MDVaFw0yMzA2
+MDExMzM1MDVaME0xCzAJBgNVBAYTAkJNMRkwFwYDVQQKExBRdW9WYWRpcyBMaW1p
+dGVkMSMwIQYDVQQDExpRdW9WYWRpcyBHbG9iYWwgU1NMIElDQSBHMjCCASIwDQYJ
+KoZIhvcNAQEBBQADggEPADCCAQoCggEBAOHhhWmUwI9X+jT+wbho5JmQqYh6zle3
+0OS1VMIYfdDDGeipY4D3t9zSGaNasGDZdrQdMlY18WyjnEKhi4ojNZdBewVphCiO
+zh5Ni2Ak8bSI/sBQ9sKPrpd0+UCqbvaGs6Tpx190ZRT0Pdy+TqOYZF/jBmzBj7Yf
+XJmWxlfCy62UiQ6tvv+4C6W2OPu1R4HUD8oJ8Qo7Eg0cD+GFsBM2w8soffyl+Dc6
+pKtARmOClUC7EqyWP0V9953lA34kuJZlYxxdgghBTn9rWoaQw/Lr5Fn0Xgd7fYS3
+/zGhmXYvVsuAxIn8Gk+YaeoLZ8H9tUvnDD3lEHzvIsMPxqtd7IgcVaMCAwEAAaOC
+ASowggEmMBIGA1UdEwEB/wQIMAYBAf8CAQAwEQYDVR0gBAowCDAGBgRVHSAAMHIG
+CCsGAQUFBwEBBGYwZDAqBggrBgEFBQcwAYYeaHR0cDovL29jc3AucXVvdmFkaXNn
+bG9iYWwuY29tMDYGCCsGAQUFBzAChipodHRwOi8vdHJ1c3QucXVvdmFkaXNnbG9i
+YWwuY29tL3F2cmNhMi5jcnQwDgYDVR0PAQH/BAQDAgEGMB8GA1UdIwQYMBaAFBqE
+YrxITDMlBNTu0PYDxBlG0ZRrMDkGA1UdHwQyMDAwLqAsoCqGKGh0dHA6Ly9jcmwu
+cXVvdmFkaXNnbG9iYWwuY29tL3F2cmNhMi5jcmwwHQYDVR0OBBYEFJEZYq1bF6cw
++/DeOSWxvYy5uFEnMA0GCSqGSIb3DQEBCwUAA4ICAQB8CmCCAEG1Lcw55fTba84A
+ipwMieZydFO5bcIh5UyXWgWZ6OP4jb/6LaifEMLjRCC0mU14G6PrPU+iZQiIae7X
+5EavhmETEA8JbLICjiD4c9Y6+bgMt4szEPiZ2SALOQj10Br4HKQfy/OvbedRbLax
+p9qlDG4qJgSt3uikDIJSarx6mpgEQXu00UZNkiEYUfeO8hXGXrZbtDnkuaiVDtM6
+s9yYpcoyFxFOrORrEgViaI7P3EJaDYmI6IDUIPaSBM6GrVMiaINYEMBL1v2jZi8r
+XDY0yVsZ/0DAIQiCBNNvT1NjQ5Sn1E+O+ZBiqDD+rBvBoPsI6ydfdKtJur5YL+Oo
+kJK2eLrce8287awIcd8FMRDcZw/NX1bc8uKye5OCtwpQ0d4jL4emuXwFv8TqUbZh
+2xJShyy57cqw3qWoBOs/WWza29/Hun8PXkQoZepwY/xc+9nI1NaKM8NqhSqJNTJl
+vXj7zb3mdpbe3YR9BkSXProlN7l5KOx54gJ7kJ7r6qJYJux03HyPM11Kp4wfdn1R
+sC2UQ5awC6fg/3XE2HZVkyqJjKwqh4nFaiK5EMV7DHQ4oJx9ckmDw6pBvDaoPokX
+yzdfJ72n+1JfHGP+workciKNldgqYX6J4jPrCIEIBrtDta4QxP10Tyd9RFu13XmE
+8SYi/VXvrf3nriQfAZ/nSA==
+-----END CERTIFICATE-----'''
+
+
+def inventory_vms():
+    """Returns the queryset of VMs that ansible should know about"""
+    return VirtualMachine.objects.filter(
+        service__status__in=('ansible', 'ansible_queued', 'ready', 'postinstall'),
+        service__site__disabled=False, service__site__deleted=False, service__site__end_date__isnull=True)
+
+
+def sitegroup(site_id):
+    return "mwssite-%d" % (site_id,)
+
+
+def servicegroup(service_id):
+    return "mwsservice-%d" % (service_id,)
+
+
+def hostid(vm):
+    return vm.network_configuration.name
+
+
+class InventoryBuilder(object):
+    """
+    Generates the ansible inventory of a set of VMs. All the objects needed to generate the host variables of
+    every VM passed are loaded in bulk when the builder is created, so the number of database queries does not
+    depend on the number of VMs, sites or vhosts. Members of Lookup groups are fetched once per group.
+
+    """
+
+    def __init__(self, vms):
+        self.vms = list(vms.select_related('network_configuration', 'service__network_configuration',
+                                           'service__site').order_by('id'))
+        self._load()
+
+    def _load(self):
+        site_ids = set(vm.service.site_id for vm in self.vms)
+        vm_service_ids = set(vm.service_id for vm in self.vms)
+
+        # Production and test services of every site involved together with whether they have VMs
+        self.services = {}
+        self.production_service = {}
+        self.test_service = {}
+        for service in Service.objects.filter(site_id__in=site_ids).select_related('network_configuration') \
+                .order_by('id'):
+            self.services[service.id] = service
+            if service.type == 'production':
+                self.production_service.setdefault(service.site_id, service)
+            elif service.type == 'test':
+                self.test_service.setdefault(service.site_id, service)
+        self.active_services = set(VirtualMachine.objects.filter(service_id__in=self.services.keys())
+                                   .values_list('service_id', flat=True))
+
+        self._load_users(site_ids)
+
+        # Vhosts (the test service uses the production one) and their domain names
+        self.vhost_service = {}
+        for service_id in vm_service_ids:
+            service = self.services[service_id]
+            if service.primary:
+                self.vhost_service[service_id] = service_id
+            else:
+                production_service = self.production_service.get(service.site_id)
+                self.vhost_service[service_id] = production_service.id if production_service else None
+        self.vhosts = defaultdict(list)
+        for vhost in Vhost.objects.filter(service_id__in=set(self.vhost_service.values())) \
+                .select_related('main_domain', 'service__network_configuration').order_by('id'):
+            self.vhosts[vhost.service_id].append(vhost)
+        self.domain_names = defaultdict(list)
+        domain_names = DomainName.objects.filter(vhost__service_id__in=set(self.vhost_service.values()))
+        for vhost_id, name, status in domain_names.order_by('id').values_list('vhost_id', 'name', 'status'):
+            self.domain_names[vhost_id].append((name, status))
+
+        # Operating system of every service
+        self.operating_system = dict(AnsibleConfiguration.objects.filter(service_id__in=vm_service_ids, key='os')
+                                     .values_list('service_id', 'value'))
+
+        # PHP packages per operating system and PHP libraries enabled per service
+        self.php_packages = defaultdict(list)
+        for os, name, library_id in PHPPackage.objects.order_by('id').values_list('os', 'name', 'library_id'):
+            self.php_packages[os].append((name, library_id))
+        self.php_libs = defaultdict(set)
+        for service_id, phplib_id in PHPLib.services.through.objects.filter(service_id__in=vm_service_ids) \
+                .values_list('service_id', 'phplib_id'):
+            self.php_libs[service_id].add(phplib_id)
+
+        # Unix groups of every site and the users belonging to each one of them
+        self.unix_groups = defaultdict(list)
+        for unix_group in UnixGroup.objects.filter(service__site_id__in=site_ids).select_related('service') \
+                .order_by('id'):
+            self.unix_groups[unix_group.service.site_id].append(unix_group)
+        self.unix_group_users = defaultdict(set)
+        for unixgroup_id, user_id in UnixGroup.users.through.objects.filter(
+                unixgroup__service__site_id__in=site_ids).values_list('unixgroup_id', 'user_id'):
+            self.unix_group_users[unixgroup_id].add(user_id)
+
+        # URL to the panel to inform about the deletion of LVs
+        self.update_lv_list_url = "%s%s" % (settings.MAIN_DOMAIN, reverse(update_lv_list))
+
+    def _load_users(self, site_ids):
+        """Loads admins, ssh users and supporters of every site, including members of their Lookup groups"""
+        def site_relation(through, field):
+            relation = defaultdict(list)
+            for row in through.objects.filter(site_id__in=site_ids).select_related(field).order_by('id'):
+                relation[row.site_id].append(getattr(row, field))
+            return relation
+
+        self.site_users = site_relation(Site.users.through, 'user')
+        self.site_ssh_users = site_relation(Site.ssh_users.through, 'user')
+        self.site_supporters = site_relation(Site.supporters.through, 'user')
+        self.site_groups = site_relation(Site.groups.through, 'lookupgroup')
+        self.site_ssh_groups = site_relation(Site.ssh_groups.through, 'lookupgroup')
+
+        # Each Lookup group is only queried once even if it is used by several sites
+        self.lookup_group_users = {}
+        for groups in self.site_groups.values() + self.site_ssh_groups.values():
+            for lookup_group in groups:
+                if lookup_group.lookup_id not in self.lookup_group_users:
+                    self.lookup_group_users[lookup_group.lookup_id] = list(get_users_of_a_group(lookup_group))
+
+        usernames = set()
+        for relation in (self.site_users, self.site_ssh_users, self.site_supporters):
+            for users in relation.values():
+                usernames.update(user.username for user in users)
+        for users in self.lookup_group_users.values():
+            usernames.update(user.username for user in users)
+        self.mws_users = dict((mws_user.user_id, mws_user) for mws_user in
+                              MWSUser.objects.filter(user_id__in=usernames))
+
+    def active_users(self, site_id):
+        """Equivalent to Site.list_of_all_type_of_active_users but using the objects already loaded"""
+        users = {}
+        for user in self.site_users[site_id] + self.site_ssh_users[site_id]:
+            users[user.id] = user
+        for lookup_group in self.site_groups[site_id] + self.site_ssh_groups[site_id]:
+            for user in self.lookup_group_users[lookup_group.lookup_id]:
+                users[user.id] = user
+        return sorted([user for user in users.values() if user.is_active], key=lambda user: user.username)
+
+    def user_vars(self, user, site_id):
+        uv = {}
+        uv['username'] = user.username
+        uv['groups'] = [unix_group.name for unix_group in self.unix_groups[site_id]
+                        if not unix_group.to_be_deleted and user.id in self.unix_group_users[unix_group.id]]
+        mws_user = self.mws_users.get(user.username)
+        if mws_user is not None and mws_user.uid is not None:
+            uv['uid'] = mws_user.uid
+            if mws_user.ssh_public_key:
+                uv['ssh_key'] = mws_user.ssh_public_key
+        return uv
+
+    def domains(self, vhost, subset=Vhost.ALL_NAMES):
+        """Equivalent to Vhost.domains but using the domain names already loaded"""
+        domain_names = self.domain_names[vhost.id]
+        if subset is Vhost.ALL_NAMES:
+            return [name for name, status in domain_names if status not in Vhost.ALL_NAMES]
+        elif subset is Vhost.GLOBAL_NAMES:
+            return [name for name, status in domain_names if status in Vhost.GLOBAL_NAMES and
+                    name != vhost.service.network_configuration.name]
+        elif subset is Vhost.PRIVATE_AND_GLOBAL_NAMES:
+            return [name for name, status in domain_names if status in Vhost.PRIVATE_AND_GLOBAL_NAMES]
+        raise ValueError('Unknown subset type: %r' % (subset,))
+
+    def vhost_vars(self, vh):
+        # List of variables for each vhost
+        vhv = {}
+        vhv['id'] = vh.id
+        vhv['name'] = vh.name
+        # List of all hostnames accepted at least once.
+        vhv['domains'] = self.domains(vh)
+        # Dict of lists of hostnames that certain certificate providers can support, keyed by provider
+        vhv['cert_domains'] = {
+            # ACME (Let's Encrypt) can only certify hostnames it can resolve
+            'acme': self.domains(vh, subset=Vhost.GLOBAL_NAMES),
+            # QuoVadis will certify tentative and private hostnames as well
+            'qv': self.domains(vh, subset=Vhost.PRIVATE_AND_GLOBAL_NAMES),
+        }
+        # The main domain where all the domain names associated will redirect to
+        if vh.main_domain:
+            vhv['main_domain'] = vh.main_domain.name
+        # The TLS certificate if already uploaded
+        if vh.certificate:
+            vhv['certificate'] = vh.certificate
+            vhv['certificatechain'] = vh.certificate_chain or CERT_CHAIN
+        if vh.tls_key_hash:
+            vhv['tls_key_hash'] = vh.tls_key_hash
+        # If is TLS enabled whether the certificate has been yet uploaded or not
+        vhv['tls_enabled'] = vh.tls_enabled
+        # Generate csr if there is a request from the web panel
+        vhv['generate_csr'] = 'tls_key_hash' in vhv and vh.tls_key_hash == "requested"
+        vhv['generate_csr_renewal'] = 'tls_key_hash' in vhv and vh.tls_key_hash == "renewal"
+        vhv['generate_csr_renewal_cert'] = 'tls_key_hash' in vhv and vh.tls_key_hash == "renewal_waiting_cert"
+        vhv['generate_renewal_cert'] = 'tls_key_hash' in vhv and vh.tls_key_hash == "renewal_cert"
+        # Type of webapp: wordpress, drupal, etc.
+        vhv['webapp'] = vh.webapp
+        return vhv
+
+    def hostvars(self, vm):
+        service = vm.service
+        site = service.site
+        v = {}
+        v['ansible_host'] = (vm.network_configuration.name or
+                             vm.network_configuration.IPv4 or
+                             vm.network_configuration.IPv6)
+        v['mws_name'] = site.name
+        v['mws_webmaster_email'] = site.email
+
+        # List of active users (admin and ssh only) together with the list of supporters
+        v['mws_users'] = [self.user_vars(u, site.id) for u in
+                          self.active_users(site.id) + self.site_supporters[site.id]]
+
+        # List of Vhosts of the production service (the test service uses the production one)
+        v['mws_vhosts'] = [self.vhost_vars(vh) for vh in self.vhosts[self.vhost_service[service.id]]]
+
+        # Is the VM the production or the test one?
+        v['mws_is_primary'] = service.primary
+
+        # Has this an active test Service?
+        test_service = self.test_service.get(site.id)
+        v['mws_test_active'] = test_service.id in self.active_services if test_service else False
+        v['mws_test_name'] = test_service.network_configuration.name if test_service else ""
+
+        # Network configuration of the VM
+        if vm.network_configuration.IPv4:
+            v['mws_ipv4'] = vm.network_configuration.IPv4
+            v['mws_ipv4_netmask'] = vm.network_configuration.IPv4_netmask
+            v['mws_ipv4_gateway'] = vm.network_configuration.IPv4_gateway
+        if vm.network_configuration.IPv6:
+            v['mws_ipv6'] = vm.network_configuration.IPv6
+
+        # is there any vhost TLS enabled? That is used later on to use http or https for
+        # redirections that do not match any vhost
+        v['mws_tls_enabled'] = any(['certificate' in vhv for vhv in v['mws_vhosts']])
+
+        # version of the operating system
+        v['mws_os'] = self.operating_system.get(service.id)
+
+        # mws_site_group refers to the Ansible host group representing
+        # this host's site.
+        v['mws_site_group'] = sitegroup(site.id)
+        # mws_site_id is a convenient string identifying the site for use
+        # in filenames etc.
+        v['mws_site_id'] = v['mws_site_group']
+
+        # mws_service_group refers to the Ansible host group representing
+        # this host's service.
+        v['mws_service_group'] = servicegroup(service.id)
+        v['mws_service_fqdn'] = service.network_configuration.name
+        v['mws_service_ipv4'] = service.network_configuration.IPv4
+        v['mws_service_ipv4_netmask'] = service.network_configuration.IPv4_netmask
+        v['mws_service_ipv4_gateway'] = service.network_configuration.IPv4_gateway
+        v['mws_service_ipv6'] = service.network_configuration.IPv6
+
+        pkgs = self.php_packages[v['mws_os']]
+        libs = self.php_libs[service.id]
+
+        # List of PHP libraries to be installed
+        v['mws_php_libs_enabled'] = [name for name, library_id in pkgs if library_id in libs]
+
+        # List of PHP libraries to be deleted
+        v['mws_php_libs_disabled'] = [name for name, library_id in pkgs if library_id not in libs]
+
+        # List of Unix groups and their associated gids
+        v['mws_unix_groups'] = []
+        # List of Unix Groups to be deleted
+        v['mws_delete_unix_groups'] = []
+        for unix_group in self.unix_groups[site.id]:
+            if unix_group.to_be_deleted:
+                v['mws_delete_unix_groups'].append({'name': unix_group.name})
+            else:
+                v['mws_unix_groups'].append({'name': unix_group.name, 'gid': INITIAL_GID-unix_group.id})
+
+        # Let ansible know if the VM should be quarantined (apache and exim services disabled)
+        v['mws_quarantined'] = service.quarantined
+
+        # URL to the panel to inform about the deletion of LVs
+        v['mws_update_lv_list_url'] = self.update_lv_list_url
+
+        # has this site been migrated to Openstack
+        v['mws_migrated'] = site.migrated
+
+        return v
+
+    def all_hostvars(self):
+        """Returns a dictionary with the host variables of every VM keyed by the host id"""
+        return dict((hostid(vm), self.hostvars(vm)) for vm in self.vms)
+
+    def inventory(self):
+        """Returns the whole inventory in the format expected by ansible's --list"""
+        result = {'_meta': {'hostvars': self.all_hostvars()}, group: [hostid(vm) for vm in self.vms]}
+        site_hosts = defaultdict(list)
+        for vm in self.vms:
+            site_hosts[vm.service.site_id].append(hostid(vm))
+        for site_id in Site.objects.filter(end_date__isnull=True).values_list('id', flat=True):
+            result[sitegroup(site_id)] = site_hosts[site_id]
+        return result
+
+
+def ansible_revision():
+    """
+    Returns the revision of the ansible playbooks and roles applied to the VMs: the contents of the file
+    ANSIBLE_REVISION_FILE, written when the playbooks are deployed, or the ANSIBLE_REVISION setting. None if it is
+    not known, in which case the runs cannot be skipped (see launch_ansible_async).
+    """
+    path = getattr(settings, 'ANSIBLE_REVISION_FILE', None)
+    if path:
+        try:
+            with open(path) as revision_file:
+                return revision_file.read().strip() or None
+        except IOError as e:
+            LOGGER.warning("The revision of the ansible playbooks cannot be read from %s: %s", path, e)
+    return getattr(settings, 'ANSIBLE_REVISION', None) or None
+
+
+def hostvars_fingerprint(hostvars, revision):
+    """Returns a digest of the host variables of a VM and of the revision of the playbooks applied to it, that only
+    changes if the variables or the playbooks change"""
+    return hashlib.sha256(json.dumps([revision, hostvars], sort_keys=True)).hexdigest()
+
+
+def snapshot_path():
+    """Returns the path of the materialized inventory or None if the snapshot is disabled"""
+    return getattr(settings, 'MWS_INVENTORY_SNAPSHOT', None)
+
+
+def stale_marker_path(path):
+    return path + ".stale"
+
+
+def scheduled_marker_path(path):
+    return path + ".scheduled"
+
+
+def claim_refresh(path):
+    """
+    Returns whether the caller has to schedule the regeneration of the snapshot, False if it is already scheduled.
+    The claim is released by the regeneration, or expires after MWS_INVENTORY_REFRESH_TIMEOUT seconds in case the
+    task was lost.
+    """
+    marker = scheduled_marker_path(path)
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        return True
+    except OSError:
+        pass
+    try:
+        expired = time.time() - os.path.getmtime(marker) > getattr(settings, 'MWS_INVENTORY_REFRESH_TIMEOUT', 600)
+    except OSError:
+        # Released in the meantime
+        return claim_refresh(path)
+    if expired:
+        os.utime(marker, None)
+    return expired
+
+
+def release_refresh(path):
+    try:
+        os.unlink(scheduled_marker_path(path))
+    except OSError:
+        pass
+
+
+def snapshot_is_stale(path):
+    """The snapshot is stale if it does not exist or if something changed after it was generated"""
+    if not os.path.exists(path):
+        return True
+    try:
+        return os.path.getmtime(stale_marker_path(path)) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def write_snapshot(path):
+    """Generates the whole inventory and atomically replaces the snapshot stored in path with it"""
+    started = time.time()
+    inventory = InventoryBuilder(inventory_vms()).inventory()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".inventory", dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(inventory, tmp_file)
+        os.chmod(tmp_path, 0o644)
+        # Date the snapshot when its generation started so that changes made while it was being generated
+        # keep it stale
+        os.utime(tmp_path, (started, started))
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def mark_snapshot_stale():
+    """Flags the snapshot as out of date and schedules its regeneration, unless it is already scheduled. Called
+    when a model used by the inventory changes."""
+    path = snapshot_path()
+    if not path:
+        return
+    with open(stale_marker_path(path), 'a'):
+        os.utime(stale_marker_path(path), None)
+    if claim_refresh(path):
+        refresh_inventory_snapshot.apply_async(countdown=getattr(settings, 'MWS_INVENTORY_REFRESH_DELAY', 5))
+
+
+def refresh_snapshot_if_stale():
+    """Regenerates the snapshot only if something has changed since it was last generated"""
+    path = snapshot_path()
+    if path and snapshot_is_stale(path):
+        write_snapshot(path)
+
+
+@shared_task
+def refresh_inventory_snapshot(force=False):
+    """Regenerates the snapshot. Changes usually come in bursts, only the first one schedules this task and the
+    rest of the burst is included in the snapshot generated after the delay."""
+    path = snapshot_path()
+    if not path:
+        return
+    # Changes made from now on schedule another regeneration
+    release_refresh(path)
+    if force or snapshot_is_stale(path):
+        LOGGER.info("Regenerating the ansible inventory snapshot %s", path)
+        write_snapshot(path)
@@ -1,8 +1,34 @@
+"""
+Client of the IPREG API, the DNS database of the University.
+
+Each :py:func:`ip_reg_call` invokes the API (``userv mws-admin mws_ipreg``) to make a single get, put or delete.
+Changes that go together are collected in a batch by :py:class:`IPRegBatch`. If IP_REG_BATCH is set, they are sent
+with a single invocation of the API, the ``batch`` call, which reads a JSON list with the arguments of each call from
+its standard input and writes a JSON list with the result of each call, in the same order,
+``{"result": <response of the call>}`` or ``{"error": <message>, "code": <exit code of the call>}``. Otherwise, or if
+the API rejects the ``batch`` call, they are sent one by one with :py:func:`ip_reg_call`.
+
+The changes made by the database signals (e.g. deleting the SSHFP records of every SiteKey of a site being deleted)
+are sent with :py:func:`ip_reg_batch_on_commit`, all the ones of the same transaction in a single batch once it is
+committed.
+
+:py:func:`get_nameinfo` caches the information of each hostname for IPREG_NAMEINFO_CACHE_TTL seconds in the Django
+cache IPREG_NAMEINFO_CACHE ("default" by default, which has to be shared by the web server and the celery workers,
+e.g. memcached or the database cache, for the invalidations to reach every process). Unless IPREG_NAMEINFO_CACHE_TTL
+is set, the information is only cached if that cache is shared by the processes. Putting or deleting a CNAME
+records the time of the change for the hostname and all its parent domains, which invalidates the information
+cached before the change for that hostname and for the hostnames of any zone containing it.
+
+"""
 import json
 import logging
 import subprocess
+import threading
+import time
 from celery import shared_task
 from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
 from apimws.jackdaw import SSHTaskWithFailure
 
 LOGGER = logging.getLogger('mws')
@@ -24,11 +50,73 @@ def ip_reg_call(call):
     return result
 
 
+def nameinfo_cache():
+    return caches[getattr(settings, 'IPREG_NAMEINFO_CACHE', 'default')]
+
+
+# Cache backends whose entries are only seen by the process that sets them
+PROCESS_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',
+                          'django.core.cache.backends.dummy.DummyCache')
+
+
+def nameinfo_cache_ttl():
+    """Seconds the nameinfo answers are cached, 0 (disabled) by default if the cache is not shared by the processes"""
+    ttl = getattr(settings, 'IPREG_NAMEINFO_CACHE_TTL', None)
+    if ttl is None:
+        backend = settings.CACHES[getattr(settings, 'IPREG_NAMEINFO_CACHE', 'default')]['BACKEND']
+        ttl = 0 if backend in PROCESS_CACHE_BACKENDS else 300
+    return ttl
+
+
+def parent_domains(hostname):
+    """The hostname and all its parent domains, e.g. www.example.cam.ac.uk, example.cam.ac.uk, ..., uk"""
+    labels = str(hostname).lower().rstrip('.').split('.')
+    return ['.'.join(labels[index:]) for index in range(len(labels))]
+
+
+def changed_key(name):
+    return 'ipreg-changed:%s' % name
+
+
+def invalidate_nameinfo(hostname):
+    """Invalidates the information cached for the hostname and for the hostnames of the zones containing it"""
+    if nameinfo_cache_ttl() <= 0:
+        return
+    now = time.time()
+    # The marks last as long as the entries they invalidate
+    nameinfo_cache().set_many(dict((changed_key(name), now) for name in parent_domains(hostname)),
+                              nameinfo_cache_ttl())
+
+
+def invalidate_changed_cnames(calls):
+    for call in calls:
+        if call[0] in ('put', 'delete') and call[1] == 'cname':
+            invalidate_nameinfo(call[2])
+
+
 def get_nameinfo(hostname):
+    """The IPREG information of a hostname, cached (see the module documentation)"""
+    ttl = nameinfo_cache_ttl()
+    name = parent_domains(hostname)[0]
+    key = 'ipreg-nameinfo:%s' % name
+    if ttl > 0:
+        entry = nameinfo_cache().get(key)
+        if entry is not None:
+            changes = nameinfo_cache().get_many([changed_key(entry['zone']), changed_key(name)])
+            if all(changed < entry['fetched'] for changed in changes.values()):
+                return entry['nameinfo']
+    fetched = time.time()
     try:
         result = ip_reg_call(['get', 'nameinfo', str(hostname)])
     except subprocess.CalledProcessError as excp:
         raise excp
+    if ttl > 0 and isinstance(result, dict):
+        nameinfo_cache().set(key, {
+            'nameinfo': result,
+            'zone': parent_domains(result.get('domain') or name)[0],
+            # Changes made while the information was requested invalidate it
+            'fetched': fetched,
+        }, ttl)
     return result
 
 
@@ -51,6 +139,8 @@ def set_cname(hostname, target):
         if excp.returncode == 7:
             raise DomainNameDelegatedException()
         raise excp
+    finally:
+        invalidate_nameinfo(hostname)
     return result
 
 
@@ -60,6 +150,8 @@ def delete_cname(hostname):
         result = ip_reg_call(['delete', 'cname', str(hostname)])
     except subprocess.CalledProcessError as excp:
         raise excp
+    finally:
+        invalidate_nameinfo(hostname)
     return result
 
 
@@ -85,3 +177,149 @@ def delete_sshfp(hostname, algorithm, fptype):
     except subprocess.CalledProcessError as excp:
         raise excp
     return result
+
+
+class IPRegFailure(Exception):
+    """A call of a batch failed"""
+
+    def __init__(self, message, call=None, code=None):
+        super(IPRegFailure, self).__init__(message)
+        self.call = call
+        self.code = code
+
+
+def ip_reg_batch_call(calls):
+    """
+    Makes many IPREG API calls, with a single invocation of the API if IP_REG_BATCH is set.
+
+    :param calls: list of the arguments of each call, as passed to ip_reg_call
+    :return: list with the result of each call in the same order, its response or an IPRegFailure if it failed
+    :raises: CalledProcessError or OSError if the API could not be invoked, ValueError if its response is not
+             properly formatted
+    """
+    if not calls:
+        return []
+    calls = [[str(argument) for argument in call] for call in calls]
+    try:
+        if getattr(settings, 'IP_REG_BATCH', False):
+            try:
+                return ip_reg_batch_request(calls)
+            except subprocess.CalledProcessError:
+                LOGGER.warning("The IPREG API rejected the batch call, sending the %d calls one by one", len(calls))
+        return [ip_reg_separate_call(call) for call in calls]
+    finally:
+        # Some of the changes may have been made even if the calls failed
+        invalidate_changed_cnames(calls)
+
+
+def ip_reg_separate_call(call):
+    """Makes an IPREG API call, returns an IPRegFailure if it fails (see ip_reg_batch_call)"""
+    try:
+        return ip_reg_call(call)
+    except subprocess.CalledProcessError as e:
+        return IPRegFailure(e.output, call, e.returncode)
+    except (ValueError, KeyError) as e:
+        return IPRegFailure(str(e), call)
+
+
+def ip_reg_batch_request(calls):
+    """Sends the calls with a single invocation of the "batch" call of the API (see ip_reg_batch_call)"""
+    command = settings.IP_REG_API_END_POINT + ['batch']
+    p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(json.dumps(calls))
+    if p.returncode != 0:
+        LOGGER.error("IPREG API Call: %s\n\nFAILED with exit code %i:\n%s%s", command, p.returncode, stdout, stderr)
+        raise subprocess.CalledProcessError(p.returncode, command, stdout)
+    try:
+        responses = json.loads(stdout)
+        if not isinstance(responses, list) or len(responses) != len(calls):
+            raise ValueError("%d results received for %d calls" % (len(responses), len(calls)))
+        results = [IPRegFailure(response['error'], call, response.get('code')) if 'error' in response
+                   else response.get('result') for call, response in zip(calls, responses)]
+    except (ValueError, TypeError, KeyError):
+        LOGGER.error("IPREG API response to the batch (%s) is not properly formatted: %s", calls, stdout)
+        raise ValueError("IPREG API response to the batch is not properly formatted")
+    for result in results:
+        if isinstance(result, IPRegFailure):
+            LOGGER.error("IPREG API Call: %s\n\nFAILED with exit code %s:\n%s", result.call, result.code, result)
+    return results
+
+
+class IPRegBatch(object):
+    """Collects IPREG changes to send them with a single invocation of the API"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def set_cname(self, hostname, target):
+        self.calls.append(['put', 'cname', hostname, target])
+
+    def delete_cname(self, hostname):
+        self.calls.append(['delete', 'cname', hostname])
+
+    def set_sshfp(self, hostname, algorithm, fptype, fingerprint):
+        self.calls.append(['put', 'sshfp', hostname, algorithm, fptype, fingerprint])
+
+    def delete_sshfp(self, hostname, algorithm, fptype):
+        self.calls.append(['delete', 'sshfp', hostname, algorithm, fptype])
+
+    def execute(self):
+        """
+        Sends the changes collected.
+
+        :return: the results of the calls, see ip_reg_batch_call
+        :raises: IPRegFailure if any of the calls failed, with the results of all the calls in results
+        """
+        results = ip_reg_batch_call(self.calls)
+        failures = [result for result in results if isinstance(result, IPRegFailure)]
+        if failures:
+            failure = IPRegFailure("%d of the %d IPREG calls failed, the first one: %s"
+                                   % (len(failures), len(results), failures[0]), failures[0].call, failures[0].code)
+            failure.results = results
+            raise failure
+        return results
+
+
+@shared_task(base=SSHTaskWithFailure, default_retry_delay=5*60, max_retries=6)  # Retry each 5 minutes for 30 minutes
+def ip_reg_batch(calls):
+    """Sends a batch of IPREG calls, it is retried if the API cannot be invoked"""
+    batch = IPRegBatch()
+    batch.calls = calls
+    try:
+        return batch.execute()
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        raise ip_reg_batch.retry(exc=e)
+
+
+class PendingBatch(IPRegBatch):
+    """The batch of the calls made during a transaction, it is sent when the transaction is committed"""
+
+    def __call__(self):
+        _pending.batch = None
+        if self.calls:
+            ip_reg_batch.delay(self.calls)
+
+
+_pending = threading.local()
+
+
+def ip_reg_batch_on_commit(batch):
+    """
+    Sends the calls of the batch once the current transaction is committed, together with the other calls made
+    during the same transaction (e.g. by the signals sent while a site and its related objects are deleted).
+    Outside of a transaction they are sent straight away.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        if len(batch):
+            ip_reg_batch.delay(batch.calls)
+        return
+    pending = getattr(_pending, 'batch', None)
+    if pending is None or pending not in [callback for _, callback in connection.run_on_commit]:
+        # There is no batch waiting for this transaction, or it was discarded when the transaction was rolled back
+        pending = _pending.batch = PendingBatch()
+        transaction.on_commit(pending)
+    pending.calls.extend(batch.calls)
@@ -0,0 +1,65 @@
+"""
+Locks shared by all the celery workers, stored in the database (see :py:class:`apimws.models.TaskLock`).
+
+Acquiring or releasing a lock is a single indexed query, it does not depend on the number of workers. Locks expire
+after a TTL so that a lock held by a worker that died is eventually released.
+
+"""
+import logging
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from apimws.models import TaskLock
+
+
+LOGGER = logging.getLogger('mws')
+
+
+class LockNotAcquired(Exception):
+    pass
+
+
+def acquire_lock(key, ttl=None):
+    """
+    Tries to acquire a lock without waiting.
+
+    :param key: the name of the lock
+    :param ttl: seconds after which the lock expires if it has not been released, TASK_LOCK_TTL by default
+    :return: the token needed to release the lock, or None if the lock is held by someone else
+    """
+    if ttl is None:
+        ttl = getattr(settings, 'TASK_LOCK_TTL', 300)
+    now = timezone.now()
+    TaskLock.objects.filter(key=key, expires__lt=now).delete()
+    token = uuid.uuid4().hex
+    try:
+        with transaction.atomic():
+            TaskLock.objects.create(key=key, token=token, expires=now + timedelta(seconds=ttl))
+    except IntegrityError:
+        return None
+    return token
+
+
+def release_lock(key, token):
+    """Releases a lock, unless it expired and was acquired by someone else in the meantime"""
+    if not TaskLock.objects.filter(key=key, token=token).delete()[0]:
+        LOGGER.warning("The lock %s expired before being released", key)
+
+
+@contextmanager
+def task_lock(key, ttl=None):
+    """
+    Context manager holding a lock while its block is executed.
+
+    :raises LockNotAcquired: if the lock is held by someone else
+    """
+    token = acquire_lock(key, ttl)
+    if token is None:
+        raise LockNotAcquired(key)
+    try:
+        yield
+    finally:
+        release_lock(key, token)
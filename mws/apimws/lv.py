@@ -1,11 +1,12 @@
 from datetime import datetime, date
 import logging
+from django.conf import settings
 from django.http import HttpResponse, HttpResponseNotFound
 from django.views.decorators.csrf import csrf_exempt
 import re
 from stronghold.decorators import public
-import subprocess
 from apimws.models import AnsibleConfiguration
+from apimws.process import run_command
 from sitesmanagement.models import VirtualMachine
 from sitesmanagement.utils import get_object_or_None
 
@@ -27,8 +28,8 @@ def update_lv_list(request):
             vm = get_object_or_None(VirtualMachine, name=request.POST['hostname'])
             if vm and (vm.network_configuration.IPv4 == ip or vm.network_configuration.IPv6 == ip or
                        vm.service.network_configuration.IPv4 == ip or vm.service.network_configuration.IPv6 == ip):
-                result = subprocess.check_output(["userv", "mws-admin", "mws_extract_lv_info",
-                                                  vm.network_configuration.name])
+                result = run_command(["userv", "mws-admin", "mws_extract_lv_info", vm.network_configuration.name],
+                                     timeout=getattr(settings, 'LV_INFO_TIMEOUT', 60), max_lines=0)
                 lvlist = []
                 first_date = date.today()
                 for lv in result.splitlines():
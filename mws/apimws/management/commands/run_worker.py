@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from mws.celery import app
+
+
+class Command(BaseCommand):
+    help = "Starts a celery worker consuming the queues of one of the profiles in CELERY_WORKER_PROFILES."
+
+    def add_arguments(self, parser):
+        parser.add_argument('profile', type=str)
+        parser.add_argument("--concurrency", type=int,
+                            help="number of worker processes, overrides the one of the profile")
+        parser.add_argument("--loglevel", default='info', help="logging level of the worker")
+
+    def handle(self, profile=None, concurrency=None, loglevel=None, **options):
+        profiles = getattr(settings, 'CELERY_WORKER_PROFILES', {})
+        if profile not in profiles:
+            raise CommandError("Unknown worker profile %s, the available profiles are: %s"
+                               % (profile, ", ".join(sorted(profiles))))
+        app.worker_main(self.worker_arguments(profile, profiles[profile], concurrency, loglevel))
+
+    def worker_arguments(self, profile, config, concurrency, loglevel):
+        argv = ['worker', '--loglevel', loglevel, '--hostname', '%s@%%h' % profile,
+                '--queues', ",".join(config['queues']),
+                '--concurrency', str(concurrency or config.get('concurrency', 1))]
+        if config.get('beat'):
+            argv.append('--beat')
+        return argv
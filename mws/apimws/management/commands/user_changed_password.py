@@ -15,4 +15,5 @@ class Command(BaseCommand):
         except User.DoesNotExist:
             return  # The user has never used MWS
 
-        launch_ansible_by_user(user)
+        # The password is not in the host variables of the VMs, an unforced run would skip them
+        launch_ansible_by_user(user, force=True)
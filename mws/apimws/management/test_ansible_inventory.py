@@ -1,12 +1,26 @@
+import imp
+import mock
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import uuid
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core.management.base import CommandError
 import json
 from StringIO import StringIO
 from datetime import datetime
+from apimws.inventory import INITIAL_GID, mark_snapshot_stale, refresh_inventory_snapshot, \
+    refresh_snapshot_if_stale, snapshot_is_stale
 from apimws.models import Cluster, Host, PHPLib, AnsibleConfiguration
 from apimws.xen import which_cluster
-from sitesmanagement.models import (Site, VirtualMachine, NetworkConfig, Service, ServerType)
+from mwsauth.models import MWSUser
+from sitesmanagement.models import (Site, VirtualMachine, NetworkConfig, Service, ServerType, UnixGroup)
 from .commands.ansible_inventory import Command
 
 
@@ -120,3 +134,173 @@ class TestsWithData(TestCase):
 
         self.assertEqual(v['mws_php_libs_enabled'], ['libphp-adodb'])
         self.assertEqual(len(v['mws_php_libs_disabled']), PHPLib.objects.filter(name_next_os__isnull=False).count() - 1)
+
+
+class FleetMixin(object):
+    """Creates a synthetic fleet of sites, each one with a VM, vhosts, domain names, users and unix groups"""
+
+    def setUp(self):
+        self.cluster = Cluster.objects.create(name="mws-bench-1")
+        Host.objects.create(hostname="mws-bench-1.dev.mws3.cam.ac.uk", cluster=self.cluster)
+        self.servertype = ServerType.objects.get(id=1)
+
+    def create_fleet(self, size, offset=0):
+        for i in range(offset, offset+size):
+            MWSUser.objects.create(user_id="bench%04d" % i, uid=10000+i, ssh_public_key="ssh-rsa KEY%d" % i)
+            with mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Bench User"):
+                user = User.objects.create(username="bench%04d" % i)
+            site = Site.objects.create(name="benchSite%04d" % i, start_date=datetime.today(), type=self.servertype,
+                                       email="bench%04d@example.com" % i)
+            site.users.add(user)
+            service = Service.objects.create(
+                type="production", site=site, status="ready", network_configuration=NetworkConfig.objects.create(
+                    IPv4='10.1.%d.%d' % (i // 250, i % 250), IPv6='2001:db8:1::%x' % i, type='ipvxpub',
+                    name="mws-bench-%04d.mws3.example" % i))
+            Service.objects.create(type="test", site=site, status="ready",
+                                   network_configuration=NetworkConfig.objects.create(
+                                       IPv4='10.2.%d.%d' % (i // 250, i % 250), type='ipv4priv',
+                                       name="mws-bench-%04d.mws3.private.example" % i))
+            VirtualMachine.objects.create(
+                name="bench_vm%04d" % i, token=uuid.uuid4(), service=service, cluster=self.cluster,
+                network_configuration=NetworkConfig.objects.create(IPv6='2001:db8:2::%x' % i, type='ipv6',
+                                                                   name="mws-bench-client%04d.example" % i))
+            AnsibleConfiguration.objects.create(service=service, key='os', value='stretch')
+            vhost = service.vhosts.create(name="default")
+            vhost.domain_names.create(name="bench%04d.example" % i, status='global')
+            vhost.domain_names.create(name="bench%04d.private.example" % i, status='private')
+            unix_group = UnixGroup.objects.create(name="BENCH", service=service)
+            unix_group.users.add(user)
+
+
+class InventoryBenchmarkTests(FleetMixin, TestCase):
+    """Query count benchmark of the inventory against a synthetic fleet"""
+
+    def measure(self):
+        s = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            Command().handle(list=True, outfile=s)
+        return json.loads(s.getvalue()), len(queries)
+
+    def test_query_count_does_not_depend_on_fleet_size(self):
+        self.create_fleet(2)
+        r, small_fleet_queries = self.measure()
+        self.assertEqual(len(r['mwsclients']), 2)
+        self.create_fleet(20, offset=2)
+        r, big_fleet_queries = self.measure()
+        self.assertEqual(len(r['mwsclients']), 22)
+        self.assertEqual(small_fleet_queries, big_fleet_queries)
+
+    def test_list_matches_host(self):
+        self.create_fleet(5)
+        r, _ = self.measure()
+        for hostname, hostvars in r['_meta']['hostvars'].items():
+            s = StringIO()
+            Command().handle(host=hostname, outfile=s)
+            self.assertEqual(json.loads(s.getvalue()), hostvars)
+        v = r['_meta']['hostvars']["mws-bench-client0003.example"]
+        self.assertEqual(v['mws_users'], [{'username': 'bench0003', 'groups': ['BENCH'], 'uid': 10003,
+                                           'ssh_key': 'ssh-rsa KEY3'}])
+        self.assertEqual(v['mws_vhosts'][0]['domains'], ["bench0003.example", "bench0003.private.example"])
+        self.assertEqual(v['mws_vhosts'][0]['cert_domains']['acme'], ["bench0003.example"])
+        self.assertEqual(v['mws_unix_groups'], [{'name': 'BENCH', 'gid': INITIAL_GID-UnixGroup.objects.get(
+            service__site__name="benchSite0003").id}])
+        self.assertTrue(v['mws_test_active'] is False)
+        self.assertEqual(r['mwssite-%d' % Site.objects.get(name="benchSite0003").id],
+                         ["mws-bench-client0003.example"])
+
+    def test_list_makes_fewer_queries_than_host_per_vm(self):
+        self.create_fleet(20)
+        r, list_queries = self.measure()
+        with CaptureQueriesContext(connection) as host_queries:
+            for hostname in r['mwsclients']:
+                Command().handle(host=hostname, outfile=StringIO())
+        # A single --list makes the same queries as a single --host
+        self.assertLessEqual(list_queries * 20, len(host_queries))
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                      'scripts', 'mws_inventory.py')
+
+
+class InventorySnapshotTests(FleetMixin, TestCase):
+    """Tests the materialized inventory and the Django-free script that serves it"""
+
+    def setUp(self):
+        super(InventorySnapshotTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'inventory.json')
+        self.settings_override = override_settings(MWS_INVENTORY_SNAPSHOT=self.path)
+        self.settings_override.enable()
+        self.create_fleet(3)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def command_output(self, **options):
+        s = StringIO()
+        Command().handle(outfile=s, **options)
+        return json.loads(s.getvalue())
+
+    def script_output(self, *args):
+        output = subprocess.check_output([sys.executable, SCRIPT] + list(args), stderr=subprocess.STDOUT,
+                                         env=dict(os.environ, MWS_INVENTORY_SNAPSHOT=self.path))
+        return json.loads(output)
+
+    def test_script_serves_snapshot(self):
+        Command().handle(snapshot=True)
+        inventory = self.command_output(list=True)
+        self.assertEqual(self.script_output('--list'), inventory)
+        for hostname in inventory['mwsclients']:
+            self.assertEqual(self.script_output('--host', hostname), self.command_output(host=hostname))
+        self.assertEqual(self.script_output('--host', 'unknown.example'), {})
+
+    def test_script_does_not_import_django(self):
+        refresh_inventory_snapshot()
+        script = imp.load_source('mws_inventory', SCRIPT)
+        s = StringIO()
+        with mock.patch.dict(os.environ, MWS_INVENTORY_SNAPSHOT=self.path):
+            self.assertEqual(script.main(['--list'], outfile=s), 0)
+        self.assertEqual(json.loads(s.getvalue()), self.command_output(list=True))
+        self.assertNotIn('django', open(SCRIPT).read())
+
+    def test_missing_snapshot(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.script_output('--list')
+
+    def test_stale(self):
+        self.assertTrue(snapshot_is_stale(self.path))
+        refresh_snapshot_if_stale()
+        self.assertFalse(snapshot_is_stale(self.path))
+        with mock.patch("apimws.inventory.refresh_inventory_snapshot.apply_async") as mock_refresh:
+            # A burst of changes schedules a single regeneration
+            for _ in range(10):
+                mark_snapshot_stale()
+        mock_refresh.assert_called_once_with(countdown=5)
+        self.assertTrue(snapshot_is_stale(self.path))
+
+        # The regeneration picks up the changes made since the last snapshot
+        self.create_fleet(1, offset=3)
+        refresh_inventory_snapshot()
+        self.assertFalse(snapshot_is_stale(self.path))
+        self.assertEqual(len(self.script_output('--list')['mwsclients']), 4)
+        with mock.patch("apimws.inventory.write_snapshot") as mock_write:
+            refresh_inventory_snapshot()
+            refresh_snapshot_if_stale()
+        self.assertFalse(mock_write.called)
+
+        # Once the regeneration has started the next change schedules another one
+        with mock.patch("apimws.inventory.refresh_inventory_snapshot.apply_async") as mock_refresh:
+            mark_snapshot_stale()
+        self.assertEqual(mock_refresh.call_count, 1)
+
+    def test_lost_refresh_expires(self):
+        with mock.patch("apimws.inventory.refresh_inventory_snapshot.apply_async") as mock_refresh:
+            mark_snapshot_stale()
+            mark_snapshot_stale()
+            self.assertEqual(mock_refresh.call_count, 1)
+            # The task never ran
+            old = time.time() - 3600
+            os.utime(self.path + ".scheduled", (old, old))
+            mark_snapshot_stale()
+            self.assertEqual(mock_refresh.call_count, 2)
@@ -0,0 +1,45 @@
+from django.core.management import call_command, CommandError
+from django.test import SimpleTestCase
+from mock import mock
+from mws.task_routing import TaskRouter, task_queue, BULK_PRIORITY, USER_PRIORITY
+
+
+class RunWorkerTests(SimpleTestCase):
+
+    def run_worker(self, *args, **kwargs):
+        with mock.patch("apimws.management.commands.run_worker.app.worker_main") as mock_worker_main:
+            call_command('run_worker', *args, **kwargs)
+        return mock_worker_main.call_args[0][0]
+
+    def test_profiles(self):
+        self.assertEqual(self.run_worker('interactive'), [
+            'worker', '--loglevel', 'info', '--hostname', 'interactive@%h', '--queues', 'interactive',
+            '--concurrency', '8'])
+        self.assertEqual(self.run_worker('scheduled', concurrency=1), [
+            'worker', '--loglevel', 'info', '--hostname', 'scheduled@%h', '--queues', 'scheduled,celery',
+            '--concurrency', '1', '--beat'])
+
+    def test_unknown_profile(self):
+        with self.assertRaises(CommandError):
+            self.run_worker('unknown')
+
+
+class TaskRouterTests(SimpleTestCase):
+
+    def test_routes(self):
+        self.assertEqual(task_queue('apimws.xen.change_vm_power_state'), 'interactive')
+        self.assertEqual(task_queue('apimws.xen_mock.change_vm_power_state'), 'interactive')
+        self.assertEqual(task_queue('apimws.utils.send_email_confirmation'), 'interactive')
+        self.assertEqual(task_queue('apimws.ansible_impl.launch_ansible_async'), 'provisioning')
+        self.assertEqual(task_queue('apimws.xen.new_site_primary_vm'), 'provisioning')
+        self.assertEqual(task_queue('sitesmanagement.cronjobs.validate_domains'), 'scheduled')
+        self.assertEqual(task_queue('apimws.jackdaw.jackdaw_api'), 'scheduled')
+        self.assertEqual(task_queue('celery.backend_cleanup'), 'celery')
+
+    def test_router(self):
+        router = TaskRouter()
+        self.assertEqual(router.route_for_task('apimws.xen.reset_vm'),
+                         {'queue': 'interactive', 'routing_key': 'interactive', 'priority': USER_PRIORITY})
+        self.assertEqual(router.route_for_task('sitesmanagement.cronjobs.expire_domains'),
+                         {'queue': 'scheduled', 'routing_key': 'scheduled', 'priority': BULK_PRIORITY})
+        self.assertIsNone(router.route_for_task('celery.backend_cleanup'))
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-18 20:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0083_virtualmachine_ansible_fingerprint'),
+        ('apimws', '0016_queueentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingAnsibleRun',
+            fields=[
+                ('service', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='sitesmanagement.Service')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('force', models.BooleanField(default=False)),
+            ],
+            options={
+                'ordering': ['created'],
+            },
+        ),
+    ]
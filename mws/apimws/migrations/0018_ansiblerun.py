@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-18 20:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0017_pendingansiblerun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnsibleRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('host', models.CharField(db_index=True, max_length=250)),
+                ('command', models.CharField(max_length=100)),
+                ('tags', models.CharField(blank=True, db_index=True, max_length=250)),
+                ('started', models.DateTimeField(db_index=True)),
+                ('finished', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('exit_code', models.IntegerField()),
+                ('output', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-18 22:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0019_tasklock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='cpus',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='disk',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='ram',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-18 22:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0020_host_capacity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='circuit_open_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='consecutive_failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='error_rate',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='latency',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='requests',
+            field=models.IntegerField(default=0),
+        ),
+    ]
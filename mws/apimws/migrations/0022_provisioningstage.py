@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-18 23:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0083_virtualmachine_ansible_fingerprint'),
+        ('apimws', '0021_host_health'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProvisioningStage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=250)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('retrying', 'Waiting to retry'), ('done', 'Done'), ('failed', 'Failed')], max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='provisioning_stages', to='sitesmanagement.Service')),
+                ('vm', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='provisioning_stages', to='sitesmanagement.VirtualMachine')),
+            ],
+            options={
+                'ordering': ['started'],
+            },
+        ),
+    ]
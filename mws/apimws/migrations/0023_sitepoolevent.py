@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-18 23:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0083_virtualmachine_ansible_fingerprint'),
+        ('apimws', '0022_provisioningstage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SitePoolEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('requested', 'Site requested'), ('unavailable', 'Site requested with the pool empty'), ('started', 'Build started'), ('built', 'Build finished')], max_length=20)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('servertype', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pool_events', to='sitesmanagement.ServerType')),
+                ('site', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='pool_events', to='sitesmanagement.Site')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='sitepoolevent',
+            index_together=set([('servertype', 'kind', 'created')]),
+        ),
+    ]
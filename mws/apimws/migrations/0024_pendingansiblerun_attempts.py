@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 09:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apimws', '0023_sitepoolevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendingansiblerun',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
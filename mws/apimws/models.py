@@ -1,6 +1,7 @@
 from django.conf import settings
 from django.db import models
-from sitesmanagement.models import Service, Site
+from django.utils import timezone
+from sitesmanagement.models import Service, Site, ServerType
 
 
 class Cluster(models.Model):
@@ -13,6 +14,17 @@ class Cluster(models.Model):
 class Host(models.Model):
     hostname = models.CharField(max_length=250, primary_key=True)
     cluster = models.ForeignKey(Cluster, related_name='hosts')
+    # Resources that the host provides to VMs, used to place new VMs (see apimws.placement). 0 means unknown.
+    cpus = models.IntegerField(default=0)  # Number of vCPUs
+    ram = models.IntegerField(default=0)  # In GB
+    disk = models.IntegerField(default=0)  # In GB
+    # Health of the VM API of the host, used to choose the host that receives each request (see apimws.host_health)
+    latency = models.FloatField(null=True, blank=True)  # Moving average of the response time, in seconds
+    error_rate = models.FloatField(default=0)  # Moving average of the fraction of failed requests
+    requests = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    consecutive_failures = models.IntegerField(default=0)
+    circuit_open_until = models.DateTimeField(null=True, blank=True)  # The host is avoided until then
 
     def __unicode__(self):
         return self.hostname
@@ -70,3 +82,105 @@ class QueueEntry(models.Model):
 
     def __unicode__(self):
         return self.site.name
+
+
+class PendingAnsibleRun(models.Model):
+    """
+    A service waiting for the next batched ansible run. Requests received during the batching window are
+    executed together in a single ansible invocation.
+    """
+    service = models.OneToOneField(Service, on_delete=models.CASCADE, primary_key=True)
+    created = models.DateTimeField(auto_now_add=True)
+    force = models.BooleanField(default=False)
+    attempts = models.PositiveIntegerField(default=0)  # Failed runs retried
+
+    class Meta:
+        ordering = ['created']
+
+    def __unicode__(self):
+        return unicode(self.service)
+
+
+class AnsibleRun(models.Model):
+    """
+    A record of an ansible invocation against a host, used to find slow hosts and slow playbook tags
+    """
+    host = models.CharField(max_length=250, db_index=True)
+    command = models.CharField(max_length=100)
+    tags = models.CharField(max_length=250, blank=True, db_index=True)
+    started = models.DateTimeField(db_index=True)
+    finished = models.DateTimeField()
+    duration = models.FloatField()  # In seconds
+    exit_code = models.IntegerField()
+    output = models.TextField(blank=True)  # Only the last ANSIBLE_RUN_OUTPUT_LIMIT characters
+
+    class Meta:
+        ordering = ['-started']
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.command, self.host, self.started)
+
+
+class TaskLock(models.Model):
+    """
+    A lock held by a celery task (see apimws.locks). The row exists while the lock is held, and it is ignored after
+    it expires so that a worker killed while holding the lock does not block the key forever.
+    """
+    key = models.CharField(max_length=250, unique=True)
+    token = models.CharField(max_length=32)
+    expires = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.key
+
+
+class ProvisioningStage(models.Model):
+    """
+    Progress of a stage of the provisioning pipeline of a VM (see apimws.provisioning)
+    """
+    STATUS_CHOICES = (
+        ('running', 'Running'),
+        ('retrying', 'Waiting to retry'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    service = models.ForeignKey(Service, related_name='provisioning_stages')
+    vm = models.ForeignKey('sitesmanagement.VirtualMachine', null=True, blank=True, on_delete=models.SET_NULL,
+                           related_name='provisioning_stages')
+    stage = models.CharField(max_length=250)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    attempts = models.IntegerField(default=0)
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['started']
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.service, self.stage, self.status)
+
+
+class SitePoolEvent(models.Model):
+    """
+    An event of the pool of preallocated sites of a server type (see apimws.pool), used to measure the demand of new
+    sites and the time it takes to build them
+    """
+    KIND_CHOICES = (
+        ('requested', 'Site requested'),
+        ('unavailable', 'Site requested with the pool empty'),
+        ('started', 'Build started'),
+        ('built', 'Build finished'),
+    )
+    servertype = models.ForeignKey(ServerType, related_name='pool_events')
+    site = models.ForeignKey(Site, null=True, blank=True, on_delete=models.SET_NULL, related_name='pool_events')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    created = models.DateTimeField(default=timezone.now)
+    duration = models.FloatField(null=True, blank=True)  # Build time in seconds of the built events
+
+    class Meta:
+        ordering = ['-created']
+        index_together = [['servertype', 'kind', 'created']]
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.servertype_id, self.kind, self.created)
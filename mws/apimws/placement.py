@@ -0,0 +1,162 @@
+"""
+Placement of new VMs in the Xen clusters.
+
+The capacity of a cluster is the sum of the resources (vCPUs, RAM and disk) of its hosts, and its usage is the sum
+of the resources assigned to the VMs of the cluster. A new VM is placed in one of the clusters where it fits,
+chosen by the policy in the VM_PLACEMENT_POLICY setting:
+
+- ``least-loaded`` spreads the VMs, choosing the cluster that will be the least used after placing the VM.
+- ``bin-packing`` fills the clusters one by one, choosing the cluster that will be the most used after placing the
+  VM, so that the free space is kept together for the biggest VMs.
+
+The policies only work with :py:class:`ClusterCapacity` objects, which can be built from the database with
+:py:func:`cluster_capacities` or by hand.
+
+"""
+import logging
+from collections import namedtuple
+from django.conf import settings
+from django.db.models import Sum, Count
+from apimws.models import Cluster, Host
+from sitesmanagement.models import VirtualMachine
+
+
+LOGGER = logging.getLogger('mws')
+
+
+class NoCapacityAvailable(Exception):
+    pass
+
+
+class Resources(namedtuple('Resources', ['cpus', 'ram', 'disk'])):
+    """vCPUs, GB of RAM and GB of disk"""
+
+    def __add__(self, other):
+        return Resources(*[a + b for a, b in zip(self, other)])
+
+    def __sub__(self, other):
+        return Resources(*[a - b for a, b in zip(self, other)])
+
+    def fits_in(self, other):
+        return all(a <= b for a, b in zip(self, other))
+
+
+NO_RESOURCES = Resources(0, 0, 0)
+
+
+class ClusterCapacity(object):
+
+    def __init__(self, cluster, total, used=NO_RESOURCES, vms=0, hosts=None):
+        self.cluster = cluster
+        self.total = total
+        self.used = used
+        self.vms = vms
+        self.hosts = hosts or []
+
+    @property
+    def free(self):
+        return self.total - self.used
+
+    @property
+    def known(self):
+        """Whether the capacity of the hosts of the cluster has been configured"""
+        return self.total != NO_RESOURCES
+
+    def utilisation(self, used=None):
+        """Fraction of the most used resource of the cluster"""
+        used = used or self.used
+        return max(float(u) / t if t else 0.0 for u, t in zip(used, self.total))
+
+    def as_dict(self):
+        return {
+            'cluster': self.cluster.name,
+            'vms': self.vms,
+            'total': self.total._asdict(),
+            'used': self.used._asdict(),
+            'free': self.free._asdict(),
+            'utilisation': round(self.utilisation(), 3),
+            'hosts': [{'hostname': host.hostname, 'cpus': host.cpus, 'ram': host.ram, 'disk': host.disk}
+                      for host in self.hosts],
+        }
+
+
+def least_loaded(capacity, requirements):
+    return -capacity.utilisation(capacity.used + requirements)
+
+
+def bin_packing(capacity, requirements):
+    return capacity.utilisation(capacity.used + requirements)
+
+
+POLICIES = {
+    'least-loaded': least_loaded,
+    'bin-packing': bin_packing,
+}
+
+
+def choose_cluster(capacities, requirements, policy=None):
+    """
+    Chooses the cluster for a new VM.
+
+    :param capacities: list of ClusterCapacity
+    :param requirements: Resources needed by the VM
+    :param policy: name of the policy, VM_PLACEMENT_POLICY by default
+    :return: the ClusterCapacity chosen
+    :raises NoCapacityAvailable: if the VM does not fit in any cluster
+    """
+    score = POLICIES[policy or getattr(settings, 'VM_PLACEMENT_POLICY', 'least-loaded')]
+    candidates = [capacity for capacity in capacities if requirements.fits_in(capacity.free)]
+    if not candidates:
+        raise NoCapacityAvailable("No cluster has %s available" % (requirements, ))
+    # Ties are resolved by the name of the cluster so that the placement is deterministic
+    return max(sorted(candidates, key=lambda capacity: capacity.cluster.name),
+               key=lambda capacity: score(capacity, requirements))
+
+
+def cluster_capacities():
+    """Returns the ClusterCapacity of every cluster, computed with aggregated queries"""
+    clusters = dict((cluster.name, cluster) for cluster in Cluster.objects.all())
+    hosts = {}
+    for host in Host.objects.order_by('hostname'):
+        hosts.setdefault(host.cluster_id, []).append(host)
+    used = dict((row['cluster_id'], row) for row in VirtualMachine.objects.order_by().values('cluster_id').annotate(
+        cpus=Sum('numcpu'), ram=Sum('sizeram'), disk=Sum('service__site__type__sizedisk'), vms=Count('id')))
+    capacities = []
+    for name in sorted(clusters):
+        cluster_hosts = hosts.get(name, [])
+        total = sum((Resources(host.cpus, host.ram, host.disk) for host in cluster_hosts), NO_RESOURCES)
+        row = used.get(name, {})
+        capacities.append(ClusterCapacity(clusters[name], total,
+                                          Resources(row.get('cpus') or 0, row.get('ram') or 0, row.get('disk') or 0),
+                                          row.get('vms', 0), cluster_hosts))
+    return capacities
+
+
+def servertype_requirements(servertype):
+    """Resources needed by a new VM of the server type"""
+    return Resources(servertype.numcpu, servertype.sizeram, servertype.sizedisk)
+
+
+def site_requirements(site):
+    """Resources needed by a new VM of a site: the ones of its production VM if it exists (test VMs are a copy of it)
+    or the ones of its server type"""
+    vm = site.production_service.virtual_machines.first() if site.production_service else None
+    if vm:
+        return Resources(vm.numcpu, vm.sizeram, site.type.sizedisk)
+    return servertype_requirements(site.type)
+
+
+def place_vm(requirements, policy=None):
+    """
+    Returns the cluster where a new VM with the given requirements has to be created.
+
+    Clusters whose hosts do not have their capacity configured are not considered. If no cluster has it configured
+    the first cluster is returned, as it was done before the capacity was known.
+    """
+    capacities = [capacity for capacity in cluster_capacities() if capacity.known]
+    if not capacities:
+        return Cluster.objects.first()
+    capacity = choose_cluster(capacities, requirements, policy)
+    LOGGER.info("New VM needing %s placed in the cluster %s (%s used)", requirements, capacity.cluster.name,
+                capacity.used)
+    return capacity.cluster
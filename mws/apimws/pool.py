@@ -0,0 +1,181 @@
+"""
+Elastic pool of preallocated sites.
+
+New sites are handed to users from a pool of preallocated sites of each server type, built in advance because a
+build takes several minutes. The pool manager (:py:func:`replenish_pool`) keeps for each server type a buffer sized
+from the demand:
+
+- the demand is the rate of sites requested per hour, the highest measured over the windows of the
+  POOL_DEMAND_WINDOWS setting (hours), so that a burst of requests (e.g. at the start of term) is noticed quickly
+  while a quiet day does not shrink the pool;
+- the target is the number of sites requested during the time it takes to build a site, multiplied by
+  POOL_SAFETY_FACTOR, never below the ServerType.preallocated minimum nor above POOL_MAX_SITES. Server types with
+  no preallocated sites configured are not offered from the pool;
+- the missing sites are built concurrently, up to POOL_MAX_CONCURRENT_BUILDS builds in flight and as many as fit
+  in the free capacity of the clusters (see apimws.placement).
+
+The demand and the build times are measured with :py:class:`~apimws.models.SitePoolEvent` records.
+
+"""
+import logging
+import math
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Count, Avg
+from django.utils import timezone
+from apimws.locks import task_lock, LockNotAcquired
+from apimws.models import SitePoolEvent
+from apimws.placement import cluster_capacities, servertype_requirements, NoCapacityAvailable
+from sitesmanagement.models import ServerType, Site
+
+
+LOGGER = logging.getLogger('mws')
+
+DEMAND_KINDS = ('requested', 'unavailable')
+
+
+def record_event(servertype, kind, site=None):
+    return SitePoolEvent.objects.create(servertype=servertype, kind=kind, site=site)
+
+
+def site_built(site):
+    """Records that a preallocated site has finished building"""
+    started = SitePoolEvent.objects.filter(site=site, kind='started').first()
+    if started is None:
+        return None
+    return SitePoolEvent.objects.create(servertype=site.type, site=site, kind='built',
+                                        duration=(timezone.now() - started.created).total_seconds())
+
+
+class PoolStatus(object):
+
+    def __init__(self, servertype, available=0, building=0, rate=0.0, build_time=None, stalled=0):
+        self.servertype = servertype
+        self.available = available  # Sites ready to be handed to users
+        self.building = building  # Sites being built
+        self.stalled = stalled  # Sites whose build started more than POOL_BUILD_TIMEOUT seconds ago
+        self.rate = rate  # Sites requested per hour
+        self.build_time = build_time or getattr(settings, 'POOL_DEFAULT_BUILD_TIME', 20*60)  # In seconds
+
+    @property
+    def target(self):
+        if not self.servertype.preallocated:
+            return 0
+        demand = int(math.ceil(self.rate * self.build_time / 3600.0 * getattr(settings, 'POOL_SAFETY_FACTOR', 2)))
+        return min(max(self.servertype.preallocated, demand),
+                   max(self.servertype.preallocated, getattr(settings, 'POOL_MAX_SITES', 20)))
+
+    @property
+    def deficit(self):
+        return max(self.target - self.available - self.building, 0)
+
+    @property
+    def time_to_replenish(self):
+        """Estimated seconds until the pool reaches its target"""
+        missing = max(self.target - self.available, 0)
+        if not missing:
+            return 0
+        concurrency = getattr(settings, 'POOL_MAX_CONCURRENT_BUILDS', 4)
+        return int(math.ceil(float(missing) / concurrency) * self.build_time)
+
+    def as_dict(self):
+        return {
+            'servertype': self.servertype.id,
+            'description': unicode(self.servertype),
+            'available': self.available,
+            'building': self.building,
+            'stalled': self.stalled,
+            'target': self.target,
+            'requests_per_hour': round(self.rate, 3),
+            'build_time': round(self.build_time, 1),
+            'time_to_replenish': self.time_to_replenish,
+        }
+
+
+def pool_status(now=None):
+    """Returns the PoolStatus of every server type, computed with aggregated queries"""
+    now = now or timezone.now()
+    sites = {}
+    for row in Site.objects.filter(preallocated=True).order_by().values('type_id', 'disabled').annotate(
+            sites=Count('id')):
+        # Preallocated sites are disabled once they have been built (see apimws.views.post_installOS)
+        sites[(row['type_id'], row['disabled'])] = row['sites']
+    # Builds that did not finish in time probably failed, they are not taken into account as sites being built
+    stalled = dict(Site.objects.filter(
+        preallocated=True, disabled=False, pool_events__kind='started',
+        pool_events__created__lt=now - timedelta(seconds=getattr(settings, 'POOL_BUILD_TIMEOUT', 2*60*60))
+    ).order_by().values('type_id').annotate(sites=Count('id', distinct=True)).values_list('type_id', 'sites'))
+    rates = {}
+    for hours in getattr(settings, 'POOL_DEMAND_WINDOWS', (24, 7*24)):
+        for row in SitePoolEvent.objects.filter(kind__in=DEMAND_KINDS, created__gt=now - timedelta(hours=hours)) \
+                .order_by().values('servertype_id').annotate(events=Count('id')):
+            rates[row['servertype_id']] = max(rates.get(row['servertype_id'], 0.0), row['events'] / float(hours))
+    build_times = {}
+    for servertype in ServerType.objects.all():
+        recent = SitePoolEvent.objects.filter(servertype=servertype, kind='built').values_list('id', flat=True)[
+            :getattr(settings, 'POOL_BUILD_SAMPLES', 10)]
+        build_times[servertype.id] = SitePoolEvent.objects.filter(id__in=list(recent)).aggregate(
+            build_time=Avg('duration'))['build_time']
+    return [PoolStatus(servertype, sites.get((servertype.id, True), 0),
+                       sites.get((servertype.id, False), 0) - stalled.get(servertype.id, 0),
+                       rates.get(servertype.id, 0.0), build_times[servertype.id], stalled.get(servertype.id, 0))
+            for servertype in ServerType.objects.order_by('order', 'id')]
+
+
+def capacity_budget(servertype, capacities):
+    """Number of new VMs of the server type that fit in the clusters, None if their capacity is not configured"""
+    capacities = [capacity for capacity in capacities if capacity.known]
+    if not capacities:
+        return None
+    requirements = servertype_requirements(servertype)
+    return sum(min(free // required if required else float('inf') for free, required in zip(capacity.free,
+                                                                                           requirements))
+               for capacity in capacities)
+
+
+def plan_builds(statuses, capacities):
+    """
+    Decides how many sites of each server type to build.
+
+    The concurrency budget is shared among the server types one site at a time, the most depleted pool first.
+
+    :return: dict ServerType id -> number of sites to build
+    """
+    budget = getattr(settings, 'POOL_MAX_CONCURRENT_BUILDS', 4) - sum(status.building for status in statuses)
+    deficits = dict((status.servertype.id, status.deficit) for status in statuses)
+    capacity = dict((status.servertype.id, capacity_budget(status.servertype, capacities)) for status in statuses)
+    planned = dict((status.servertype.id, 0) for status in statuses)
+    while budget > 0:
+        candidates = [status for status in statuses if deficits[status.servertype.id] > 0 and
+                      (capacity[status.servertype.id] is None or capacity[status.servertype.id] > 0)]
+        if not candidates:
+            break
+        status = min(candidates, key=lambda s: (float(s.available + s.building + planned[s.servertype.id]) / s.target,
+                                                s.servertype.order))
+        planned[status.servertype.id] += 1
+        deficits[status.servertype.id] -= 1
+        if capacity[status.servertype.id] is not None:
+            capacity[status.servertype.id] -= 1
+        budget -= 1
+    return dict((servertype_id, builds) for servertype_id, builds in planned.items() if builds)
+
+
+def replenish_pool():
+    """Starts building the preallocated sites needed to reach the target of each server type"""
+    from apimws.utils import preallocate_new_site
+    try:
+        with task_lock("site-pool", ttl=getattr(settings, 'POOL_LOCK_TTL', 300)):
+            statuses = pool_status()
+            planned = plan_builds(statuses, cluster_capacities())
+            for status in statuses:
+                for _ in range(planned.get(status.servertype.id, 0)):
+                    try:
+                        # The sites are created straight away and built asynchronously (see apimws.provisioning)
+                        preallocate_new_site(servertype=status.servertype)
+                    except NoCapacityAvailable as e:
+                        LOGGER.error("Cannot preallocate more sites of the server type %s: %s", status.servertype, e)
+                        break
+            return planned
+    except LockNotAcquired:
+        # Another pool manager is running, it will take into account the latest demand
+        return {}
@@ -0,0 +1,107 @@
+"""
+Execution of external commands (mostly userv services) from the panel and the celery workers.
+
+Unlike :py:func:`subprocess.check_output`, :py:func:`.run_command` reads the output of the command line by line as
+it is produced, keeping only the last lines in memory, copying every line to a log file as soon as it is received (so
+the progress of a long command can be followed in it), and killing the command if it does not finish in time.
+
+The command is started through ``setsid`` to run in its own process group, instead of calling os.setsid in the child
+with preexec_fn, which can deadlock in Python 2 when other threads are running (run_command is called from thread
+pools).
+
+"""
+import errno
+import logging
+import os
+import signal
+import subprocess
+import threading
+from collections import deque
+from distutils.spawn import find_executable
+from django.conf import settings
+
+
+LOGGER = logging.getLogger('mws')
+
+
+class CommandTimeout(subprocess.CalledProcessError):
+    """Raised when a command did not finish in time. The command has been killed and output contains the last lines
+    it wrote."""
+
+    def __init__(self, cmd, timeout, output):
+        super(CommandTimeout, self).__init__(-signal.SIGKILL, cmd, output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '%s' timed out after %s seconds" % (self.cmd, self.timeout)
+
+
+def run_command(cmd, timeout=None, log_path=None, max_lines=None):
+    """
+    Execute a command streaming its output (stdout and stderr merged).
+
+    :param cmd: the command to execute
+    :param timeout: seconds after which the command and all its children are killed, COMMAND_TIMEOUT by default.
+                    0 disables the timeout.
+    :param log_path: file where each line of output is appended as soon as it is received
+    :param max_lines: number of lines of output kept in memory, the last ones, COMMAND_OUTPUT_LINES by default.
+                      0 keeps the whole output, use it only for commands whose output needs to be parsed.
+    :return: the output of the command (or its last max_lines lines)
+    :raises CalledProcessError: if the command exits with a non zero status
+    :raises CommandTimeout: if the command did not finish in time
+    :raises OSError: if the command cannot be found
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'COMMAND_TIMEOUT', 3600)
+    if max_lines is None:
+        max_lines = getattr(settings, 'COMMAND_OUTPUT_LINES', 1000)
+
+    # setsid would report a missing command as a failure of the command
+    if not find_executable(cmd[0]):
+        raise OSError(errno.ENOENT, "Command not found: %s" % cmd[0])
+    # The command runs in its own process group so that a timeout also kills its children (e.g. ansible workers).
+    # setsid executes it in the same process, as the child is not a process group leader.
+    process = subprocess.Popen(["setsid"] + list(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               close_fds=True)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass  # Already finished
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    lines = deque(maxlen=max_lines or None)
+    log_file = open(log_path, 'a') if log_path else None
+    try:
+        for line in iter(process.stdout.readline, b''):
+            lines.append(line)
+            if log_file:
+                log_file.write(line)
+                log_file.flush()
+        returncode = process.wait()
+    except:
+        kill()
+        process.wait()
+        raise
+    finally:
+        if timer:
+            timer.cancel()
+        if log_file:
+            log_file.close()
+        process.stdout.close()
+
+    output = b''.join(lines)
+    if timed_out.is_set():
+        LOGGER.error("Command %s killed after %s seconds", cmd, timeout)
+        raise CommandTimeout(cmd, timeout, output)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd, output)
+    return output
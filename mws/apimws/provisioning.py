@@ -0,0 +1,73 @@
+"""
+Stages of the provisioning pipeline of the VMs.
+
+Creating a VM is split in independent celery tasks, chained with celery canvas primitives and started with
+apimws.xen.start_pipeline (see apimws.xen.new_site_primary_vm and apimws.xen.clone_vm_api_call), so that no worker is
+held during the whole sequence and the slow external calls (userv mws_pubkey, IPREG) of different stages run in
+parallel in different workers. The stages that publish the host keys of the site run next to the creation of the
+VM, off its critical path.
+
+Each stage is executed inside :py:func:`provisioning_stage`, which records its progress as a
+:py:class:`~apimws.models.ProvisioningStage` of the service and retries the stage with an exponential backoff when
+it fails with one of the errors the stage considers transient.
+
+"""
+import logging
+import subprocess
+from contextlib import contextmanager
+from celery import Task
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from apimws.models import ProvisioningStage
+
+
+LOGGER = logging.getLogger('mws')
+
+
+class ProvisioningTask(Task):
+    abstract = True
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        if isinstance(exc, subprocess.CalledProcessError):
+            LOGGER.error("A provisioning stage failed.\nThe task id is %s.\n\nThe parameters passed to the task were: "
+                         "%s\n\nThe traceback is:\n%s\n\nThe output from the command was: %s\n", task_id, args, einfo,
+                         exc.output)
+        else:
+            LOGGER.error("A provisioning stage failed.\nThe task id is %s.\n\nThe parameters passed to the task were: "
+                         "%s\n\nThe traceback is:\n%s\n", task_id, args, einfo)
+
+
+def retry_countdown(task):
+    """Seconds to wait before the next retry of the task, doubled after each retry"""
+    return getattr(settings, 'PROVISIONING_RETRY_DELAY', 10) * 2 ** task.request.retries
+
+
+@contextmanager
+def provisioning_stage(task, vm, stage, retry_on=()):
+    """
+    Records the progress of a stage of the provisioning of a VM executed by a celery task.
+
+    :param task: the task executing the stage, retried if the stage fails with one of the exceptions in retry_on
+    :param vm: the VM being provisioned
+    :param stage: name of the stage
+    :param retry_on: exceptions after which the stage can be safely executed again
+    """
+    record, created = ProvisioningStage.objects.get_or_create(
+        vm=vm, stage=stage, defaults={'service': vm.service, 'status': 'running', 'started': timezone.now()})
+    ProvisioningStage.objects.filter(pk=record.pk).update(status='running', attempts=F('attempts') + 1,
+                                                          finished=None)
+    try:
+        yield record
+    except retry_on as e:
+        if task.max_retries is not None and task.request.retries >= task.max_retries:
+            ProvisioningStage.objects.filter(pk=record.pk).update(status='failed', error=str(e),
+                                                                  finished=timezone.now())
+            raise
+        # Recorded before retrying because eager tasks (tests) are retried synchronously inside task.retry
+        ProvisioningStage.objects.filter(pk=record.pk).update(status='retrying', error=str(e))
+        raise task.retry(exc=e, countdown=retry_countdown(task))
+    except Exception as e:
+        ProvisioningStage.objects.filter(pk=record.pk).update(status='failed', error=str(e), finished=timezone.now())
+        raise
+    ProvisioningStage.objects.filter(pk=record.pk).update(status='done', error='', finished=timezone.now())
@@ -0,0 +1,90 @@
+"""
+Readiness probe of the VMs.
+
+After the OS installation or a power on the VM reboots, and ansible can only configure it once its SSH server
+answers. Instead of waiting a fixed time, :py:func:`wait_for_ssh` polls the SSH port of the VMs with an exponential
+backoff and launches the task given as callback as soon as all of them answer with an SSH banner.
+
+The VM notifies the end of the OS installation before rebooting, when the SSH server of the installer may still be
+answering, so in that case the SSH server of the VMs has to go down before it is waited for.
+
+"""
+import logging
+import socket
+from celery import shared_task, Task, signature
+from celery.exceptions import MaxRetriesExceededError
+from django.conf import settings
+
+
+LOGGER = logging.getLogger('mws')
+
+
+class ReadinessTaskWithFailure(Task):
+    abstract = True
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        LOGGER.error("An error happened when waiting for a VM to be ready.\nThe task id is %s.\n\n"
+                     "The parameters passed to the task were: %s\n\nThe traceback is:\n%s\n", task_id, args, einfo)
+
+
+def vm_address(vm):
+    """The address used to connect to the VM, the same that ansible uses (see apimws.inventory)"""
+    return vm.network_configuration.name or vm.network_configuration.IPv4 or vm.network_configuration.IPv6
+
+
+def ssh_ready(host, port=22, timeout=None):
+    """Returns whether an SSH server answers in the host"""
+    if timeout is None:
+        timeout = getattr(settings, 'SSH_PROBE_TIMEOUT', 5)
+    try:
+        connection = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    try:
+        return connection.recv(4).startswith(b'SSH-')
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        connection.close()
+
+
+def probe_countdown(retries):
+    """Seconds before the next probe, doubled after each probe up to SSH_PROBE_MAX_DELAY"""
+    return min(getattr(settings, 'SSH_PROBE_INITIAL_DELAY', 2) * 2 ** retries,
+               getattr(settings, 'SSH_PROBE_MAX_DELAY', 30))
+
+
+@shared_task(base=ReadinessTaskWithFailure)
+def wait_for_ssh(hosts, callback, rebooting=()):
+    """
+    Launches callback once the SSH server of all the hosts answers.
+
+    :param hosts: addresses of the VMs
+    :param callback: celery signature of the task to launch
+    :param rebooting: addresses of the VMs about to reboot, whose SSH server is only waited for after it goes down
+    """
+    rebooting = [host for host in rebooting if ssh_ready(host)]
+    waiting = rebooting + [host for host in hosts if host not in rebooting and not ssh_ready(host)]
+    if waiting:
+        # The reboot can be quick, so the VMs about to reboot are probed without backoff
+        countdown = probe_countdown(0 if rebooting else wait_for_ssh.request.retries)
+        try:
+            raise wait_for_ssh.retry(args=(hosts, callback, rebooting), countdown=countdown,
+                                     max_retries=getattr(settings, 'SSH_PROBE_MAX_RETRIES', 60))
+        except MaxRetriesExceededError:
+            # The task will probably fail, but it will report why
+            LOGGER.warning("The SSH server of %s did not %s after %d probes, launching %s anyway",
+                           ", ".join(waiting), "go down" if rebooting else "answer",
+                           wait_for_ssh.request.retries + 1, callback)
+    signature(callback).delay()
+
+
+def when_ready(service, callback, reboot=False):
+    """
+    Launches callback once the VMs of the service answer to SSH
+
+    :param reboot: whether the VMs are about to reboot, in which case their SSH server has to go down first
+    """
+    hosts = [vm_address(vm) for vm in service.virtual_machines.all()]
+    wait_for_ssh.apply_async((hosts, callback, hosts if reboot else []),
+                             countdown=getattr(settings, 'SSH_PROBE_INITIAL_DELAY', 2))
@@ -0,0 +1,212 @@
+"""
+Reconciliation of the VMs of the database with the guests of the Xen clusters.
+
+The power actions are requested to the VM API without waiting for them to be applied, so the database can drift
+from the state of the clusters: VMs deleted or never created in the cluster, guests left behind after a VM was
+deleted from the database, or VMs powered off that should be running (or the other way round).
+
+:py:func:`reconcile_fleet` asks each cluster for all its guests and their power state with a single ``list`` VM
+API request, the clusters in parallel, and compares them with the VMs of the database, loaded with a single query.
+The power state reported is stored in the VMs, the differences found are logged and, if the RECONCILIATION_REPAIR
+setting is enabled, the VMs with the wrong power state are powered on or off with a batch request per cluster (see
+apimws.xen.batch_vm_button). VMs missing in the cluster and unknown guests are only reported, they need someone to
+look at them.
+
+"""
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.utils import timezone
+from apimws.host_health import ordered_hosts
+from apimws.locks import task_lock, LockNotAcquired
+from apimws.models import Cluster
+from apimws.xen import vm_api_failover_request, record_attempts, batch_vm_button, VMAPIFailure
+from sitesmanagement.models import VirtualMachine
+
+
+LOGGER = logging.getLogger('mws')
+
+# Status of the services whose VMs have to exist in the cluster, the others are being installed
+INSTALLED_STATUSES = ('postinstall', 'ansible', 'ansible_queued', 'ready')
+
+# Power action that repairs each (expected, reported) power state drift
+REPAIR_ACTIONS = {
+    ('running', 'stopped'): 'poweron',
+    ('stopped', 'running'): 'poweroff',
+}
+
+
+class Drift(object):
+    """A difference between the database and a cluster"""
+
+    def __init__(self, kind, cluster, vmid, vm_id=None, expected=None, reported=None):
+        self.kind = kind  # 'missing' (VM not in the cluster), 'unknown' (guest not in the database) or 'power'
+        self.cluster = cluster
+        self.vmid = vmid
+        self.vm_id = vm_id
+        self.expected = expected
+        self.reported = reported
+
+    @property
+    def repair_action(self):
+        if self.kind != 'power':
+            return None
+        return REPAIR_ACTIONS.get((self.expected, self.reported))
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'cluster': self.cluster,
+            'vmid': self.vmid,
+            'vm': self.vm_id,
+            'expected': self.expected,
+            'reported': self.reported,
+        }
+
+    def __str__(self):
+        if self.kind == 'missing':
+            return "The VM %s is not in the cluster %s" % (self.vmid, self.cluster)
+        if self.kind == 'unknown':
+            return "The guest %s of the cluster %s is not in the database" % (self.vmid, self.cluster)
+        return "The VM %s of the cluster %s should be %s but it is %s" % (self.vmid, self.cluster, self.expected,
+                                                                         self.reported)
+
+
+def list_guests(hostnames):
+    """
+    Asks the VM API of a cluster for its guests. It does not access the database so that the clusters can be asked
+    in parallel.
+
+    :return: dict guest name -> power state (or the VMAPIFailure raised) and the attempts made to the hosts
+    """
+    response, attempts = vm_api_failover_request('list', None, hostnames)
+    if isinstance(response, Exception):
+        return response, attempts
+    try:
+        return dict((guest['vmid'], guest['state']) for guest in json.loads(response)), attempts
+    except (ValueError, KeyError, TypeError):
+        return VMAPIFailure("The list of guests is not properly formatted: %s" % response), attempts
+
+
+def cluster_guests(clusters):
+    """Returns dict Cluster name -> guests of the cluster (see list_guests), asking all the clusters at once"""
+    hosts = dict((cluster.pk, ordered_hosts(cluster)) for cluster in clusters)
+    if not hosts:
+        return {}
+    pool = ThreadPool(min(len(hosts), getattr(settings, 'VM_API_BATCH_MAX_HOSTS', 8)))
+    try:
+        responses = pool.map(lambda cluster_id: list_guests([host.hostname for host in hosts[cluster_id]]),
+                             list(hosts))
+    finally:
+        pool.close()
+        pool.join()
+    guests = {}
+    for cluster_id, (response, attempts) in zip(hosts, responses):
+        # The health of the hosts is updated from this thread, the one with access to the database
+        record_attempts(hosts[cluster_id], attempts)
+        guests[cluster_id] = response
+    return guests
+
+
+def expected_power_state(vm):
+    """The power state of a VM according to the database, from a row of fleet_vms"""
+    if vm['service__site__id'] is None or vm['service__site__disabled'] or vm['service__site__deleted'] or \
+            vm['service__site__end_date'] is not None:
+        # Disabled and cancelled sites are powered off (see Site.disable and Site.cancel)
+        return 'stopped'
+    return 'running'
+
+
+def fleet_vms():
+    """The VMs of the database with the fields needed to reconcile them, with a single query"""
+    return VirtualMachine.objects.exclude(name__isnull=True).exclude(name='').order_by('id').values(
+        'id', 'name', 'cluster_id', 'service__status', 'service__site__id', 'service__site__disabled',
+        'service__site__deleted', 'service__site__end_date')
+
+
+def diff_cluster(cluster, guests, vms):
+    """
+    Compares the guests of a cluster with its VMs in the database.
+
+    :param guests: dict guest name -> power state reported by the cluster
+    :param vms: rows of fleet_vms of the VMs of the cluster
+    :return: list of Drift
+    """
+    drifts = []
+    for vm in vms:
+        reported = guests.get(vm['name'])
+        if reported is None:
+            if vm['service__status'] in INSTALLED_STATUSES:
+                drifts.append(Drift('missing', cluster.name, vm['name'], vm['id']))
+            continue
+        if vm['service__status'] not in INSTALLED_STATUSES:
+            # The VM is being installed and rebooted
+            continue
+        expected = expected_power_state(vm)
+        if reported != expected:
+            drifts.append(Drift('power', cluster.name, vm['name'], vm['id'], expected, reported))
+    names = set(vm['name'] for vm in vms)
+    drifts.extend(Drift('unknown', cluster.name, name, reported=state)
+                  for name, state in sorted(guests.items()) if name not in names)
+    return drifts
+
+
+def record_power_states(guests, vms, now):
+    """Stores the power state reported for the VMs, with one update per power state"""
+    vm_ids = {}
+    for vm in vms:
+        vm_ids.setdefault(guests.get(vm['name'], 'missing'), []).append(vm['id'])
+    for state, ids in vm_ids.items():
+        VirtualMachine.objects.filter(pk__in=ids).update(power_state=state, power_state_checked=now)
+
+
+def repair(drifts):
+    """Requests the power actions that fix the power state drifts, a batch request per action"""
+    actions = {}
+    for drift in drifts:
+        if drift.repair_action:
+            actions.setdefault(drift.repair_action, []).append(drift.vm_id)
+    for action, vm_ids in actions.items():
+        LOGGER.info("Fleet reconciliation: requesting %s for the VMs %s", action, vm_ids)
+        batch_vm_button.delay(vm_ids, action)
+    return actions
+
+
+def reconcile_fleet(repair_drift=None):
+    """
+    Compares the VMs of the database with the guests of all the clusters.
+
+    :param repair_drift: whether to repair the power state drift, the RECONCILIATION_REPAIR setting by default
+    :return: dict with the clusters that could not be asked, the drifts found and the power actions requested
+    """
+    if repair_drift is None:
+        repair_drift = getattr(settings, 'RECONCILIATION_REPAIR', False)
+    try:
+        with task_lock("fleet-reconciliation", ttl=getattr(settings, 'RECONCILIATION_LOCK_TTL', 600)):
+            clusters = list(Cluster.objects.order_by('name'))
+            guests = cluster_guests(clusters)
+            vms = {}
+            for vm in fleet_vms():
+                vms.setdefault(vm['cluster_id'], []).append(vm)
+            now = timezone.now()
+            failed = {}
+            drifts = []
+            for cluster in clusters:
+                if isinstance(guests[cluster.pk], Exception):
+                    LOGGER.error("Fleet reconciliation: the guests of the cluster %s could not be listed: %s",
+                                 cluster.name, guests[cluster.pk])
+                    failed[cluster.name] = str(guests[cluster.pk])
+                    continue
+                record_power_states(guests[cluster.pk], vms.get(cluster.pk, []), now)
+                drifts.extend(diff_cluster(cluster, guests[cluster.pk], vms.get(cluster.pk, [])))
+            for drift in drifts:
+                LOGGER.warning("Fleet reconciliation: %s", drift)
+            return {
+                'failed': failed,
+                'drift': [drift.as_dict() for drift in drifts],
+                'repaired': repair(drifts) if repair_drift else {},
+            }
+    except LockNotAcquired:
+        # Another reconciliation is running
+        return None
@@ -0,0 +1,499 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import override_settings, RequestFactory, TestCase
+from django.utils import timezone
+from mock import mock
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from apimws.ansible_impl import launch_ansible, launch_ansible_async, run_on_vms, AnsibleHostsError, \
+    launch_ansible_batch, execute_playbook_on_vms, launch_ansible_by_user, services_by_user, run_ansible
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.models import PendingAnsibleRun, AnsibleRun
+from apimws.views import ansible_run_stats
+from mws.task_routing import BULK_PRIORITY, USER_PRIORITY
+from mwsauth.models import LookupGroupMember
+from sitesmanagement.cronjobs import refresh_lookup_group_members
+from sitesmanagement.models import Service, VirtualMachine, Site
+from ucamlookup.models import LookupGroup
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory',
+                   ANSIBLE_REVISION="r1")
+class AnsibleFingerprintTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(AnsibleFingerprintTests, self).setUp()
+        self.create_fleet(1)
+        self.vm = VirtualMachine.objects.get()
+
+    def launch(self, **kwargs):
+        service = Service.objects.get(id=self.vm.service_id)
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
+            launch_ansible(service, **kwargs)
+        self.assertEqual(Service.objects.get(id=service.id).status, 'ready')
+        return mock_run_ansible.call_count
+
+    def test_unchanged_configuration_is_skipped(self):
+        self.assertIsNone(self.vm.ansible_fingerprint)
+        self.assertEqual(self.launch(), 1)
+        fingerprint = VirtualMachine.objects.get(id=self.vm.id).ansible_fingerprint
+        self.assertIsNotNone(fingerprint)
+        self.assertEqual(self.launch(), 0)
+        self.assertEqual(self.launch(force=True), 1)
+        self.assertEqual(VirtualMachine.objects.get(id=self.vm.id).ansible_fingerprint, fingerprint)
+
+    def test_changed_configuration_is_applied(self):
+        self.assertEqual(self.launch(), 1)
+        fingerprint = VirtualMachine.objects.get(id=self.vm.id).ansible_fingerprint
+        self.vm.service.vhosts.first().domain_names.create(name="new.example", status='external')
+        self.assertEqual(self.launch(), 1)
+        self.assertNotEqual(VirtualMachine.objects.get(id=self.vm.id).ansible_fingerprint, fingerprint)
+        self.assertEqual(self.launch(), 0)
+
+    def test_new_playbooks_are_applied(self):
+        with override_settings(ANSIBLE_REVISION="r1"):
+            self.assertEqual(self.launch(), 1)
+            self.assertEqual(self.launch(), 0)
+        with override_settings(ANSIBLE_REVISION="r2"):
+            self.assertEqual(self.launch(), 1)
+            self.assertEqual(self.launch(), 0)
+
+    @override_settings(ANSIBLE_REVISION=None)
+    def test_unknown_playbooks_are_always_applied(self):
+        self.assertEqual(self.launch(), 1)
+        self.assertEqual(self.launch(), 1)
+        revision_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(revision_file.close)
+        with override_settings(ANSIBLE_REVISION_FILE=revision_file.name):
+            self.assertEqual(self.launch(), 1)
+            revision_file.write("r3\n")
+            revision_file.flush()
+            self.assertEqual(self.launch(), 1)
+            self.assertEqual(self.launch(), 0)
+
+    def test_failed_run_does_not_store_fingerprint(self):
+        service = Service.objects.get(id=self.vm.service_id)
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.side_effect = Exception("ansible failed")
+            with self.assertRaises(Exception):
+                launch_ansible(service)
+        self.assertIsNone(VirtualMachine.objects.get(id=self.vm.id).ansible_fingerprint)
+
+    def test_new_install_is_always_configured(self):
+        self.assertEqual(self.launch(), 1)
+        service = Service.objects.get(id=self.vm.service_id)
+        service.status = 'postinstall'
+        service.save()
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            launch_ansible_async(service, ignore_host_key=True)
+            mock_run_ansible.assert_called_once_with([
+                "userv", "--defvar", "ANSIBLE_HOST_KEY_CHECKING=False", "mws-admin", "mws_ansible_host",
+                self.vm.network_configuration.name
+            ])
+
+
+class RunOnVMsTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(RunOnVMsTests, self).setUp()
+        self.create_fleet(5)
+        self.vms = list(VirtualMachine.objects.order_by('id'))
+
+    @override_settings(ANSIBLE_MAX_PARALLEL_VMS=3)
+    def test_concurrency_is_capped(self):
+        lock = threading.Lock()
+        running = [0, 0]  # current, maximum
+
+        def run_ansible(cmd):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        succeeded = []
+        with mock.patch("apimws.ansible_impl.run_ansible", side_effect=run_ansible):
+            start = time.time()
+            run_on_vms(self.vms, lambda vm: ["true", vm.network_configuration.name], succeeded.append)
+        self.assertLess(time.time() - start, 0.05 * len(self.vms))
+        self.assertEqual(running[1], 3)
+        self.assertEqual(succeeded, self.vms)
+
+    def test_failures_are_reported_per_host(self):
+        failing = set(vm.network_configuration.name for vm in self.vms[1:3])
+
+        def run_ansible(cmd):
+            if cmd[1] in failing:
+                raise subprocess.CalledProcessError(2, cmd, "%s is unreachable" % cmd[1])
+
+        succeeded = []
+        with mock.patch("apimws.ansible_impl.run_ansible", side_effect=run_ansible):
+            with self.assertRaises(AnsibleHostsError) as cm:
+                run_on_vms(self.vms, lambda vm: ["false", vm.network_configuration.name], succeeded.append)
+        self.assertEqual(set(cm.exception.failures), failing)
+        self.assertEqual(succeeded, [self.vms[0]] + self.vms[3:])
+        for host in failing:
+            self.assertIn("%s is unreachable" % host, cm.exception.output)
+        self.assertTrue(isinstance(cm.exception, subprocess.CalledProcessError))
+
+    def test_service_status_is_reset_on_failure(self):
+        service = self.vms[0].service
+        service.status = 'ansible'
+        service.save()
+        exc = AnsibleHostsError({self.vms[0].network_configuration.name:
+                                 subprocess.CalledProcessError(1, "userv", "host unreachable")})
+        with mock.patch("apimws.ansible_impl.LOGGER") as mock_logger:
+            launch_ansible_async.on_failure(exc, "task-id", (service, ), {}, None)
+        self.assertIn("host unreachable", mock_logger.error.call_args[0][-1])
+        self.assertEqual(Service.objects.get(id=service.id).status, 'ready')
+
+    def test_output_is_streamed_to_host_log(self):
+        log_dir = os.path.join(tempfile.mkdtemp(), "ansible")
+        self.addCleanup(shutil.rmtree, os.path.dirname(log_dir))
+        host = self.vms[0].network_configuration.name
+        cmd = ["userv", "mws-admin", "mws_ansible_host", host]
+        with override_settings(ANSIBLE_LOG_DIR=log_dir), \
+                mock.patch("apimws.ansible_impl.run_command") as mock_run_command:
+            run_ansible(cmd)
+        mock_run_command.assert_called_once_with(cmd, timeout=3600, log_path=os.path.join(log_dir, "%s.log" % host))
+        self.assertTrue(os.path.isdir(log_dir))
+
+
+def play_recap(failed_hosts=(), ok_hosts=()):
+    lines = ["PLAY RECAP *********************************************************************"]
+    for host in ok_hosts:
+        lines.append("%s : ok=25   changed=0    unreachable=0    failed=0    skipped=3" % host)
+    for host in failed_hosts:
+        lines.append("%s : ok=12   changed=1    unreachable=0    failed=1    skipped=0" % host)
+    return "\n".join(lines)
+
+
+@override_settings(ANSIBLE_BATCH_WINDOW=5, ANSIBLE_REVISION="r1")
+class AnsibleBatchTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(AnsibleBatchTests, self).setUp()
+        self.create_fleet(3)
+        self.vms = list(VirtualMachine.objects.order_by('id'))
+        self.hosts = [vm.network_configuration.name for vm in self.vms]
+        for vm in self.vms:
+            launch_ansible(vm.service)
+
+    def test_requests_are_batched(self):
+        self.assertEqual(PendingAnsibleRun.objects.count(), 3)
+        self.assertEqual(set(Service.objects.filter(virtual_machines__isnull=False).values_list('status', flat=True)),
+                         {'ansible'})
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = play_recap(ok_hosts=self.hosts)
+            launch_ansible_batch()
+            mock_run_ansible.assert_called_once_with([
+                "userv", "mws-admin", "mws_ansible_hosts", "--limit", ":".join(self.hosts), "--forks", "10"
+            ])
+        self.assertFalse(PendingAnsibleRun.objects.exists())
+        for vm in VirtualMachine.objects.all():
+            self.assertEqual(vm.service.status, 'ready')
+            self.assertIsNotNone(vm.ansible_fingerprint)
+
+        # Nothing has changed, so the next batch does not run ansible
+        for vm in self.vms:
+            launch_ansible(Service.objects.get(id=vm.service_id))
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            launch_ansible_batch()
+            self.assertFalse(mock_run_ansible.called)
+
+    @override_settings(ANSIBLE_BATCH_SIZE=2)
+    def test_batch_size(self):
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = play_recap(ok_hosts=self.hosts)
+            launch_ansible_batch()
+        self.assertEqual([c[0][0][4] for c in mock_run_ansible.call_args_list],
+                         [":".join(self.hosts[:2]), self.hosts[2]])
+
+    def test_failures_are_mapped_to_services(self):
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.side_effect = subprocess.CalledProcessError(
+                2, "userv", play_recap(failed_hosts=self.hosts[1:2], ok_hosts=self.hosts[:1] + self.hosts[2:]))
+            with mock.patch("apimws.ansible_impl.LOGGER") as mock_logger:
+                launch_ansible_batch()
+                # The failed service is retried twice, like launch_ansible_async, and then released
+                self.assertEqual(list(PendingAnsibleRun.objects.values_list('service_id', 'attempts')),
+                                 [(self.vms[1].service_id, 1)])
+                self.assertEqual(Service.objects.get(id=self.vms[1].service_id).status, 'ansible')
+                self.assertFalse(mock_logger.error.called)
+                launch_ansible_batch()
+                launch_ansible_batch()
+        self.assertEqual(mock_run_ansible.call_count, 3)
+        self.assertEqual(mock_run_ansible.call_args[0][0][4], self.hosts[1])
+        self.assertFalse(PendingAnsibleRun.objects.exists())
+        self.assertEqual(mock_logger.error.call_count, 1)
+        self.assertIn(self.hosts[1], mock_logger.error.call_args[0][2])
+        fingerprints = [VirtualMachine.objects.get(id=vm.id).ansible_fingerprint for vm in self.vms]
+        self.assertIsNone(fingerprints[1])
+        self.assertIsNotNone(fingerprints[0])
+        self.assertIsNotNone(fingerprints[2])
+        self.assertEqual(set(Service.objects.filter(virtual_machines__isnull=False).values_list('status', flat=True)),
+                         {'ready'})
+
+    def test_errors_keep_the_queued_runs(self):
+        def run_ansible(cmd):
+            launch_ansible(Service.objects.get(id=self.vms[0].service_id))
+            raise OSError("userv not found")
+
+        with mock.patch("apimws.ansible_impl.run_ansible", side_effect=run_ansible):
+            with self.assertRaises(OSError):
+                launch_ansible_batch()
+        # The services are released, and the run requested in the meantime is queued
+        self.assertEqual(list(PendingAnsibleRun.objects.values_list('service_id', 'attempts')),
+                         [(self.vms[0].service_id, 0)])
+        self.assertEqual(Service.objects.get(id=self.vms[0].service_id).status, 'ansible')
+        self.assertEqual(Service.objects.get(id=self.vms[1].service_id).status, 'ready')
+
+    def test_single_scheduled_batch(self):
+        with mock.patch("apimws.ansible_impl.launch_ansible_batch.apply_async") as mock_apply_async, \
+                mock.patch("apimws.ansible_impl.transaction.on_commit", side_effect=lambda callback: callback()):
+            for vm in self.vms:
+                Service.objects.filter(id=vm.service_id).update(status='ready')
+                launch_ansible(Service.objects.get(id=vm.service_id))
+            self.assertEqual(mock_apply_async.call_count, 1)
+            token = mock_apply_async.call_args[0][0][0]
+            self.assertEqual(mock_apply_async.call_args[1], {'countdown': 5})
+            with mock.patch("apimws.ansible_impl.run_ansible", return_value=play_recap(ok_hosts=self.hosts)):
+                launch_ansible_batch(token)
+            # Once the batch has started, the next request schedules another one
+            launch_ansible(Service.objects.get(id=self.vms[0].service_id), force=True)
+            self.assertEqual(mock_apply_async.call_count, 2)
+
+    def test_queued_run_goes_to_next_batch(self):
+        def run_ansible(cmd):
+            launch_ansible(Service.objects.get(id=self.vms[0].service_id))
+            return play_recap(ok_hosts=self.hosts)
+
+        with mock.patch("apimws.ansible_impl.run_ansible", side_effect=run_ansible):
+            launch_ansible_batch()
+        self.assertEqual(list(PendingAnsibleRun.objects.values_list('service_id', flat=True)),
+                         [self.vms[0].service_id])
+        self.assertEqual(Service.objects.get(id=self.vms[0].service_id).status, 'ansible')
+        self.assertEqual(Service.objects.get(id=self.vms[1].service_id).status, 'ready')
+
+    def test_forced_request_goes_to_next_batch(self):
+        def run_ansible(cmd):
+            launch_ansible(Service.objects.get(id=self.vms[0].service_id), force=True)
+            launch_ansible(Service.objects.get(id=self.vms[0].service_id))
+            return play_recap(ok_hosts=self.hosts)
+
+        with mock.patch("apimws.ansible_impl.run_ansible", side_effect=run_ansible):
+            launch_ansible_batch()
+        self.assertEqual(list(PendingAnsibleRun.objects.values_list('service_id', 'force')),
+                         [(self.vms[0].service_id, True)])
+        self.assertFalse(Service.objects.get(id=self.vms[0].service_id).ansible_queued_force)
+        # The configuration has not changed, but the forced run is applied
+        with mock.patch("apimws.ansible_impl.run_ansible", return_value=play_recap(ok_hosts=self.hosts[:1])) \
+                as mock_run_ansible:
+            launch_ansible_batch()
+        self.assertEqual(mock_run_ansible.call_args[0][0][4], self.hosts[0])
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory',
+                   ANSIBLE_REVISION="r1")
+class AnsibleRunQueueTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(AnsibleRunQueueTests, self).setUp()
+        self.create_fleet(1)
+        self.service = VirtualMachine.objects.get().service
+
+    def test_stale_object_does_not_launch_twice(self):
+        stale = Service.objects.get(id=self.service.id)
+        with mock.patch("apimws.ansible_impl.launch_ansible_async") as mock_launch:
+            launch_ansible(self.service)
+            launch_ansible(stale)
+            launch_ansible(stale)
+        self.assertEqual(mock_launch.apply_async.call_count, 1)
+        self.assertEqual(mock_launch.apply_async.call_args[1], {'priority': USER_PRIORITY})
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ansible_queued')
+        self.assertEqual(stale.status, 'ansible_queued')
+
+    def test_forced_request_during_a_run(self):
+        def run_ansible(cmd):
+            # A forced request (e.g. a password change) arrives while ansible is running
+            if len(launches) == 0:
+                launch_ansible(Service.objects.get(id=self.service.id), force=True)
+                launch_ansible(Service.objects.get(id=self.service.id))
+            launches.append(cmd)
+
+        launches = []
+        Service.objects.filter(id=self.service.id).update(status='ansible')
+        with mock.patch("apimws.ansible_impl.run_ansible", side_effect=run_ansible), \
+                mock.patch("apimws.ansible_impl.launch_ansible_async.delay") as mock_delay:
+            launch_ansible_async(Service.objects.get(id=self.service.id))
+            mock_delay.assert_called_once_with(mock.ANY, force=True)
+            self.assertFalse(Service.objects.get(id=self.service.id).ansible_queued_force)
+            # The follow-up run is applied although the configuration has not changed
+            launch_ansible_async(*mock_delay.call_args[0], **mock_delay.call_args[1])
+        self.assertEqual(len(launches), 2)
+        self.assertEqual(mock_delay.call_count, 1)
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ready')
+
+    def test_bulk_runs_have_lower_priority(self):
+        with mock.patch("apimws.ansible_impl.launch_ansible_async") as mock_launch:
+            launch_ansible(self.service, bulk=True)
+        mock_launch.apply_async.assert_called_once_with((self.service, ), {'force': False}, priority=BULK_PRIORITY)
+
+    def test_queued_run_is_a_new_task(self):
+        launches = []
+
+        def run_ansible(cmd):
+            if not launches:
+                # Two more requests arrive while ansible is running, they are coalesced in one follow-up run
+                launch_ansible(Service.objects.get(id=self.service.id))
+                launch_ansible(Service.objects.get(id=self.service.id))
+            launches.append(cmd)
+
+        with mock.patch("apimws.ansible_impl.run_ansible", side_effect=run_ansible):
+            with mock.patch("apimws.ansible_impl.launch_ansible_async.apply_async") as mock_apply_async, \
+                    mock.patch("apimws.ansible_impl.launch_ansible_async.delay") as mock_delay:
+                launch_ansible(self.service, force=True)
+                service = mock_apply_async.call_args[0][0][0]
+                self.assertEqual(service.status, 'ansible')
+                launch_ansible_async(service, force=True)
+                self.assertEqual(len(launches), 1)
+                self.assertEqual(Service.objects.get(id=self.service.id).status, 'ansible')
+                self.assertEqual(mock_delay.call_count, 1)
+                launch_ansible_async(*mock_delay.call_args[0], force=True)
+        self.assertEqual(len(launches), 2)
+        self.assertEqual(mock_apply_async.call_count, 1)
+        self.assertEqual(mock_delay.call_count, 1)
+        self.assertEqual(Service.objects.get(id=self.service.id).status, 'ready')
+
+
+class AnsibleRunTelemetryTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(AnsibleRunTelemetryTests, self).setUp()
+        self.create_fleet(2)
+        self.vms = list(VirtualMachine.objects.order_by('id'))
+
+    def test_runs_are_recorded(self):
+        def run_ansible(cmd):
+            if cmd[3] == self.vms[1].network_configuration.name:
+                raise subprocess.CalledProcessError(4, cmd, "x" * 100 + "unreachable")
+            return "ok"
+
+        with mock.patch("apimws.ansible_impl.run_ansible", side_effect=run_ansible):
+            with override_settings(ANSIBLE_RUN_OUTPUT_LIMIT=50):
+                with self.assertRaises(AnsibleHostsError):
+                    execute_playbook_on_vms(self.vms[0].service, ["--tags", "restore_snapshot"])
+                    execute_playbook_on_vms(self.vms[1].service, ["--tags", "restore_snapshot"])
+                execute_playbook_on_vms(self.vms[0].service, ["--tags", "restore_snapshot"])
+        runs = list(AnsibleRun.objects.order_by('id'))
+        self.assertEqual([(run.host, run.command, run.tags, run.exit_code) for run in runs], [
+            (self.vms[0].network_configuration.name, "mws_ansible_host_d", "restore_snapshot", 0),
+            (self.vms[1].network_configuration.name, "mws_ansible_host_d", "restore_snapshot", 4),
+            (self.vms[0].network_configuration.name, "mws_ansible_host_d", "restore_snapshot", 0),
+        ])
+        self.assertEqual(runs[0].output, "ok")
+        self.assertEqual(len(runs[1].output), 50)
+        self.assertTrue(runs[1].output.endswith("unreachable"))
+        self.assertGreaterEqual(runs[0].duration, 0)
+        self.assertEqual(runs[0].duration, (runs[0].finished - runs[0].started).total_seconds())
+
+    def test_stats(self):
+        now = timezone.now()
+        for i in range(1, 101):
+            AnsibleRun.objects.create(host="slow.example" if i > 90 else "fast.example", command="mws_ansible_host",
+                                      tags="", started=now, finished=now, duration=i, exit_code=0)
+        AnsibleRun.objects.create(host="old.example", command="mws_ansible_host_d", tags="restore_snapshot",
+                                  started=now - timedelta(days=30), finished=now, duration=1000, exit_code=0)
+        with mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Admin"):
+            user = User.objects.create(username="admin0001")
+
+        def get(**params):
+            request = RequestFactory().get(reverse('apimws.views.ansible_run_stats'), params)
+            request.user = user
+            return ansible_run_stats(request)
+
+        self.assertEqual(get().status_code, 302)
+        user.is_superuser = True
+        stats = json.loads(get().content)
+        self.assertEqual(stats['tags'], {'all': {'count': 100, 'p50': 50, 'p95': 95, 'p99': 99, 'max': 100}})
+        self.assertEqual(stats['hosts']['slow.example'], {'count': 10, 'p50': 95, 'p95': 100, 'p99': 100,
+                                                          'max': 100})
+        self.assertEqual(stats['hosts']['fast.example']['p99'], 90)
+        self.assertNotIn('old.example', stats['hosts'])
+        self.assertIn('restore_snapshot', json.loads(get(days=60).content)['tags'])
+
+
+class ServicesByUserTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(ServicesByUserTests, self).setUp()
+        self.create_fleet(6)
+        self.sites = list(Site.objects.order_by('id'))
+        self.user = User.objects.get(username="bench0000")
+        self.group = self.create_group("101888")
+
+    def create_group(self, lookup_id):
+        with mock.patch("ucamlookup.signals.return_title_by_groupid", return_value="Bench group"):
+            return LookupGroup.objects.create(lookup_id=lookup_id)
+
+    def services(self, user=None):
+        with mock.patch("mwsauth.utils.get_users_of_a_group") as mock_get_users:
+            with CaptureQueriesContext(connection) as queries:
+                services = list(services_by_user(user or self.user))
+        # Lookup is never queried and the services are found with a single query
+        self.assertFalse(mock_get_users.called)
+        self.assertEqual(len(queries), 1)
+        return services
+
+    def test_all_relations(self):
+        self.sites[1].ssh_users.add(self.user)
+        self.sites[2].supporters.add(self.user)
+        self.sites[3].groups.add(self.group)
+        self.sites[4].ssh_groups.add(self.group)
+        LookupGroupMember.objects.create(group=self.group, user=self.user)
+        # Only production services have virtual machines
+        self.assertEqual(self.services(), [site.production_service for site in self.sites[:5]])
+
+    def test_cancelled_sites_and_inactive_users(self):
+        self.sites[1].users.add(self.user)
+        self.sites[1].end_date = self.sites[1].start_date
+        self.sites[1].save()
+        self.assertEqual(self.services(), [self.sites[0].production_service])
+        self.user.is_active = False
+        with mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Bench User"):
+            self.user.save()
+        self.assertEqual(list(services_by_user(self.user)), [])
+
+    def test_refresh_lookup_group_members(self):
+        self.sites[3].groups.add(self.group)
+        unused_group = self.create_group("101923")
+        LookupGroupMember.objects.create(group=unused_group, user=self.user)
+        LookupGroupMember.objects.create(group=self.group, user=User.objects.get(username="bench0001"))
+        with mock.patch("mwsauth.utils.get_users_of_a_group", return_value=[self.user]) as mock_get_users:
+            refresh_lookup_group_members()
+        mock_get_users.assert_called_once_with(self.group)
+        self.assertEqual(list(LookupGroupMember.objects.values_list('group__lookup_id', 'user__username')),
+                         [("101888", "bench0000")])
+        self.assertIn(self.sites[3].production_service, self.services())
+
+    def test_launch_only_affected_services(self):
+        self.sites[2].ssh_users.add(self.user)
+        with mock.patch("apimws.ansible_impl.launch_ansible") as mock_launch_ansible:
+            launch_ansible_by_user(self.user)
+        self.assertEqual([c[0][0] for c in mock_launch_ansible.call_args_list],
+                         [self.sites[0].production_service, self.sites[2].production_service])
+
+    def test_password_change_forces_the_runs(self):
+        with mock.patch("apimws.ansible_impl.launch_ansible") as mock_launch_ansible:
+            call_command('user_changed_password', self.user.username)
+        self.assertEqual([c[1] for c in mock_launch_ansible.call_args_list], [{'force': True}])
@@ -0,0 +1,98 @@
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mock import mock
+from apimws.host_health import ordered_hosts, record_success, record_failure, circuit_open
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.models import Cluster, Host
+from apimws.xen import vm_api_request, vm_api_batch, VMAPIFailure, VMAPIHostUnavailable, VMAPIHostTimeout
+from sitesmanagement.models import VirtualMachine
+
+
+@override_settings(VM_API_BREAKER_THRESHOLD=2, VM_API_BREAKER_COOLDOWN=60)
+class HostHealthTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(HostHealthTests, self).setUp()
+        self.create_fleet(2)
+        self.cluster = Cluster.objects.get(name="mws-bench-1")
+        self.host1 = Host.objects.get(hostname="mws-bench-1.dev.mws3.cam.ac.uk")
+        self.host2 = Host.objects.create(hostname="mws-bench-1b.dev.mws3.cam.ac.uk", cluster=self.cluster)
+        self.vm = VirtualMachine.objects.get(name="bench_vm0000")
+
+    def test_breaker(self):
+        record_failure(self.host1)
+        self.assertFalse(circuit_open(Host.objects.get(pk=self.host1.pk)))
+        record_failure(self.host1)
+        host = Host.objects.get(pk=self.host1.pk)
+        self.assertTrue(circuit_open(host))
+        self.assertEqual((host.requests, host.failures, host.consecutive_failures), (2, 2, 2))
+        self.assertFalse(circuit_open(host, now=timezone.now() + timedelta(seconds=61)))
+        record_success(host, 0.5)
+        host = Host.objects.get(pk=self.host1.pk)
+        self.assertFalse(circuit_open(host))
+        self.assertEqual((host.requests, host.failures, host.consecutive_failures), (3, 2, 0))
+        self.assertEqual(host.latency, 0.5)
+        self.assertTrue(0 < host.error_rate < 1)
+
+    def test_concurrent_updates(self):
+        # Each worker records the result of its request on its own copy of the host, loaded before the others
+        # recorded theirs
+        stale = [Host.objects.get(pk=self.host1.pk) for _ in range(3)]
+        record_success(stale[0], 1.0)
+        record_failure(stale[1])
+        record_failure(stale[2])
+        host = Host.objects.get(pk=self.host1.pk)
+        self.assertEqual((host.requests, host.failures, host.consecutive_failures), (3, 2, 2))
+        self.assertTrue(circuit_open(host))
+        self.assertEqual(host.latency, 1.0)
+        self.assertAlmostEqual(host.error_rate, 0.3 + 0.7 * 0.3)
+        # The copy is refreshed with the recorded health
+        self.assertEqual(stale[2].consecutive_failures, 2)
+
+    def test_ordered_hosts(self):
+        Host.objects.filter(pk=self.host1.pk).update(latency=2.0)
+        Host.objects.filter(pk=self.host2.pk).update(latency=0.1)
+        # With two healthy hosts both are always sampled and the fastest goes first
+        self.assertEqual([host.hostname for host in ordered_hosts(self.cluster)],
+                         [self.host2.hostname, self.host1.hostname])
+        Host.objects.filter(pk=self.host2.pk).update(circuit_open_until=timezone.now() + timedelta(seconds=60))
+        self.assertEqual([host.hostname for host in ordered_hosts(self.cluster)],
+                         [self.host1.hostname, self.host2.hostname])
+
+    def failover_to(self, exception, hostname):
+        def host_request(command, parameters, host):
+            if host != hostname:
+                raise exception
+            return "output from %s" % host
+        return host_request
+
+    def test_failover_when_host_unavailable(self):
+        Host.objects.filter(pk=self.host2.pk).update(circuit_open_until=timezone.now() + timedelta(seconds=60))
+        with mock.patch("apimws.xen.vm_api_host_request",
+                        side_effect=self.failover_to(VMAPIHostUnavailable(), self.host2.hostname)) as mock_request:
+            self.assertEqual(vm_api_request('button', {'action': 'reboot', 'vmid': self.vm.name}, self.vm),
+                             "output from %s" % self.host2.hostname)
+        self.assertEqual([c[0][2] for c in mock_request.call_args_list], [self.host1.hostname, self.host2.hostname])
+        self.assertEqual(Host.objects.get(pk=self.host1.pk).failures, 1)
+        host2 = Host.objects.get(pk=self.host2.pk)
+        self.assertEqual((host2.requests, host2.failures), (1, 0))
+        self.assertIsNone(host2.circuit_open_until)
+
+    def test_no_failover_after_timeout_or_command_failure(self):
+        Host.objects.filter(pk=self.host2.pk).update(circuit_open_until=timezone.now() + timedelta(seconds=60))
+        for exception, failures in ((VMAPIHostTimeout(), 1), (VMAPIFailure(), 1)):
+            with mock.patch("apimws.xen.vm_api_host_request",
+                            side_effect=self.failover_to(exception, self.host2.hostname)) as mock_request:
+                with self.assertRaises(exception.__class__):
+                    vm_api_request('delete', {'vmid': self.vm.name}, self.vm)
+            self.assertEqual(mock_request.call_count, 1)
+            # A command that failed is not a failure of the host
+            self.assertEqual(Host.objects.get(pk=self.host1.pk).failures, failures)
+
+    def test_all_hosts_unavailable(self):
+        with mock.patch("apimws.xen.vm_api_host_request", side_effect=VMAPIHostUnavailable()) as mock_request:
+            results = vm_api_batch([(self.vm, 'delete', {'vmid': self.vm.name})])
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertTrue(isinstance(results[0], VMAPIHostUnavailable))
+        self.assertEqual([host.consecutive_failures for host in Host.objects.order_by('hostname')], [1, 1])
@@ -0,0 +1,215 @@
+import json
+import subprocess
+import mock
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from apimws.ipreg import IPRegBatch, IPRegFailure, PendingBatch, ip_reg_batch_call, ip_reg_batch_on_commit, \
+    get_nameinfo, nameinfo_cache_ttl, set_cname, delete_cname
+from apimws.management.test_ansible_inventory import FleetMixin
+from sitesmanagement.models import Site, SiteKey, DomainName
+
+
+def send_pending_batches():
+    """Sends the IPREG batches waiting for the test transaction to be committed, which never happens in a TestCase"""
+    for _, callback in connection.run_on_commit:
+        if isinstance(callback, PendingBatch):
+            callback()
+
+
+def ipreg_process(responses, returncode=0):
+    process = mock.Mock(returncode=returncode)
+    process.communicate.return_value = (json.dumps(responses), '')
+    return mock.patch("apimws.ipreg.subprocess.Popen", return_value=process)
+
+
+@override_settings(IP_REG_API_END_POINT=['userv', 'mws-admin', 'mws_ipreg', 'live'], IP_REG_BATCH=True)
+class IPRegBatchTests(TestCase):
+
+    def test_batch_call(self):
+        batch = IPRegBatch()
+        batch.set_sshfp("mws-bench.example", 1, 2, "AB12")
+        batch.delete_cname("www.example.cam.ac.uk")
+        with ipreg_process([{"result": {}}, {"error": "Not found", "code": 4}]) as popen:
+            results = ip_reg_batch_call(batch.calls)
+        # A single invocation of the API with all the calls
+        popen.assert_called_once_with(['userv', 'mws-admin', 'mws_ipreg', 'live', 'batch'], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(json.loads(popen.return_value.communicate.call_args[0][0]),
+                         [['put', 'sshfp', 'mws-bench.example', '1', '2', 'AB12'],
+                          ['delete', 'cname', 'www.example.cam.ac.uk']])
+        self.assertEqual(results[0], {})
+        self.assertIsInstance(results[1], IPRegFailure)
+        self.assertEqual((results[1].call, results[1].code), (['delete', 'cname', 'www.example.cam.ac.uk'], 4))
+
+        # execute raises if any of the calls failed
+        with ipreg_process([{"result": {}}, {"error": "Not found", "code": 4}]):
+            with self.assertRaises(IPRegFailure) as failure:
+                batch.execute()
+        self.assertEqual(failure.exception.code, 4)
+        self.assertEqual(failure.exception.results[0], {})
+
+    def test_malformed_responses(self):
+        with ipreg_process([{"result": {}}]):
+            with self.assertRaises(ValueError):
+                ip_reg_batch_call([['delete', 'cname', 'a.example'], ['delete', 'cname', 'b.example']])
+        with mock.patch("apimws.ipreg.subprocess.Popen") as popen:
+            self.assertEqual(ip_reg_batch_call([]), [])
+        self.assertFalse(popen.called)
+
+    def test_rejected_batch_call(self):
+        # The calls are sent one by one if the API does not accept the batch call
+        with ipreg_process({"message": "unknown call"}, returncode=1), \
+                mock.patch("apimws.ipreg.ip_reg_call", side_effect=[
+                    {}, subprocess.CalledProcessError(4, 'mws_ipreg', '{"message": "Not found"}')]) as ip_reg_call:
+            results = ip_reg_batch_call([['put', 'cname', 'a.example', 'b.example'], ['delete', 'cname', 'c.example']])
+        self.assertEqual(ip_reg_call.call_args_list, [mock.call(['put', 'cname', 'a.example', 'b.example']),
+                                                      mock.call(['delete', 'cname', 'c.example'])])
+        self.assertEqual(results[0], {})
+        self.assertEqual((results[1].call, results[1].code), (['delete', 'cname', 'c.example'], 4))
+
+    @override_settings(IP_REG_BATCH=False)
+    def test_batch_call_disabled(self):
+        batch = IPRegBatch()
+        batch.set_sshfp("mws-bench.example", 1, 2, "AB12")
+        batch.delete_cname("www.example.cam.ac.uk")
+        with mock.patch("apimws.ipreg.subprocess.Popen") as popen, \
+                mock.patch("apimws.ipreg.ip_reg_call", return_value={}) as ip_reg_call:
+            self.assertEqual(batch.execute(), [{}, {}])
+        self.assertFalse(popen.called)
+        self.assertEqual(ip_reg_call.call_args_list,
+                         [mock.call(['put', 'sshfp', 'mws-bench.example', '1', '2', 'AB12']),
+                          mock.call(['delete', 'cname', 'www.example.cam.ac.uk'])])
+        with mock.patch("apimws.ipreg.ip_reg_call", side_effect=OSError()):
+            with self.assertRaises(OSError):
+                batch.execute()
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
+class IPRegTeardownTests(FleetMixin, TestCase):
+
+    def test_site_deletion_is_a_single_batch(self):
+        self.create_fleet(2)
+        site = Site.objects.get(name="benchSite0000")
+        for keytype in SiteKey.ALGORITHMS:
+            SiteKey.objects.create(site=site, type=keytype, public_key="ssh-%s KEY" % keytype.lower())
+        DomainName.objects.filter(name="bench0000.example").update(status='accepted')
+
+        with mock.patch("apimws.ipreg.ip_reg_batch_call", return_value=[]) as ip_reg_batch_call, \
+                mock.patch("apimws.xen.vm_api_request"):
+            site.delete()
+            self.assertFalse(ip_reg_batch_call.called)
+            send_pending_batches()
+        self.assertEqual(ip_reg_batch_call.call_count, 1)
+        calls = ip_reg_batch_call.call_args[0][0]
+        # The SHA1 and SHA256 records of every key, for both services and the VM, and the accepted CNAME
+        self.assertEqual(len(calls), len(SiteKey.ALGORITHMS) * len(SiteKey.FP_TYPES) * 3 + 1)
+        self.assertEqual(set(call[2] for call in calls if call[1] == 'sshfp'),
+                         {"mws-bench-0000.mws3.example", "mws-bench-0000.mws3.private.example",
+                          "mws-bench-client0000.example"})
+        self.assertIn(['delete', 'cname', "bench0000.example"], calls)
+
+    def test_rolled_back_changes_are_not_sent(self):
+        self.create_fleet(2)
+        DomainName.objects.filter(name__in=["bench0000.example", "bench0001.example"]).update(status='accepted')
+        try:
+            with transaction.atomic():
+                DomainName.objects.get(name="bench0000.example").delete()
+                raise ValueError()
+        except ValueError:
+            pass
+        DomainName.objects.get(name="bench0001.example").delete()
+        with mock.patch("apimws.ipreg.ip_reg_batch_call", return_value=[]) as ip_reg_batch_call:
+            send_pending_batches()
+        ip_reg_batch_call.assert_called_once_with([['delete', 'cname', "bench0001.example"]])
+
+    def test_outside_transactions_changes_are_sent_straight_away(self):
+        batch = IPRegBatch()
+        batch.delete_cname("bench0000.example")
+        with mock.patch("apimws.ipreg.transaction.get_connection") as get_connection, \
+                mock.patch("apimws.ipreg.ip_reg_batch_call", return_value=[]) as ip_reg_batch_call:
+            get_connection.return_value.in_atomic_block = False
+            ip_reg_batch_on_commit(batch)
+        ip_reg_batch_call.assert_called_once_with([['delete', 'cname', "bench0000.example"]])
+
+
+NAMEINFO = {"hostname": "www.example.cam.ac.uk", "exists": [], "emails": ["admin@example.cam.ac.uk"], "crsids": [],
+            "delegated": "N", "domain": "example.cam.ac.uk"}
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'ipreg-nameinfo-tests'}},
+                   IPREG_NAMEINFO_CACHE_TTL=300, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
+class NameinfoCacheTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_nameinfo_is_cached(self):
+        with mock.patch("apimws.ipreg.ip_reg_call", return_value=NAMEINFO) as ip_reg_call:
+            self.assertEqual(get_nameinfo("www.example.cam.ac.uk"), NAMEINFO)
+            self.assertEqual(get_nameinfo("WWW.example.cam.ac.uk"), NAMEINFO)
+            # Changes outside the zone of the hostname keep it
+            set_cname("www.other.cam.ac.uk", "mws-bench.mws3.example")
+            delete_cname("www.example.ox.ac.uk")
+            get_nameinfo("www.example.cam.ac.uk")
+        self.assertEqual(ip_reg_call.call_args_list,
+                         [mock.call(['get', 'nameinfo', "www.example.cam.ac.uk"]),
+                          mock.call(['put', 'cname', "www.other.cam.ac.uk", "mws-bench.mws3.example"]),
+                          mock.call(['delete', 'cname', "www.example.ox.ac.uk"])])
+
+    def test_cname_changes_invalidate_the_zone(self):
+        with mock.patch("apimws.ipreg.ip_reg_call", return_value=NAMEINFO) as ip_reg_call:
+            get_nameinfo("www.example.cam.ac.uk")
+            set_cname("new.example.cam.ac.uk", "mws-bench.mws3.example")
+            get_nameinfo("www.example.cam.ac.uk")
+            delete_cname("www.example.cam.ac.uk")
+            get_nameinfo("www.example.cam.ac.uk")
+        self.assertEqual(len([c for c in ip_reg_call.call_args_list if c[0][0][1] == 'nameinfo']), 3)
+
+        # Changes sent in a batch, even a failed one, invalidate it too
+        batch = IPRegBatch()
+        batch.delete_cname("old.example.cam.ac.uk")
+        with mock.patch("apimws.ipreg.ip_reg_call", side_effect=subprocess.CalledProcessError(4, 'mws_ipreg', '')):
+            ip_reg_batch_call(batch.calls)
+        with mock.patch("apimws.ipreg.ip_reg_call", return_value=NAMEINFO) as ip_reg_call:
+            get_nameinfo("www.example.cam.ac.uk")
+        self.assertEqual(ip_reg_call.call_count, 1)
+
+    def test_failed_calls_are_not_cached(self):
+        with mock.patch("apimws.ipreg.ip_reg_call",
+                        side_effect=[subprocess.CalledProcessError(1, 'mws_ipreg'), NAMEINFO]) as ip_reg_call:
+            with self.assertRaises(subprocess.CalledProcessError):
+                get_nameinfo("www.example.cam.ac.uk")
+            self.assertEqual(get_nameinfo("www.example.cam.ac.uk"), NAMEINFO)
+        self.assertEqual(ip_reg_call.call_count, 2)
+
+    @override_settings(IPREG_NAMEINFO_CACHE_TTL=0)
+    def test_cache_disabled(self):
+        with mock.patch("apimws.ipreg.ip_reg_call", return_value=NAMEINFO) as ip_reg_call:
+            get_nameinfo("www.example.cam.ac.uk")
+            get_nameinfo("www.example.cam.ac.uk")
+        self.assertEqual(ip_reg_call.call_count, 2)
+
+    @override_settings(IPREG_NAMEINFO_CACHE_TTL=None)
+    def test_cache_disabled_unless_shared(self):
+        # The local memory cache of each process would not see the invalidations made by the celery workers
+        self.assertEqual(nameinfo_cache_ttl(), 0)
+        with mock.patch("apimws.ipreg.ip_reg_call", return_value=NAMEINFO) as ip_reg_call:
+            get_nameinfo("www.example.cam.ac.uk")
+            get_nameinfo("www.example.cam.ac.uk")
+        self.assertEqual(ip_reg_call.call_count, 2)
+
+    @override_settings(IPREG_NAMEINFO_CACHE_TTL=None, CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'mws_cache'}})
+    def test_shared_database_cache(self):
+        # The cache configured in the production settings, whose table is created by the migrations
+        call_command('createcachetable')
+        self.assertEqual(nameinfo_cache_ttl(), 300)
+        with mock.patch("apimws.ipreg.ip_reg_call", return_value=NAMEINFO) as ip_reg_call:
+            get_nameinfo("www.example.cam.ac.uk")
+            get_nameinfo("www.example.cam.ac.uk")
+            delete_cname("old.example.cam.ac.uk")
+            get_nameinfo("www.example.cam.ac.uk")
+        self.assertEqual(len([c for c in ip_reg_call.call_args_list if c[0][0][1] == 'nameinfo']), 2)
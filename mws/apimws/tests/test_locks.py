@@ -0,0 +1,76 @@
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mock import patch
+from apimws.locks import acquire_lock, release_lock, task_lock, LockNotAcquired
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.models import TaskLock
+from apimws.xen import change_vm_power_state, reset_vm
+from sitesmanagement.models import VirtualMachine
+
+
+class TaskLockTests(TestCase):
+
+    def test_lock_is_exclusive(self):
+        token = acquire_lock("vm-1-reboot")
+        self.assertIsNotNone(token)
+        self.assertIsNone(acquire_lock("vm-1-reboot"))
+        # Other keys are independent
+        self.assertIsNotNone(acquire_lock("vm-1-poweron"))
+        release_lock("vm-1-reboot", token)
+        self.assertIsNotNone(acquire_lock("vm-1-reboot"))
+
+    def test_expired_lock(self):
+        token = acquire_lock("vm-1-reboot", ttl=60)
+        TaskLock.objects.update(expires=timezone.now() - timedelta(seconds=1))
+        new_token = acquire_lock("vm-1-reboot", ttl=60)
+        self.assertIsNotNone(new_token)
+        # The owner of the expired lock does not release the new one
+        release_lock("vm-1-reboot", token)
+        self.assertEqual(TaskLock.objects.get(key="vm-1-reboot").token, new_token)
+
+    def test_context_manager(self):
+        with task_lock("vm-1-reboot"):
+            with self.assertRaises(LockNotAcquired):
+                with task_lock("vm-1-reboot"):
+                    pass
+        self.assertFalse(TaskLock.objects.exists())
+        with self.assertRaises(ValueError):
+            with task_lock("vm-1-reboot"):
+                raise ValueError()
+        self.assertFalse(TaskLock.objects.exists())
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory',
+                   VM_LOCK_MAX_RETRIES=2)
+class VMActionLockTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(VMActionLockTests, self).setUp()
+        self.create_fleet(1)
+        self.vm = VirtualMachine.objects.get()
+
+    def test_concurrent_requests_are_retried(self):
+        token = acquire_lock("vm-%d-reboot" % self.vm.id)
+        with patch("apimws.xen.vm_api_request") as mock_vm_api_request:
+            # The first reset is in flight, the second one is retried until it gives up
+            with self.assertRaises(LockNotAcquired):
+                reset_vm.delay(self.vm.id)
+            self.assertFalse(mock_vm_api_request.called)
+            # Other actions are not blocked
+            self.assertTrue(change_vm_power_state.delay(self.vm.id, "on").get())
+            self.assertEqual(mock_vm_api_request.call_count, 1)
+            release_lock("vm-%d-reboot" % self.vm.id, token)
+            self.assertTrue(reset_vm.delay(self.vm.id).get())
+            self.assertEqual(mock_vm_api_request.call_count, 2)
+        self.assertFalse(TaskLock.objects.exists())
+
+    @override_settings(VM_LOCK_MAX_RETRIES=None, VM_API_TIMEOUT=900, VM_LOCK_RETRY_DELAY=5)
+    def test_retries_outlast_the_lock(self):
+        acquire_lock("vm-%d-reboot" % self.vm.id)
+        with patch("apimws.xen.vm_api_request"), patch("apimws.xen.reset_vm.retry",
+                                                       side_effect=LockNotAcquired) as mock_retry:
+            with self.assertRaises(LockNotAcquired):
+                reset_vm.delay(self.vm.id)
+        # The request in flight times out after 900s, the lock expires with it
+        self.assertGreater(mock_retry.call_args[1]['countdown'] * mock_retry.call_args[1]['max_retries'], 900)
@@ -0,0 +1,90 @@
+import json
+from django.contrib.auth.models import User
+from django.test import TestCase, SimpleTestCase, RequestFactory
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.models import Cluster, Host
+from apimws.placement import Resources, ClusterCapacity, choose_cluster, cluster_capacities, place_vm, \
+    NoCapacityAvailable, site_requirements
+from apimws.views import cluster_capacity
+from apimws.utils import preallocate_new_site
+from apimws.xen import clone_vm_api_call, which_cluster
+from sitesmanagement.models import VirtualMachine, Site, NetworkConfig
+
+
+class PlacementPolicyTests(SimpleTestCase):
+    """Placement with synthetic clusters"""
+
+    def setUp(self):
+        self.capacities = [
+            ClusterCapacity(Cluster(name="a"), Resources(64, 256, 4000), Resources(60, 100, 1000)),
+            ClusterCapacity(Cluster(name="b"), Resources(64, 256, 4000), Resources(8, 32, 400)),
+            ClusterCapacity(Cluster(name="c"), Resources(32, 128, 2000), Resources(16, 96, 1000)),
+        ]
+
+    def test_least_loaded(self):
+        self.assertEqual(choose_cluster(self.capacities, Resources(1, 1, 20), 'least-loaded').cluster.name, "b")
+
+    def test_bin_packing(self):
+        # The cluster a is the most used, but only the cluster c, the next one, has room for 8 more vCPUs
+        self.assertEqual(choose_cluster(self.capacities, Resources(1, 1, 20), 'bin-packing').cluster.name, "a")
+        self.assertEqual(choose_cluster(self.capacities, Resources(8, 4, 20), 'bin-packing').cluster.name, "c")
+
+    def test_no_capacity(self):
+        with self.assertRaises(NoCapacityAvailable):
+            choose_cluster(self.capacities, Resources(1, 512, 20))
+
+    def test_ties(self):
+        capacities = [ClusterCapacity(Cluster(name=name), Resources(8, 8, 8)) for name in ("y", "x", "z")]
+        self.assertEqual(choose_cluster(capacities, Resources(1, 1, 1)).cluster.name, "x")
+
+
+class ClusterCapacityTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(ClusterCapacityTests, self).setUp()
+        self.create_fleet(3)
+        self.cluster2 = Cluster.objects.create(name="mws-bench-2")
+
+    def test_no_capacity_configured(self):
+        # Behaves as before the capacity of the hosts was known
+        self.assertEqual(place_vm(Resources(1, 1, 20)), Cluster.objects.first())
+
+    def test_capacities(self):
+        Host.objects.filter(cluster=self.cluster).update(cpus=16, ram=64, disk=1000)
+        Host.objects.create(hostname="mws-bench-2a", cluster=self.cluster2, cpus=16, ram=64, disk=1000)
+        Host.objects.create(hostname="mws-bench-2b", cluster=self.cluster2, cpus=16, ram=64, disk=1000)
+        VirtualMachine.objects.update(numcpu=2, sizeram=4)
+        servertype = Site.objects.first().type
+        capacities = cluster_capacities()
+        self.assertEqual([(c.cluster.name, c.total, c.used, c.vms) for c in capacities], [
+            ("mws-bench-1", (16, 64, 1000), (6, 12, 3 * servertype.sizedisk), 3),
+            ("mws-bench-2", (32, 128, 2000), (0, 0, 0), 0),
+        ])
+        self.assertEqual(place_vm(Resources(2, 4, 20)), self.cluster2)
+        self.assertEqual(place_vm(Resources(2, 4, 20), policy='bin-packing'), self.cluster)
+        site = Site.objects.first()
+        self.assertEqual(site_requirements(site), Resources(2, 4, servertype.sizedisk))
+        self.assertEqual(which_cluster(site_requirements(site)), self.cluster2)
+
+        superuser = User(username="admin", is_superuser=True)
+        request = RequestFactory().get('/api/clusters/capacity/')
+        request.user = superuser
+        response = cluster_capacity(request)
+        self.assertEqual(response.status_code, 200)
+        clusters = json.loads(response.content)['clusters']
+        self.assertEqual(clusters[0]['free'], {'cpus': 10, 'ram': 52, 'disk': 1000 - 3 * servertype.sizedisk})
+        self.assertEqual([host['hostname'] for host in clusters[1]['hosts']], ["mws-bench-2a", "mws-bench-2b"])
+
+    def test_no_capacity_leaves_nothing_behind(self):
+        Host.objects.filter(cluster=self.cluster).update(cpus=1, ram=1, disk=10)
+        NetworkConfig.objects.create(IPv4='10.3.0.1', IPv6='2001:db8:3::1', type='ipvxpub', name="mws-new.example")
+        NetworkConfig.objects.create(IPv4='10.4.0.1', type='ipv4priv', name="mws-new.private.example")
+        NetworkConfig.objects.create(IPv6='2001:db8:2::ff', type='ipv6', name="mws-new-host.example")
+        sites = Site.objects.count()
+        free = NetworkConfig.objects.filter(status='free').count()
+        with self.assertRaises(NoCapacityAvailable):
+            preallocate_new_site(Site.objects.first().type)
+        with self.assertRaises(NoCapacityAvailable):
+            clone_vm_api_call(Site.objects.first())
+        self.assertEqual(Site.objects.count(), sites)
+        self.assertEqual(NetworkConfig.objects.filter(status='free').count(), free)
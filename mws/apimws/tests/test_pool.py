@@ -0,0 +1,97 @@
+import json
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.test import TestCase, RequestFactory, override_settings
+from django.utils import timezone
+from mock import mock
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.models import SitePoolEvent
+from apimws.placement import ClusterCapacity, Resources
+from apimws.pool import pool_status, plan_builds, replenish_pool, site_built, record_event, PoolStatus
+from apimws.views import site_pool
+from sitesmanagement.models import Site, ServerType
+
+
+@override_settings(POOL_MAX_CONCURRENT_BUILDS=4, POOL_DEFAULT_BUILD_TIME=30*60, POOL_SAFETY_FACTOR=2,
+                   POOL_MAX_SITES=20, POOL_DEMAND_WINDOWS=(24, 7*24), POOL_BUILD_TIMEOUT=2*60*60)
+class SitePoolTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(SitePoolTests, self).setUp()
+        ServerType.objects.exclude(id=1).update(preallocated=0)
+        ServerType.objects.filter(id=1).update(preallocated=1)
+        self.servertype = ServerType.objects.get(id=1)
+
+    def preallocated_site(self, built=True, started=None):
+        site = Site.objects.create(name="pool%d" % Site.objects.count(), type=self.servertype, preallocated=True,
+                                   disabled=built)
+        event = record_event(self.servertype, 'started', site)
+        if started:
+            SitePoolEvent.objects.filter(pk=event.pk).update(created=started)
+        return site
+
+    def status(self):
+        return [status for status in pool_status() if status.servertype.id == 1][0]
+
+    def test_target_follows_demand(self):
+        self.assertEqual(self.status().target, 1)
+        # 12 requests in the last day: 0.5 requests per hour, 0.25 during a build, 1 with the safety factor
+        for _ in range(12):
+            record_event(self.servertype, 'requested')
+        self.assertEqual(self.status().target, 1)
+        # A burst of requests, 72 in the last day: 3 requests per hour, 1.5 during a build
+        for _ in range(60):
+            record_event(self.servertype, 'unavailable')
+        status = self.status()
+        self.assertAlmostEqual(status.rate, 3.0)
+        self.assertEqual(status.target, 3)
+        # Server types without preallocated sites are not offered from the pool
+        ServerType.objects.filter(id=1).update(preallocated=0)
+        self.assertEqual(self.status().target, 0)
+
+    def test_depth_and_build_times(self):
+        self.preallocated_site(built=True)
+        building = self.preallocated_site(built=False)
+        self.preallocated_site(built=False, started=timezone.now() - timedelta(hours=3))
+        SitePoolEvent.objects.filter(site=building, kind='started').update(
+            created=timezone.now() - timedelta(minutes=10))
+        building.disabled = True
+        building.save()
+        self.assertAlmostEqual(site_built(building).duration, 600, delta=5)
+        status = self.status()
+        self.assertEqual((status.available, status.building, status.stalled), (2, 0, 1))
+        self.assertAlmostEqual(status.build_time, 600, delta=5)
+
+    def test_plan_builds_shares_the_budget(self):
+        big = ServerType.objects.create(numcpu=4, sizeram=8, sizedisk=40, preallocated=1, price=200, order=9)
+        statuses = [PoolStatus(self.servertype, available=0, rate=10), PoolStatus(big, available=0, rate=10)]
+        # Both pools are empty, the budget of 4 builds is shared
+        self.assertEqual(plan_builds(statuses, []), {self.servertype.id: 2, big.id: 2})
+        statuses[0].building = 3
+        self.assertEqual(plan_builds(statuses, []), {big.id: 1})
+        # Only one VM of the small server type fits in the clusters
+        small = self.servertype
+        capacity = ClusterCapacity(self.cluster, Resources(small.numcpu, small.sizeram, small.sizedisk))
+        statuses[0].building = 0
+        self.assertEqual(plan_builds(statuses, [capacity]), {small.id: 1})
+
+    @mock.patch("apimws.utils.preallocate_new_site")
+    def test_replenish_pool(self, preallocate_new_site):
+        for _ in range(60):
+            record_event(self.servertype, 'requested')
+        self.preallocated_site(built=True)
+        self.assertEqual(replenish_pool(), {1: 2})
+        self.assertEqual(preallocate_new_site.call_count, 2)
+        preallocate_new_site.assert_called_with(servertype=self.servertype)
+
+    def test_site_pool_view(self):
+        self.preallocated_site(built=True)
+        with mock.patch("ucamlookup.signals.return_visibleName_by_crsid", return_value="Admin"):
+            admin = User.objects.create(username="admin0001", is_superuser=True)
+        request = RequestFactory().get('/api/pool/')
+        request.user = admin
+        response = json.loads(site_pool(request).content)
+        self.assertEqual(response['max_concurrent_builds'], 4)
+        pool = [pool for pool in response['pools'] if pool['servertype'] == 1][0]
+        self.assertEqual((pool['available'], pool['building'], pool['target'], pool['time_to_replenish']),
+                         (1, 0, 1, 0))
@@ -0,0 +1,63 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from django.test import SimpleTestCase
+from mock import mock
+from apimws.process import run_command, CommandTimeout
+
+
+class RunCommandTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmpdir, "command.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_output_is_streamed(self):
+        output = run_command(["sh", "-c", "for i in $(seq 1 100); do echo line$i; echo err$i >&2; done"],
+                             log_path=self.log_path, max_lines=3)
+        # Only the last lines are kept in memory, but all of them go to the log
+        self.assertEqual(output, "err99\nline100\nerr100\n")
+        with open(self.log_path) as log_file:
+            lines = log_file.readlines()
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(lines[:2], ["line1\n", "err1\n"])
+
+    def test_whole_output(self):
+        self.assertEqual(len(run_command(["seq", "1", "5000"], max_lines=0).splitlines()), 5000)
+
+    def test_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            run_command(["sh", "-c", "echo first; echo last; exit 3"], max_lines=1)
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.output, "last\n")
+
+    def test_timeout(self):
+        start = time.time()
+        with self.assertRaises(CommandTimeout) as cm:
+            # The child of the shell keeps the output open, it has to be killed too
+            run_command(["sh", "-c", "echo started; sleep 30; echo never"], timeout=0.5)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(cm.exception.output, "started\n")
+        self.assertTrue(isinstance(cm.exception, subprocess.CalledProcessError))
+
+    def test_log_failure_kills_command(self):
+        start = time.time()
+        with mock.patch("apimws.process.open", create=True) as mock_open:
+            mock_open.return_value.write.side_effect = IOError("No space left on device")
+            with self.assertRaises(IOError):
+                run_command(["sh", "-c", "echo started; sleep 30"], timeout=0, log_path=self.log_path)
+        self.assertLess(time.time() - start, 10)
+
+    def test_own_process_group(self):
+        # The command is the leader of its own process group, so that killing the group does not kill the worker
+        pgid = run_command(["sh", "-c", "ps -o pgid= -p $$"]).strip()
+        self.assertNotEqual(pgid, str(os.getpgrp()))
+
+    def test_command_not_found(self):
+        with self.assertRaises(OSError):
+            run_command(["mws-no-such-command"])
@@ -0,0 +1,140 @@
+import json
+from celery.exceptions import Retry
+from django.test import TestCase, override_settings
+from mock import mock
+from apimws.ipreg import IPRegFailure
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.models import ProvisioningStage
+from apimws.tests.test_vmapi import PUBKEY
+from apimws.xen import clone_vm_api_call, fetch_site_key, new_site_primary_vm, VMAPIFailure, VMAPIHostUnavailable
+from sitesmanagement.models import Site, Service, NetworkConfig, SiteKey
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory',
+                   PROVISIONING_RETRY_DELAY=0)
+class ProvisioningPipelineTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(ProvisioningPipelineTests, self).setUp()
+        self.create_fleet(1)
+        self.site = Site.objects.get(name="benchSite0000")
+        NetworkConfig.objects.create(IPv6='2001:db8:2::ff', type='ipv6', name="mws-bench-new.example")
+        # The stages are started when the transaction is committed, which never happens inside a TestCase
+        patcher = mock.patch("apimws.xen.transaction.on_commit", side_effect=lambda stages: stages())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stages(self, vm):
+        return dict(ProvisioningStage.objects.filter(vm=vm).values_list('stage', 'status'))
+
+    @mock.patch("apimws.xen.launch_ansible")
+    @mock.patch("apimws.ipreg.ip_reg_batch_call")
+    @mock.patch("apimws.xen.subprocess")
+    @mock.patch("apimws.xen.vm_api_request", return_value='{"vmid": "mws-bench-new"}')
+    def test_clone(self, vm_api_request, mock_subprocess, ip_reg_batch_call, launch_ansible):
+        mock_subprocess.Popen().communicate.return_value = (json.dumps({"pubkey": PUBKEY}), '')
+        clone_vm_api_call(self.site)
+        vm = self.site.test_service.virtual_machines.get()
+        self.assertEqual(vm.name, "mws-bench-new")
+        self.assertEqual(vm_api_request.call_args[1]['parameters']['netconf'],
+                         {"IPv6": "2001:db8:2::ff", "hostname": "mws-bench-new.example"})
+        self.assertEqual(SiteKey.objects.filter(site=self.site).count(), len(SiteKey.ALGORITHMS))
+        # All the SSHFP records are published with a single IPREG batch
+        self.assertEqual(ip_reg_batch_call.call_count, 1)
+        calls = ip_reg_batch_call.call_args[0][0]
+        self.assertEqual(sorted(set(c[2] for c in calls)),
+                         ["mws-bench-0000.mws3.example", "mws-bench-0000.mws3.private.example",
+                          "mws-bench-new.example"])
+        self.assertEqual(len(calls), len(SiteKey.ALGORITHMS) * 3)
+        self.assertEqual(set(tuple(c[:2]) for c in calls), {('put', 'sshfp')})
+        self.assertEqual(launch_ansible.call_count, 2)
+        stages = self.stages(vm)
+        self.assertEqual(len(stages), 3 + len(SiteKey.ALGORITHMS))
+        self.assertEqual(set(stages.values()), {'done'})
+        self.assertEqual(stages['create'], 'done')
+        self.assertEqual(stages['configure'], 'done')
+        self.assertEqual(self.site.test_service.provisioning_stages.count(), len(stages))
+
+    @mock.patch("apimws.ipreg.ip_reg_batch_call")
+    @mock.patch("apimws.xen.subprocess")
+    @mock.patch("apimws.xen.vm_api_request", return_value='{"vmid": "mws-new-site"}')
+    def test_new_site(self, vm_api_request, mock_subprocess, ip_reg_batch_call):
+        mock_subprocess.Popen().communicate.return_value = (json.dumps({"pubkey": PUBKEY}), '')
+        site = Site.objects.create(name="newSite", type=self.servertype, preallocated=True)
+        service = Service.objects.create(site=site, type='production', network_configuration=NetworkConfig.objects.create(
+            IPv4='10.3.0.1', IPv6='2001:db8:3::1', type='ipvxpub', name="mws-new-site.mws3.example"))
+        Service.objects.create(site=site, type='test', network_configuration=NetworkConfig.objects.create(
+            IPv4='10.4.0.1', type='ipv4priv', name="mws-new-site.mws3.private.example"))
+        vm = service.virtual_machines.get(pk=new_site_primary_vm(service, NetworkConfig.get_free_host_config()))
+        self.assertEqual(vm.name, "mws-new-site")
+        self.assertEqual(service.vhosts.get().main_domain.name, "mws-new-site.mws3.example")
+        self.assertEqual(set(self.stages(vm).values()), {'done'})
+        self.assertEqual(len(ip_reg_batch_call.call_args[0][0]), len(SiteKey.ALGORITHMS) * 3)
+
+    @mock.patch("apimws.xen.launch_ansible")
+    @mock.patch("apimws.ipreg.ip_reg_batch_call")
+    @mock.patch("apimws.xen.subprocess")
+    def test_create_is_only_retried_when_not_sent(self, mock_subprocess, ip_reg_batch_call, launch_ansible):
+        mock_subprocess.Popen().communicate.return_value = (json.dumps({"pubkey": PUBKEY}), '')
+        with mock.patch("apimws.xen.vm_api_request", side_effect=[VMAPIHostUnavailable(), '{"vmid": "retried"}']):
+            # Eager tasks are retried synchronously and then raise Retry
+            with self.assertRaises(Retry):
+                clone_vm_api_call(self.site)
+        vm = self.site.test_service.virtual_machines.get()
+        self.assertEqual(vm.name, "retried")
+        self.assertEqual(ProvisioningStage.objects.get(vm=vm, stage="create").attempts, 2)
+
+    @mock.patch("apimws.ipreg.ip_reg_batch_call")
+    @mock.patch("apimws.xen.subprocess")
+    def test_create_failure_stops_the_pipeline(self, mock_subprocess, ip_reg_batch_call):
+        mock_subprocess.Popen().communicate.return_value = (json.dumps({"pubkey": PUBKEY}), '')
+        with mock.patch("apimws.xen.vm_api_request", side_effect=VMAPIFailure()) as vm_api_request:
+            with self.assertRaises(VMAPIFailure):
+                clone_vm_api_call(self.site)
+        self.assertEqual(vm_api_request.call_count, 1)
+        vm = self.site.test_service.virtual_machines.get()
+        # The pipeline stops at the failed stage
+        self.assertEqual(self.stages(vm)['create'], 'failed')
+        self.assertNotIn('configure', self.stages(vm))
+
+    @mock.patch("apimws.xen.launch_ansible")
+    @mock.patch("apimws.ipreg.ip_reg_batch_call")
+    @mock.patch("apimws.xen.subprocess")
+    @mock.patch("apimws.xen.vm_api_request", return_value='{"vmid": "mws-bench-new"}')
+    def test_key_failure_does_not_stop_the_creation(self, vm_api_request, mock_subprocess, ip_reg_batch_call,
+                                                    launch_ansible):
+        mock_subprocess.Popen().communicate.return_value = ("not json", "mws_pubkey failed")
+        with self.assertRaises((ValueError, Retry)):
+            clone_vm_api_call(self.site)
+        vm = self.site.test_service.virtual_machines.get()
+        stages = self.stages(vm)
+        self.assertEqual((stages['create'], stages['configure']), ('done', 'done'))
+        self.assertEqual(launch_ansible.call_count, 2)
+        self.assertEqual(stages['key %s' % sorted(SiteKey.ALGORITHMS)[0]], 'failed')
+        self.assertNotIn('sshfp', stages)
+        self.assertFalse(ip_reg_batch_call.called)
+
+    @mock.patch("apimws.xen.launch_ansible")
+    @mock.patch("apimws.xen.subprocess")
+    @mock.patch("apimws.xen.vm_api_request", return_value='{"vmid": "mws-bench-new"}')
+    def test_rejected_sshfp_records(self, vm_api_request, mock_subprocess, launch_ansible):
+        mock_subprocess.Popen().communicate.return_value = (json.dumps({"pubkey": PUBKEY}), '')
+        rejected = lambda calls: [{}] * (len(calls) - 1) + [IPRegFailure("Not authorised", calls[-1], 3)]
+        with mock.patch("apimws.ipreg.ip_reg_batch_call", side_effect=rejected) as ip_reg_batch_call:
+            clone_vm_api_call(self.site)
+        # The batch is not retried and the stage is done, keeping the rejected records as its error
+        self.assertEqual(ip_reg_batch_call.call_count, 1)
+        vm = self.site.test_service.virtual_machines.get()
+        self.assertEqual(set(self.stages(vm).values()), {'done'})
+        self.assertIn("Not authorised", ProvisioningStage.objects.get(vm=vm, stage="sshfp").error)
+
+    @mock.patch("apimws.xen.subprocess")
+    def test_key_fetch_retry(self, mock_subprocess):
+        vm = self.site.production_service.virtual_machines.get()
+        mock_subprocess.Popen().communicate.side_effect = [("not json", "error"),
+                                                           (json.dumps({"pubkey": PUBKEY}), '')]
+        with self.assertRaises(Retry):
+            fetch_site_key.delay(vm.id, 'RSA')
+        stage = ProvisioningStage.objects.get(vm=vm, stage="key RSA")
+        self.assertEqual((stage.status, stage.attempts, stage.error), ('done', 2, ''))
+        self.assertEqual(SiteKey.objects.get(site=self.site, type='RSA').public_key, PUBKEY)
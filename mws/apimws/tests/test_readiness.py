@@ -0,0 +1,97 @@
+import socket
+import threading
+from celery.exceptions import Retry
+from django.test import TestCase, override_settings
+from mock import mock
+from apimws.readiness import ssh_ready, wait_for_ssh, probe_countdown, when_ready
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.views import post_installOS
+from sitesmanagement.models import Service
+
+
+class SSHProbeTests(TestCase):
+
+    def serve(self, banner):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def accept():
+            connection, _ = server.accept()
+            connection.sendall(banner)
+            connection.close()
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+        return server.getsockname()[1]
+
+    def test_ssh_ready(self):
+        self.assertTrue(ssh_ready('127.0.0.1', self.serve(b"SSH-2.0-OpenSSH_7.4p1 Debian-10\r\n"), timeout=5))
+        self.assertFalse(ssh_ready('127.0.0.1', self.serve(b"HTTP/1.1 400 Bad Request\r\n"), timeout=5))
+
+    def test_closed_port(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        self.assertFalse(ssh_ready('127.0.0.1', port, timeout=1))
+
+    @override_settings(SSH_PROBE_INITIAL_DELAY=2, SSH_PROBE_MAX_DELAY=30)
+    def test_backoff(self):
+        self.assertEqual([probe_countdown(retries) for retries in range(6)], [2, 4, 8, 16, 30, 30])
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory',
+                   SSH_PROBE_MAX_RETRIES=3)
+class WaitForSSHTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(WaitForSSHTests, self).setUp()
+        self.create_fleet(1)
+        self.service = Service.objects.get(network_configuration__name="mws-bench-0000.mws3.example")
+
+    @mock.patch("apimws.views.launch_ansible_async")
+    def test_ansible_launched_when_ready(self, launch_ansible_async):
+        with mock.patch("apimws.readiness.ssh_ready", side_effect=[False, False, True]) as probe:
+            # Eager tasks are retried synchronously and then raise Retry
+            with self.assertRaises(Retry):
+                when_ready(self.service, post_installOS.si(self.service))
+        probe.assert_called_with("mws-bench-client0000.example")
+        self.assertEqual(probe.call_count, 3)
+        launch_ansible_async.assert_called_once_with(self.service, ignore_host_key=True)
+
+    @mock.patch("apimws.views.launch_ansible_async")
+    def test_ready_straight_away(self, launch_ansible_async):
+        with mock.patch("apimws.readiness.ssh_ready", return_value=True) as probe:
+            when_ready(self.service, post_installOS.si(self.service))
+        self.assertEqual(probe.call_count, 1)
+        self.assertEqual(launch_ansible_async.call_count, 1)
+
+    @mock.patch("apimws.views.launch_ansible_async")
+    def test_reboot_is_waited_for(self, launch_ansible_async):
+        # The SSH server of the installer still answers, then the VM reboots and it answers again
+        with mock.patch("apimws.readiness.ssh_ready", side_effect=[True, True, False, False, True]) as probe:
+            with self.assertRaises(Retry):
+                when_ready(self.service, post_installOS.si(self.service), reboot=True)
+        self.assertEqual(probe.call_count, 5)
+        launch_ansible_async.assert_called_once_with(self.service, ignore_host_key=True)
+
+    @mock.patch("apimws.views.launch_ansible_async")
+    def test_reboot_not_seen(self, launch_ansible_async):
+        with mock.patch("apimws.readiness.ssh_ready", return_value=True) as probe, \
+                mock.patch("apimws.readiness.probe_countdown", wraps=probe_countdown) as countdown:
+            with self.assertRaises(Retry):
+                when_ready(self.service, post_installOS.si(self.service), reboot=True)
+        # The VMs are probed without backoff while they are expected to go down, and launched anyway at the end
+        self.assertEqual(countdown.call_args_list, [mock.call(0)] * 4)
+        self.assertEqual(probe.call_count, 4)
+        self.assertEqual(launch_ansible_async.call_count, 1)
+
+    @mock.patch("apimws.views.launch_ansible_async")
+    def test_launched_anyway_after_max_retries(self, launch_ansible_async):
+        with mock.patch("apimws.readiness.ssh_ready", return_value=False) as probe:
+            with self.assertRaises(Retry):
+                wait_for_ssh.delay(["mws-bench-client0000.example"], post_installOS.si(self.service))
+        self.assertEqual(probe.call_count, 4)
+        self.assertEqual(launch_ansible_async.call_count, 1)
@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+from django.test import TestCase, override_settings
+from mock import mock
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.models import Cluster, Host
+from apimws.reconciliation import reconcile_fleet, list_guests
+from apimws.xen import VMAPIHostUnavailable
+from sitesmanagement.models import VirtualMachine, Site
+
+
+def guests_response(guests):
+    return json.dumps([{'vmid': vmid, 'state': state} for vmid, state in guests])
+
+
+@override_settings(RECONCILIATION_REPAIR=False)
+class FleetReconciliationTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(FleetReconciliationTests, self).setUp()
+        self.create_fleet(4)
+
+    def reconcile(self, responses, **kwargs):
+        """Reconciles the fleet with the VM API answering the list request of each host with responses[hostname]"""
+        def list_request(command, parameters, hostnames):
+            self.assertEqual(command, 'list')
+            return responses[hostnames[0]], [(hostnames[0], 0.1, False)]
+        with mock.patch("apimws.reconciliation.vm_api_failover_request", side_effect=list_request) as request, \
+                mock.patch("apimws.reconciliation.batch_vm_button") as batch:
+            report = reconcile_fleet(**kwargs)
+        return report, request, batch
+
+    def test_no_drift(self):
+        with self.assertNumQueries(13):
+            report, request, batch = self.reconcile({"mws-bench-1.dev.mws3.cam.ac.uk": guests_response(
+                ("bench_vm%04d" % i, 'running') for i in range(4))})
+        self.assertEqual(report, {'failed': {}, 'drift': [], 'repaired': {}})
+        # A single request per cluster
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(set(VirtualMachine.objects.values_list('power_state', flat=True)), {'running'})
+        self.assertFalse(VirtualMachine.objects.filter(power_state_checked__isnull=True).exists())
+
+    def test_drift(self):
+        Site.objects.filter(name="benchSite0002").update(disabled=True)
+        report, request, batch = self.reconcile({"mws-bench-1.dev.mws3.cam.ac.uk": guests_response([
+            ("bench_vm0000", 'running'), ("bench_vm0001", 'stopped'), ("bench_vm0002", 'running'),
+            ("leftover_vm", 'running')])})
+        self.assertEqual(sorted((drift['kind'], drift['vmid'], drift['expected'], drift['reported'])
+                                for drift in report['drift']), [
+            ('missing', 'bench_vm0003', None, None),
+            ('power', 'bench_vm0001', 'running', 'stopped'),
+            ('power', 'bench_vm0002', 'stopped', 'running'),
+            ('unknown', 'leftover_vm', None, 'running'),
+        ])
+        self.assertEqual(VirtualMachine.objects.get(name="bench_vm0003").power_state, 'missing')
+        self.assertEqual(VirtualMachine.objects.get(name="bench_vm0001").power_state, 'stopped')
+        # Only reported
+        self.assertEqual(report['repaired'], {})
+        self.assertFalse(batch.delay.called)
+
+    def test_repair(self):
+        Site.objects.filter(name="benchSite0002").update(disabled=True)
+        report, request, batch = self.reconcile({"mws-bench-1.dev.mws3.cam.ac.uk": guests_response([
+            ("bench_vm0000", 'running'), ("bench_vm0001", 'stopped'), ("bench_vm0002", 'running'),
+            ("bench_vm0003", 'crashed')])}, repair_drift=True)
+        vm1 = VirtualMachine.objects.get(name="bench_vm0001")
+        vm2 = VirtualMachine.objects.get(name="bench_vm0002")
+        self.assertEqual(report['repaired'], {'poweron': [vm1.id], 'poweroff': [vm2.id]})
+        batch.delay.assert_has_calls([mock.call([vm1.id], 'poweron'), mock.call([vm2.id], 'poweroff')],
+                                     any_order=True)
+
+    def test_vms_being_installed(self):
+        VirtualMachine.objects.filter(name="bench_vm0000").update(name=None)
+        vm = VirtualMachine.objects.get(name="bench_vm0001")
+        vm.service.status = 'installing'
+        vm.service.save()
+        report, request, batch = self.reconcile({"mws-bench-1.dev.mws3.cam.ac.uk": guests_response([
+            ("bench_vm0001", 'stopped'), ("bench_vm0002", 'running'), ("bench_vm0003", 'running')])})
+        self.assertEqual(report['drift'], [])
+
+    def test_cluster_failure(self):
+        cluster = Cluster.objects.create(name="mws-bench-2")
+        Host.objects.create(hostname="mws-bench-2.dev.mws3.cam.ac.uk", cluster=cluster)
+        VirtualMachine.objects.filter(name="bench_vm0003").update(cluster=cluster)
+        report, request, batch = self.reconcile({
+            "mws-bench-1.dev.mws3.cam.ac.uk": guests_response(("bench_vm%04d" % i, 'running') for i in range(3)),
+            "mws-bench-2.dev.mws3.cam.ac.uk": VMAPIHostUnavailable("down"),
+        })
+        # The VMs of the cluster that could not be listed are not reported as missing
+        self.assertEqual(report['failed'], {"mws-bench-2": "down"})
+        self.assertEqual(report['drift'], [])
+        self.assertIsNone(VirtualMachine.objects.get(name="bench_vm0003").power_state)
+
+    def test_list_guests(self):
+        with mock.patch("apimws.reconciliation.vm_api_failover_request", return_value=("not json", [])):
+            guests, attempts = list_guests(["mws-bench-1.dev.mws3.cam.ac.uk"])
+        self.assertIsInstance(guests, Exception)
+        with mock.patch("apimws.reconciliation.vm_api_failover_request",
+                        return_value=(guests_response([("a", "running")]), [])):
+            guests, attempts = list_guests(["mws-bench-1.dev.mws3.cam.ac.uk"])
+        self.assertEqual(guests, {"a": "running"})
+
+
+VMMANAGER_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'vmmanager')
+# Runs vmmanager instead of sending the command to the host, whose hostname is dropped
+VMMANAGER_COMMAND = [sys.executable, "-c",
+                     "import sys; sys.path.insert(0, %r); del sys.argv[1]; import vmmanager; vmmanager.cli()"
+                     % VMMANAGER_DIR]
+
+
+@override_settings(VM_API_CHANNEL=False, VM_END_POINT_COMMAND=VMMANAGER_COMMAND)
+class VMManagerListTests(TestCase):
+
+    def setUp(self):
+        # Fake userv that answers the vm_list request of vmmanager
+        bin_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bin_dir)
+        userv = os.path.join(bin_dir, 'userv')
+        with open(userv, 'w') as script:
+            script.write("#!/bin/sh\necho '%s'\n" % guests_response([("bench_vm0000", "running"),
+                                                                      ("bench_vm0001", "dying")]))
+        os.chmod(userv, stat.S_IRWXU)
+        patcher = mock.patch.dict(os.environ, {'PATH': bin_dir + os.pathsep + os.environ['PATH']})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_list_command_line(self):
+        guests, attempts = list_guests(["mws-bench-1.dev.mws3.cam.ac.uk"])
+        self.assertEqual(guests, {"bench_vm0000": "running", "bench_vm0001": "crashed"})
+        self.assertEqual([failed for hostname, elapsed, failed in attempts], [False])
+        # The JSON parameters sent with the rest of the commands are accepted too
+        output = subprocess.check_output(VMMANAGER_COMMAND + ["mws-bench-1.dev.mws3.cam.ac.uk", "list", "{}"])
+        self.assertEqual(len(json.loads(output)), 2)
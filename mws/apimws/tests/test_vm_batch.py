@@ -0,0 +1,57 @@
+import json
+from django.test import TestCase, override_settings
+from mock import mock
+from apimws.management.test_ansible_inventory import FleetMixin
+from apimws.models import Cluster, Host
+from apimws.xen import vm_api_batch, batch_vm_button, VMAPIFailure
+from sitesmanagement.models import VirtualMachine
+
+
+@override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
+class VMAPIBatchTests(FleetMixin, TestCase):
+
+    def setUp(self):
+        super(VMAPIBatchTests, self).setUp()
+        self.create_fleet(5)
+        cluster = Cluster.objects.create(name="mws-bench-2")
+        Host.objects.create(hostname="mws-bench-2.dev.mws3.cam.ac.uk", cluster=cluster)
+        VirtualMachine.objects.filter(name__in=["bench_vm0001", "bench_vm0003"]).update(cluster=cluster)
+        self.vms = list(VirtualMachine.objects.order_by('id'))
+
+    @staticmethod
+    def host_request(command, parameters, host):
+        # Fake "vmmanager batch": the button operations on bench_vm0003 fail
+        return json.dumps([{'error': 'vm_button failed'} if operation['parameters']['vmid'] == "bench_vm0003"
+                           else {'output': "%s %s" % (host, operation['parameters']['vmid'])}
+                           for operation in parameters])
+
+    def test_operations_are_grouped_per_host(self):
+        with mock.patch("apimws.xen.vm_api_host_request", side_effect=self.host_request) as mock_request:
+            results = vm_api_batch([(vm, 'button', {'action': 'reboot', 'vmid': vm.name}) for vm in self.vms])
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(sorted((c[0][2], [op['parameters']['vmid'] for op in c[0][1]])
+                                for c in mock_request.call_args_list),
+                         [("mws-bench-1.dev.mws3.cam.ac.uk", ["bench_vm0000", "bench_vm0002", "bench_vm0004"]),
+                          ("mws-bench-2.dev.mws3.cam.ac.uk", ["bench_vm0001", "bench_vm0003"])])
+        self.assertEqual(results[:3], ["mws-bench-1.dev.mws3.cam.ac.uk bench_vm0000",
+                                       "mws-bench-2.dev.mws3.cam.ac.uk bench_vm0001",
+                                       "mws-bench-1.dev.mws3.cam.ac.uk bench_vm0002"])
+        self.assertTrue(isinstance(results[3], VMAPIFailure))
+        self.assertEqual(results[4], "mws-bench-1.dev.mws3.cam.ac.uk bench_vm0004")
+
+    def test_failed_host(self):
+        def host_request(command, parameters, host):
+            if host == "mws-bench-2.dev.mws3.cam.ac.uk":
+                raise VMAPIFailure()
+            return self.host_request(command, parameters, host)
+
+        with mock.patch("apimws.xen.vm_api_host_request", side_effect=host_request):
+            results = vm_api_batch([(vm, 'delete', {'vmid': vm.name}) for vm in self.vms])
+        self.assertEqual([isinstance(result, VMAPIFailure) for result in results], [False, True, False, True, False])
+        self.assertEqual(vm_api_batch([]), [])
+
+    def test_batch_vm_button(self):
+        with mock.patch("apimws.xen.vm_api_host_request", side_effect=self.host_request):
+            self.assertTrue(batch_vm_button.delay([self.vms[0].id, self.vms[1].id], 'poweroff').get())
+            with self.assertRaises(VMAPIFailure):
+                batch_vm_button.delay([vm.id for vm in self.vms], 'poweroff')
@@ -0,0 +1,69 @@
+import json
+import sys
+import threading
+from django.test import SimpleTestCase, override_settings
+from apimws.vm_channel import get_channel, close_channels, VMAPIRequestError, VMAPIChannelError
+
+
+# Stub of "vmmanager serve": answers each request after the given delay, so responses arrive out of order
+STUB_SERVER = """
+import json, sys, threading, time
+lock = threading.Lock()
+def answer(request):
+    time.sleep(request['parameters'].get('delay', 0))
+    if request['command'] == 'exit':
+        sys.exit(1)
+    if request['command'] == 'fail':
+        response = {'id': request['id'], 'error': 'VM not found'}
+    else:
+        response = {'id': request['id'], 'output': json.dumps([request['command'], request['parameters'],
+                                                               sys.argv[1:]])}
+    with lock:
+        sys.stdout.write(json.dumps(response) + "\\n")
+        sys.stdout.flush()
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    if request['command'] == 'exit':
+        sys.exit(1)
+    threading.Thread(target=answer, args=(request, )).start()
+"""
+
+
+@override_settings(VM_END_POINT_COMMAND=[sys.executable, "-c", STUB_SERVER])
+class VMAPIChannelTests(SimpleTestCase):
+
+    def tearDown(self):
+        close_channels()
+
+    def test_concurrent_requests(self):
+        channel = get_channel("xen1.example")
+        responses = {}
+
+        def request(i):
+            responses[i] = channel.request('button', {'vmid': i, 'delay': 0.3 - i * 0.05}, timeout=10)
+
+        threads = [threading.Thread(target=request, args=(i, )) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(5):
+            self.assertEqual(json.loads(responses[i]),
+                             ["button", {"delay": 0.3 - i * 0.05, "vmid": i}, ["xen1.example", "serve"]])
+        # The same process serves all the requests for a host
+        self.assertIs(get_channel("xen1.example"), channel)
+        self.assertIsNot(get_channel("xen2.example"), channel)
+
+    def test_errors(self):
+        channel = get_channel("xen1.example")
+        with self.assertRaises(VMAPIRequestError):
+            channel.request('fail', {}, timeout=10)
+        with self.assertRaises(VMAPIChannelError):
+            channel.request('button', {'delay': 1}, timeout=0.1)
+        # The channel is reopened after the command exits
+        with self.assertRaises(VMAPIChannelError):
+            channel.request('exit', {}, timeout=10)
+        self.assertTrue(channel.closed)
+        new_channel = get_channel("xen1.example")
+        self.assertIsNot(new_channel, channel)
+        self.assertEqual(new_channel.request('delete', {}, timeout=10), '["delete", {}, ["xen1.example", "serve"]]')
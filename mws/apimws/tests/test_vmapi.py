@@ -1,3 +1,4 @@
+import json
 import mock
 import os
 from django.conf import settings
@@ -5,10 +6,15 @@ from django.test import TestCase, override_settings
 from mock import patch, call
 
 from mwsauth.tests import do_test_login
-from sitesmanagement.models import VirtualMachine
+from sitesmanagement.models import VirtualMachine, SiteKey
 from sitesmanagement.tests.tests import assign_a_site
 from apimws.xen import change_vm_power_state, reset_vm, destroy_vm, clone_vm_api_call
 
+PUBKEY = "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQClBKpj+/WXlxJMY2iYw1mB1qYLM8YDjFS6qSiT6UmNLLhXJBEfd6vOMErM1IfDsYN+W36" \
+         "04hukxwC859TU4ZLQYD6wFI2D+qMhb2UTcoLlOYD7TG436RXKbxK4iAT7ll3XUT8VxZUq/AZKVsvmH309l5LcW6UPO0PVYoafpo4+F" \
+         "mv5c/CRTvp5X0eaoXtgT49h58/GwNlD2RrVPInjI9isa8/k8qiNaWEHYOGKC343BQIR9Sx+5HQ16wf3x3fUFeMTOYfsbvwQ9T5pkK" \
+         "pFoiUYRxjsz7bXdPQPT4A1UrfgmGnTLJGSUh+uvHYLe7izWoMCCDCV0+Zyn0IlrlfmN+cD"
+
 
 @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True, CELERY_ALWAYS_EAGER=True, BROKER_BACKEND='memory')
 class XenAPITests(TestCase):
@@ -18,15 +24,14 @@ class XenAPITests(TestCase):
         do_test_login(self, "test0001")
         assign_a_site(self)
 
-    @staticmethod
     @patch("apimws.xen.launch_ansible")
-    @patch("apimws.xen.secrets_prealocation_vm")
-    @patch("apimws.xen.app")
+    @patch("apimws.ipreg.ip_reg_batch_call")
+    @patch("apimws.xen.subprocess")
+    @patch("apimws.xen.transaction.on_commit", side_effect=lambda stages: stages())
     @patch("apimws.xen.vm_api_request")
-    def test_xen_api(mock_vm_api_request, mock_xen_app, secrets_prealocation_vm, launch_ansible):
+    def test_xen_api(self, mock_vm_api_request, on_commit, mock_subprocess, ip_reg_batch_call, launch_ansible):
         # We retrieve the VM created by the create Xen API call
         vm = VirtualMachine.objects.first()
-        mock_xen_app.control.inspect.active.values.return_value = []
         mock_vm_api_request.return_value = "{}"
         # We try that the switch off change of state works
         change_vm_power_state(vm.id, "off")
@@ -34,11 +39,20 @@ class XenAPITests(TestCase):
         change_vm_power_state(vm.id, "on")
         # We try that the reset call works
         reset_vm(vm.id)
+        mock_vm_api_request.assert_has_calls([
+            call(command='button', parameters={"action": "poweroff", "vmid": vm.name}, vm=vm),
+            call(command='button', parameters={"action": "poweron", "vmid": vm.name}, vm=vm),
+            call(command='button', vm=vm, parameters={"action": "reboot", "vmid": vm.name}),
+        ])
         # We clone the production VM to a test VM
         site = vm.site
+
+        mock_subprocess.Popen().communicate.return_value = (json.dumps({"pubkey": PUBKEY}), '')
         clone_vm_api_call(site)
 
-        secrets_prealocation_vm.assert_called_once_with(site.secondary_vm)
+        # Every key of the site is published as SSHFP record of both services and of the new VM
+        self.assertEqual(ip_reg_batch_call.call_count, 1)
+        self.assertEqual(len(ip_reg_batch_call.call_args[0][0]), len(SiteKey.ALGORITHMS) * 3)
         launch_ansible.assert_has_calls([call(site.production_service), call(site.test_service)])
 
         # We try the deletion of both VMs through a Xen API call
@@ -6,7 +6,9 @@ from celery import shared_task, Task
 from django.core.mail import EmailMessage
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from apimws.vm import new_site_primary_vm
+from apimws.pool import record_event
+from apimws.placement import servertype_requirements
+from apimws.vm import new_site_primary_vm, which_cluster
 from sitesmanagement.models import EmailConfirmation, NetworkConfig, Site, Service, ServerType
 from sitesmanagement.utils import is_camacuk_subdomain
 
@@ -106,19 +108,24 @@ def preallocate_new_site(servertype=None):
     "production" and "test".
 
     """
-    if servertype:
-        site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True, type=servertype)
-    else:
-        site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True,
-                                   type=ServerType.objects.get(id=1))
+    if not servertype:
+        servertype = ServerType.objects.get(id=1)
+    # The cluster is chosen first, so that nothing is created or allocated if there is no capacity left for the VM
+    cluster = which_cluster(servertype_requirements(servertype))
     prod_service_netconf = NetworkConfig.get_free_prod_service_config()
     test_service_netconf = NetworkConfig.get_free_test_service_config()
     host_netconf = NetworkConfig.get_free_host_config()
     if not prod_service_netconf or not test_service_netconf or not host_netconf:
+        # Return to the free list the network configurations already allocated
+        for netconf in (prod_service_netconf, test_service_netconf, host_netconf):
+            if netconf:
+                netconf.release()
         raise Exception('A MWS server cannot be created at this moment because there are no network addresses available')
+    site = Site.objects.create(name=uuid.uuid4(), disabled=False, preallocated=True, type=servertype)
     prod_service = Service.objects.create(site=site, type='production', network_configuration=prod_service_netconf)
     Service.objects.create(site=site, type='test', network_configuration=test_service_netconf)
-    new_site_primary_vm(prod_service, host_netconf)
+    record_event(site.type, 'started', site)
+    new_site_primary_vm(prod_service, host_netconf, cluster)
     LOGGER.info("Preallocated MWS server created '" + str(site.name) + "' with id " + str(site.id))
 
 
@@ -1,19 +1,25 @@
 import calendar
 import logging
+import math
 import subprocess
 from datetime import date, datetime, timedelta
 from time import mktime
 from celery import shared_task
 from django.conf import settings
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.core.mail import EmailMessage
 from django.db.models import Q
 from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from stronghold.decorators import public
 from apimws.ansible import launch_ansible_async, AnsibleTaskWithFailure, ansible_change_mysql_root_pwd
 from apimws.ipreg import get_nameinfo
+from apimws.models import AnsibleRun
+from apimws.placement import cluster_capacities
+from apimws.pool import pool_status, site_built
+from apimws.readiness import when_ready
 from mwsauth.utils import privileges_check
 from sitesmanagement.models import DomainName, EmailConfirmation, VirtualMachine, Billing, Site, Vhost
 from ucamlookup import user_in_groups, get_or_create_group_by_groupid
@@ -107,13 +113,10 @@ def post_installOS(service):
                    service.site.production_service.virtual_machines.first().name,
                    service.site.test_service.virtual_machines.first().name]
         subprocess.check_output(command)
-    try:
-        launch_ansible_async(service, ignore_host_key=True)
-    except:
-        # In case the previous task fail because we didn't leave enough time for the machine to reboot
-        launch_ansible_async(service, ignore_host_key=True)
+    launch_ansible_async(service, ignore_host_key=True)
     if service.site.preallocated:
-        service.site.disable()
+        if service.site.disable():
+            site_built(service.site)
 
 
 @public
@@ -137,8 +140,8 @@ def post_installation(request):
                 raise Exception("The service wasn't in the OS installation process")  # TODO raise custom exception
             service.status = 'postinstall'
             service.save()
-            post_installOS.apply_async((service,), countdown=180)
-            # Wait 180 seconds before launching ansible, this will allow the machine have time to complete the reboot
+            # Launch ansible once the machine has completed the reboot
+            when_ready(service, post_installOS.si(service), reboot=True)
             return HttpResponse()
 
     return HttpResponseForbidden()
@@ -260,3 +263,65 @@ def statsdatarequests(request):
       "values" : values
     }, ]
     return JsonResponse(data, safe=False)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list of values"""
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def duration_stats(durations):
+    result = {}
+    for key, values in durations.items():
+        values.sort()
+        result[key] = {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'max': values[-1],
+        }
+    return result
+
+
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def ansible_run_stats(request):
+    """Percentiles of the duration (in seconds) of the ansible runs of the last days, per playbook tag and per
+    host. Runs without tags (the whole MWS guest role) are reported under the tag 'all'."""
+    try:
+        days = int(request.GET.get('days', 7))
+    except ValueError:
+        days = 7
+    since = timezone.now() - timedelta(days=days)
+    per_tag = {}
+    per_host = {}
+    for host, tags, duration in AnsibleRun.objects.filter(started__gte=since).values_list('host', 'tags', 'duration'):
+        per_tag.setdefault(tags or 'all', []).append(duration)
+        per_host.setdefault(host, []).append(duration)
+    return JsonResponse({
+        'since': since.isoformat(),
+        'tags': duration_stats(per_tag),
+        'hosts': duration_stats(per_host),
+    })
+
+
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def cluster_capacity(request):
+    """Capacity, usage and free resources (vCPUs, GB of RAM and GB of disk) of each cluster, used to place new VMs"""
+    capacities = cluster_capacities()
+    return JsonResponse({
+        'policy': getattr(settings, 'VM_PLACEMENT_POLICY', 'least-loaded'),
+        'clusters': [capacity.as_dict() for capacity in capacities],
+    })
+
+
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def site_pool(request):
+    """Depth, target, demand and build times of the pool of preallocated sites of each server type"""
+    return JsonResponse({
+        'max_concurrent_builds': getattr(settings, 'POOL_MAX_CONCURRENT_BUILDS', 4),
+        'pools': [status.as_dict() for status in pool_status()],
+    })
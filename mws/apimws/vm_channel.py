@@ -0,0 +1,150 @@
+"""
+Persistent channels to the VM API of the Xen hosts.
+
+Instead of executing VM_END_POINT_COMMAND once per request, which opens a new connection to the host and starts
+vmmanager every time, a channel executes ``VM_END_POINT_COMMAND <host> serve`` once and keeps it running. Requests
+are sent as JSON lines with an id, vmmanager executes them concurrently and answers with JSON lines carrying the id
+of the request, so several requests from different threads can be in flight on the same channel.
+
+Channels are kept per host in each worker process and are reopened if the command exits.
+
+"""
+import copy
+import itertools
+import json
+import logging
+import os
+import subprocess
+import threading
+from django.conf import settings
+
+
+LOGGER = logging.getLogger('mws')
+
+
+class VMAPIChannelError(Exception):
+    """The channel failed (the command exited or did not answer in time), the request may not have been executed"""
+    pass
+
+
+class VMAPIChannelUnavailable(VMAPIChannelError):
+    """The channel could not be used, the request was not sent"""
+    pass
+
+
+class VMAPIRequestError(Exception):
+    """vmmanager executed the request and reported an error"""
+    pass
+
+
+class PendingRequest(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+
+class VMAPIChannel(object):
+    """A persistent VM API command for a host"""
+
+    def __init__(self, host):
+        self.host = host
+        self.command = copy.copy(settings.VM_END_POINT_COMMAND) + [host, 'serve']
+        try:
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            close_fds=True)
+        except OSError as e:
+            raise VMAPIChannelUnavailable("Cannot open the VM API channel to %s: %s" % (host, e))
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_responses, name="vmapi-%s" % host)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_responses(self):
+        for line in iter(self.process.stdout.readline, b''):
+            try:
+                response = json.loads(line)
+                pending = self.pending.pop(response['id'])
+            except (ValueError, KeyError, TypeError):
+                LOGGER.error("Unexpected response from the VM API channel to %s: %s", self.host, line)
+                continue
+            pending.response = response
+            pending.event.set()
+        self.close()
+
+    def request(self, command, parameters, timeout=None):
+        """
+        Sends a request and waits for its response.
+
+        :return: the output of the command, the same that executing VM_END_POINT_COMMAND would have returned
+        :raises VMAPIRequestError: if vmmanager reported an error executing the command
+        :raises VMAPIChannelError: if the channel failed
+        """
+        pending = PendingRequest()
+        with self.lock:
+            if self.closed:
+                raise VMAPIChannelUnavailable("The VM API channel to %s is closed" % self.host)
+            request_id = next(self.ids)
+            self.pending[request_id] = pending
+            try:
+                self.process.stdin.write(json.dumps({'id': request_id, 'command': command,
+                                                     'parameters': parameters}) + "\n")
+                self.process.stdin.flush()
+            except (IOError, OSError) as e:
+                self.pending.pop(request_id, None)
+                raise VMAPIChannelUnavailable("Cannot write to the VM API channel to %s: %s" % (self.host, e))
+        if not pending.event.wait(timeout):
+            self.pending.pop(request_id, None)
+            raise VMAPIChannelError("The VM API channel to %s did not answer in %s seconds" % (self.host, timeout))
+        if pending.response is None:
+            raise VMAPIChannelError("The VM API channel to %s was closed" % self.host)
+        if 'error' in pending.response:
+            raise VMAPIRequestError(pending.response['error'])
+        return pending.response.get('output', '')
+
+    def close(self):
+        """Closes the channel, requests in flight fail with VMAPIChannelError"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = self.pending.values()
+            self.pending = {}
+        for request in pending:
+            request.event.set()
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+_channels = {}
+_channels_lock = threading.Lock()
+_channels_pid = None
+
+
+def get_channel(host):
+    """Returns the open channel to a host of this process, opening a new one if needed"""
+    global _channels_pid
+    with _channels_lock:
+        if _channels_pid != os.getpid():
+            # Channels are not shared with forked processes (e.g. celery worker processes)
+            _channels.clear()
+            _channels_pid = os.getpid()
+        channel = _channels.get(host)
+        if channel is None or channel.closed:
+            LOGGER.info("Opening a VM API channel to %s", host)
+            channel = _channels[host] = VMAPIChannel(host)
+        return channel
+
+
+def close_channels():
+    """Closes all the channels of this process"""
+    with _channels_lock:
+        channels = _channels.values()
+        _channels.clear()
+    for channel in channels:
+        channel.close()
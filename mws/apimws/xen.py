@@ -1,23 +1,36 @@
 from __future__ import absolute_import
 import copy
 import logging
+import math
 import uuid
 import json
 import subprocess
-from celery import shared_task, Task
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from celery import shared_task, Task, chain, chord, group
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from apimws.ansible import launch_ansible
-from apimws.ipreg import set_sshfp
-from apimws.models import Cluster
+from apimws.ipreg import IPRegBatch, IPRegFailure
+from apimws.locks import task_lock, LockNotAcquired
+from apimws.models import Cluster, ProvisioningStage
+from apimws.placement import place_vm, site_requirements
+from apimws.host_health import ordered_hosts, record_success, record_failure
+from apimws.process import run_command, CommandTimeout
+from apimws.provisioning import ProvisioningTask, provisioning_stage
+from apimws.vm_channel import get_channel, VMAPIRequestError, VMAPIChannelError, VMAPIChannelUnavailable
 from apimws.views import post_installation, post_recreate
 from libs.sshpubkey import SSHPubKey
-from mws.celery import app
 from sitesmanagement.models import VirtualMachine, NetworkConfig, SiteKey, Vhost, DomainName
 
 
 LOGGER = logging.getLogger('mws')
 
+# Exit status of ssh when the connection to the host fails
+SSH_CONNECTION_ERROR = 255
+
 
 class VMAPINotWorkingException(Exception):
     pass
@@ -31,20 +44,152 @@ class VMAPIFailure(Exception):
     pass
 
 
+class VMAPIHostUnavailable(VMAPIFailure):
+    """The host could not be contacted, the request was not executed and can be sent to another host"""
+    pass
+
+
+class VMAPIHostTimeout(VMAPIFailure):
+    """The host did not answer in time, the request may have been executed"""
+    pass
+
+
 def vm_api_request(command, parameters, vm):
+    hosts = ordered_hosts(vm.cluster)
+    response, attempts = vm_api_failover_request(command, parameters, [host.hostname for host in hosts])
+    record_attempts(hosts, attempts)
+    if isinstance(response, Exception):
+        raise response
+    return response
+
+
+def vm_api_failover_request(command, parameters, hostnames):
+    """
+    Sends a request to the first host that can be contacted. It does not access the database so that it can be
+    used from several threads.
+
+    :return: the response (or the VMAPIFailure raised) and the list of (hostname, seconds, host failed) attempts
+    """
+    attempts = []
+    for hostname in hostnames:
+        start = time.time()
+        try:
+            response = vm_api_host_request(command, parameters, hostname)
+        except VMAPIHostUnavailable:
+            attempts.append((hostname, time.time() - start, True))
+            LOGGER.warning("The VM API of the host %s is unavailable, trying the next host", hostname)
+            continue
+        except VMAPIHostTimeout as e:
+            attempts.append((hostname, time.time() - start, True))
+            return e, attempts
+        except VMAPIFailure as e:
+            # The host answered, the command failed
+            attempts.append((hostname, time.time() - start, False))
+            return e, attempts
+        attempts.append((hostname, time.time() - start, False))
+        return response, attempts
+    return VMAPIHostUnavailable("No host could be contacted among %s" % ", ".join(hostnames)), attempts
+
+
+def record_attempts(hosts, attempts):
+    """Updates the health of the hosts with the result of the attempts made by vm_api_failover_request"""
+    hosts = dict((host.hostname, host) for host in hosts)
+    for hostname, elapsed, failed in attempts:
+        if failed:
+            record_failure(hosts[hostname])
+        else:
+            record_success(hosts[hostname], elapsed)
+
+
+def vm_api_host_request(command, parameters, host):
+    if getattr(settings, 'VM_API_CHANNEL', False):
+        return vm_api_channel_request(command, parameters, host)
     api_command = copy.copy(settings.VM_END_POINT_COMMAND)
-    api_command.append(vm.cluster.hosts.first().hostname)
+    api_command.append(host)
     api_command.append(command)
-    api_command.append("'%s'" % json.dumps(parameters))
+    if parameters is not None:
+        # Commands without parameters, such as list, are sent without the JSON argument
+        api_command.append("'%s'" % json.dumps(parameters))
     try:
-        response = subprocess.check_output(api_command, stderr=subprocess.STDOUT)
+        response = run_command(api_command, timeout=getattr(settings, 'VM_API_TIMEOUT', 900), max_lines=0)
         LOGGER.info("VM API request: %s\nVM API response: %s", api_command, response)
+    except CommandTimeout as e:
+        LOGGER.error("VM API request: %s\nVM API response: %s", api_command, e)
+        raise VMAPIHostTimeout()
     except subprocess.CalledProcessError as e:
         LOGGER.error("VM API request: %s\nVM API response: %s", api_command, e.output)
+        if e.returncode == SSH_CONNECTION_ERROR:
+            raise VMAPIHostUnavailable()
         raise VMAPIFailure()
+    except OSError as e:
+        LOGGER.error("VM API request: %s\nThe command cannot be executed: %s", api_command, e)
+        raise VMAPIHostUnavailable()
     return response
 
 
+def vm_api_channel_request(command, parameters, host):
+    """Sends the request through the persistent VM API channel to the host (see apimws.vm_channel)"""
+    try:
+        response = get_channel(host).request(command, parameters, timeout=getattr(settings, 'VM_API_TIMEOUT', 900))
+        LOGGER.info("VM API request to %s: %s %s\nVM API response: %s", host, command, parameters, response)
+    except VMAPIRequestError as e:
+        LOGGER.error("VM API request to %s: %s %s\nVM API response: %s", host, command, parameters, e)
+        raise VMAPIFailure()
+    except VMAPIChannelUnavailable as e:
+        LOGGER.error("VM API request to %s: %s %s\nVM API response: %s", host, command, parameters, e)
+        raise VMAPIHostUnavailable()
+    except VMAPIChannelError as e:
+        LOGGER.error("VM API request to %s: %s %s\nVM API response: %s", host, command, parameters, e)
+        raise VMAPIHostTimeout()
+    return response
+
+
+def vm_api_batch(operations):
+    """
+    Executes VM API operations grouped per Xen cluster: each cluster receives a single batch request with its
+    operations, sent to one of its hosts, and the clusters are contacted in parallel.
+
+    :param operations: list of (vm, command, parameters)
+    :return: list with the result of each operation in the same order, its output or a VMAPIFailure if it failed
+    """
+    batches = OrderedDict()
+    hosts = {}
+    for index, (vm, command, parameters) in enumerate(operations):
+        if vm.cluster_id not in hosts:
+            hosts[vm.cluster_id] = ordered_hosts(vm.cluster)
+        batches.setdefault(vm.cluster_id, []).append((index, {'command': command, 'parameters': parameters}))
+
+    def run_batch(cluster):
+        return vm_api_failover_request('batch', [operation for _, operation in batches[cluster]],
+                                       [host.hostname for host in hosts[cluster]])
+
+    results = [None] * len(operations)
+    if not batches:
+        return results
+    pool = ThreadPool(min(len(batches), getattr(settings, 'VM_API_BATCH_MAX_HOSTS', 8)))
+    try:
+        responses = pool.map(run_batch, list(batches))
+    finally:
+        pool.close()
+        pool.join()
+    for cluster, (response, attempts) in zip(batches, responses):
+        # The health of the hosts is updated from this thread, the one with access to the database
+        record_attempts(hosts[cluster], attempts)
+        try:
+            if isinstance(response, Exception):
+                raise response
+            cluster_results = [VMAPIFailure(result['error']) if 'error' in result else result.get('output', '')
+                               for result in json.loads(response)]
+        except VMAPIFailure as e:
+            cluster_results = [e] * len(batches[cluster])
+        except ValueError:
+            cluster_results = [VMAPIFailure("The batch request to the cluster %s failed" % cluster)] * \
+                len(batches[cluster])
+        for (index, _), result in zip(batches[cluster], cluster_results):
+            results[index] = result
+    return results
+
+
 class XenWithFailure(Task):
     abstract = True
     def on_failure(self, exc, task_id, args, kwargs, einfo):
@@ -57,16 +202,66 @@ class XenWithFailure(Task):
                          "The parameters passed to the task were: %s\n\n The traceback is: \n %s", task_id, args, einfo)
 
 
-def secrets_prealocation_vm(vm):
-    # Gets all the keys generated for the site and generates the fingerprint and the SSHFP from them
-    # It sends the SSHFP record to ip-register
-    service = vm.service
+def vm_create_parameters(vm, callback_view, os=None):
+    """Parameters of the VM API create request of a VM"""
+    network_configuration = vm.network_configuration
+    netconf = {}
+    if network_configuration.IPv4:
+        netconf["IPv4"] = network_configuration.IPv4
+    if network_configuration.IPv6:
+        netconf["IPv6"] = network_configuration.IPv6
+    if network_configuration.name:
+        netconf["hostname"] = network_configuration.name
+    parameters = {
+        "site-id": "mwssite-%d" % vm.service.site.id,
+        "netconf": netconf,
+        "features": {
+            "cpu": vm.numcpu,
+            "ram": vm.sizeram*1024,
+            "disk": vm.service.site.type.sizedisk,
+        },
+        "callback": {
+            "endpoint": "%s%s" % (settings.MAIN_DOMAIN, reverse(callback_view)),
+            "vm_id": vm.id,
+            "secret": str(vm.token),
+        },
+    }
+    if os:
+        parameters["os"] = os
+    return parameters
+
+
+@shared_task(base=ProvisioningTask, max_retries=3)
+def vm_api_create(vm_id, parameters):
+    """Provisioning stage that requests the creation of the VM to the VM API. It is only retried if the request
+    could not be sent, otherwise the VM could be created twice."""
+    vm = VirtualMachine.objects.get(pk=vm_id)
+    with provisioning_stage(vm_api_create, vm, "create", retry_on=(VMAPIHostUnavailable, )):
+        response = vm_api_request(command='create', parameters=parameters, vm=vm)
+        try:
+            jresponse = json.loads(response)
+        except ValueError as e:
+            LOGGER.error("VM API response is not properly formated: %s", response)
+            vm.name = vm.network_configuration.name
+            vm.save()
+            raise e
+        if isinstance(jresponse, dict) and 'vmid' in jresponse:
+            vm.name = jresponse['vmid']
+        else:
+            vm.name = vm.network_configuration.name
+        vm.save()
+    return vm.name
+
 
-    for keytype in SiteKey.ALGORITHMS:
+@shared_task(base=ProvisioningTask, max_retries=5)
+def fetch_site_key(vm_id, keytype):
+    """Provisioning stage that gets a host key generated for the site, stores it and returns its SSHFP fingerprint"""
+    vm = VirtualMachine.objects.get(pk=vm_id)
+    site = vm.service.site
+    with provisioning_stage(fetch_site_key, vm, "key %s" % keytype, retry_on=(ValueError, OSError, KeyError)):
         p = subprocess.Popen(["userv", "mws-admin", "mws_pubkey"], stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate(json.dumps({"id": "mwssite-%d" % service.site.id,
-                                                   "keytype": "ssh"+keytype.lower()}))
+        stdout, stderr = p.communicate(json.dumps({"id": "mwssite-%d" % site.id, "keytype": "ssh"+keytype.lower()}))
         try:
             result = json.loads(stdout)
         except ValueError as e:
@@ -74,90 +269,96 @@ def secrets_prealocation_vm(vm):
             raise e
 
         pubkey = SSHPubKey(result["pubkey"])
-
-        SiteKey.objects.get_or_create(site=service.site, type=keytype, 
+        SiteKey.objects.get_or_create(site=site, type=keytype,
                                       defaults={
-                                          'public_key': result["pubkey"], 
+                                          'public_key': result["pubkey"],
                                           'fingerprint': pubkey.hash_md5(),
                                           'fingerprint2': pubkey.hash_sha256()
                                       })
+    return keytype, pubkey.sshfp_sha256()
 
-        for fptype in SiteKey.FP_TYPES:
-            if not fptype == "SHA1":
-                try:
-                    if fptype == "SHA256":
-                        fp = pubkey.sshfp_sha256()
-                    else:
-                        raise Exception("fptype %s is not supported" % fptype)
-                    set_sshfp(service.network_configuration.name, SiteKey.ALGORITHMS[keytype],
-                              SiteKey.FP_TYPES[fptype], fp)
-                    set_sshfp(service.site.test_service.network_configuration.name, SiteKey.ALGORITHMS[keytype],
-                              SiteKey.FP_TYPES[fptype], fp)
-                    set_sshfp(vm.network_configuration.name, SiteKey.ALGORITHMS[keytype], SiteKey.FP_TYPES[fptype],
-                              fp)
-                except Exception as e:
-                    LOGGER.error("Error while trying to set up sshfp records. \nkeytype: %s\nfptype: %s\nexception: %s"
-                                 % (keytype, fptype, str(e.__class__)+" "+str(e)))
-                    pass
 
+@shared_task(base=ProvisioningTask, max_retries=5)
+def publish_site_sshfp(fingerprints, vm_id):
+    """Provisioning stage that receives the fingerprints of all the host keys of the site and publishes them as SSHFP
+    records of the VM and of both services, all of them with a single IPREG batch. The stage is retried if IPREG
+    cannot be invoked, the records that IPREG rejects are only logged and do not fail the stage."""
+    vm = VirtualMachine.objects.get(pk=vm_id)
+    site = vm.service.site
+    hostnames = [site.production_service.network_configuration.name,
+                 site.test_service.network_configuration.name,
+                 vm.network_configuration.name]
+    with provisioning_stage(publish_site_sshfp, vm, "sshfp",
+                            retry_on=(subprocess.CalledProcessError, OSError, ValueError)) as stage:
+        batch = IPRegBatch()
+        for keytype, fingerprint in fingerprints:
+            for hostname in hostnames:
+                batch.set_sshfp(hostname, SiteKey.ALGORITHMS[keytype], SiteKey.FP_TYPES["SHA256"], fingerprint)
+        failure = None
+        try:
+            batch.execute()
+        except IPRegFailure as failure:
+            LOGGER.error("Some SSHFP records of the VM %s could not be published: %s", vm_id, failure)
+    if failure:
+        # The stage is done, the rejected records are kept as its error
+        ProvisioningStage.objects.filter(pk=stage.pk).update(error=str(failure))
 
-@shared_task(base=XenWithFailure)
-def new_site_primary_vm(service, host_network_configuration=None):
-    parameters = {}
-    parameters["site-id"] = "mwssite-%d" % service.site.id
-    parameters["os"] = getattr(settings, 'OS_VERSION', "stretch")
-
-    if host_network_configuration:
-        netconf = {}
-        if host_network_configuration.IPv4:
-            netconf["IPv4"] = host_network_configuration.IPv4
-        if host_network_configuration.IPv6:
-            netconf["IPv6"] = host_network_configuration.IPv6
-        if host_network_configuration.name:
-            netconf["hostname"] = host_network_configuration.name
-        vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
-    else:
-        raise AttributeError("No host network configuration")
 
-    parameters["features"] = {
-        "cpu": vm.numcpu,
-        "ram": vm.sizeram*1024,
-        "disk": service.site.type.sizedisk,
-    }
+def secrets_prealocation_vm(vm):
+    """
+    Returns the stages that get all the keys generated for the site, in parallel, and then generate the SSHFP
+    records from them and send them to ip-register.
 
-    parameters["netconf"] = netconf
-    parameters["callback"] = {
-        "endpoint": "%s%s" % (settings.MAIN_DOMAIN, reverse(post_installation)),
-        "vm_id": vm.id,
-        "secret": str(vm.token),
-    }
+    The VM does not need these stages to be created and configured, so they are started next to the pipeline that
+    creates it rather than in it: their failure is recorded in their ProvisioningStage but does not stop the
+    provisioning of the VM.
+    """
+    return chord(group(fetch_site_key.si(vm.id, keytype) for keytype in sorted(SiteKey.ALGORITHMS)),
+                 publish_site_sshfp.s(vm.id))
 
-    service.status = 'installing'
-    service.save()
 
-    response = vm_api_request(command='create', parameters=parameters, vm=vm)
+@shared_task(base=ProvisioningTask)
+def finish_test_vm(vm_id):
+    """Provisioning stage that copies the configuration of the production service to the new test service and
+    launches ansible on both"""
+    vm = VirtualMachine.objects.get(pk=vm_id)
+    site = vm.service.site
+    with provisioning_stage(finish_test_vm, vm, "configure"):
+        # PHPLibs
+        for phplib in site.production_service.php_libs.all():
+            phplib.services.add(site.test_service)
+
+        # Call Ansible to update the state of the machine
+        launch_ansible(site.production_service)
+        launch_ansible(site.test_service)
+    return True
 
-    try:
-        jresponse = json.loads(response)
-    except ValueError as e:
-        LOGGER.error("VM API response is not properly formated: %s", response)
-        vm.name = vm.network_configuration.name
-        vm.save()
-        raise e
 
-    try:
-        if 'vmid' in jresponse:
-            vm.name = jresponse['vmid']
-        else:
-            vm.name = vm.network_configuration.name
-    except Exception as e:
-        vm.name = vm.network_configuration.name
-    vm.save()
+def start_pipeline(pipeline):
+    """Starts the stages once the VM they refer to has been committed to the database"""
+    transaction.on_commit(lambda: pipeline.apply_async())
+
+
+def new_vm(service, host_network_configuration, cluster):
+    if not host_network_configuration:
+        raise AttributeError("No host network configuration")
+    vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
+                                       network_configuration=host_network_configuration, cluster=cluster)
+    service.status = 'installing'
+    service.save()
     from apimws.models import AnsibleConfiguration
     AnsibleConfiguration.objects.update_or_create(service=service, key='os',
                                                   defaults={'value': getattr(settings,
                                                                              "OS_VERSION", "stretch")})
+    return vm
+
+
+@shared_task(base=XenWithFailure)
+def new_site_primary_vm(service, host_network_configuration=None, cluster=None):
+    """Creates the VM of a new site in the cluster given, which is chosen with which_cluster if not given"""
+    if cluster is None:
+        cluster = which_cluster(site_requirements(service.site))
+    vm = new_vm(service, host_network_configuration, cluster)
 
     # Create a default Vhost and associate the service name
     default_vhost = Vhost.objects.create(service=service, name="default")
@@ -165,60 +366,43 @@ def new_site_primary_vm(service, host_network_configuration=None):
                                                status="accepted", vhost=default_vhost)
     default_vhost.main_domain = service_domain
     default_vhost.save()
-    secrets_prealocation_vm(vm)
+
+    parameters = vm_create_parameters(vm, post_installation, getattr(settings, 'OS_VERSION', "stretch"))
+    start_pipeline(vm_api_create.si(vm.id, parameters))
+    start_pipeline(secrets_prealocation_vm(vm))
+    return vm.id
 
 
 def recreate_vm(vm_id):
     vm = VirtualMachine.objects.get(pk=vm_id)
     service = vm.service
-    network_configuration = vm.network_configuration
-    parameters = {}
-    parameters["site-id"] = "mwssite-%d" % service.site.id
-    netconf = {}
-    if network_configuration.IPv4:
-        netconf["IPv4"] = network_configuration.IPv4
-    if network_configuration.IPv6:
-        netconf["IPv6"] = network_configuration.IPv6
-    if network_configuration.name:
-        netconf["hostname"] = network_configuration.name
     os = vm.service.ansible_configuration.filter(key='os')
-    if os:
-        parameters["os"] = os[0].value
-    parameters["netconf"] = netconf
-
-    parameters["features"] = {
-        "cpu": vm.numcpu,
-        "ram": vm.sizeram*1024,
-        "disk": service.site.type.sizedisk,
-    }
-
-    parameters["callback"] = {
-        "endpoint": "%s%s" % (settings.MAIN_DOMAIN, reverse(post_recreate)),
-        "vm_id": vm.id,
-        "secret": str(vm.token),
-    }
+    parameters = vm_create_parameters(vm, post_recreate, os[0].value if os else None)
 
     service.status = 'installing'
     service.save()
 
-    response = vm_api_request(command='create', parameters=parameters, vm=vm)
+    start_pipeline(vm_api_create.si(vm.id, parameters))
 
-    try:
-        jresponse = json.loads(response)
-    except ValueError as e:
-        LOGGER.error("VM API response is not properly formated: %s", response)
-        vm.name = vm.network_configuration.name
-        vm.save()
-        raise e
 
-    try:
-        if 'vmid' in jresponse:
-            vm.name = jresponse['vmid']
-        else:
-            vm.name = vm.network_configuration.name
-    except Exception as e:
-        vm.name = vm.network_configuration.name
-    vm.save()
+def vm_action_lock_ttl():
+    return getattr(settings, 'VM_API_TIMEOUT', 900)
+
+
+def vm_action_lock(vm_id, action):
+    """Lock held while an action is requested to the VM API for a VM so that it is not requested twice at the same
+    time. It expires with the VM API request timeout."""
+    return task_lock("vm-%s-%s" % (vm_id, action), ttl=vm_action_lock_ttl())
+
+
+def retry_locked_vm_action(task, exc):
+    """The same action is being requested for the VM, the request is executed again after it. It is retried until
+    the lock expires, so the request in flight either finishes or times out before giving up."""
+    delay = getattr(settings, 'VM_LOCK_RETRY_DELAY', 5)
+    max_retries = getattr(settings, 'VM_LOCK_MAX_RETRIES', None)
+    if max_retries is None:
+        max_retries = int(math.ceil(float(vm_action_lock_ttl()) / delay)) + 1
+    return task.retry(exc=exc, countdown=delay, max_retries=max_retries)
 
 
 @shared_task(base=XenWithFailure)
@@ -226,26 +410,34 @@ def change_vm_power_state(vm_id, on):
     if on != 'on' and on != 'off':
         raise VMAPIInputException("passed wrong parameter power %s" % on)
     vm = VirtualMachine.objects.get(pk=vm_id)
-    lock = filter(lambda x: x and x['name'] == u'apimws.xen.change_vm_power_state' and
-                            x['args'] == u"(%s, '%s')" % (vm_id, on),
-                  [item for sublist in app.control.inspect().active().values() for item in sublist])
-    if len(lock) == 1:
-        vm_api_request(command='button', parameters={"action": "power%s" % on, "vmid": vm.name}, vm=vm)
-        return True
-    else:
-        return False
+    try:
+        with vm_action_lock(vm_id, "power%s" % on):
+            vm_api_request(command='button', parameters={"action": "power%s" % on, "vmid": vm.name}, vm=vm)
+    except LockNotAcquired as e:
+        raise retry_locked_vm_action(change_vm_power_state, e)
+    return True
 
 
 @shared_task(base=XenWithFailure)
 def reset_vm(vm_id):
-    lock = filter(lambda x: x and x['name'] == u'apimws.xen.reset_vm' and x['args'] == u'(%s,)' % vm_id,
-                  [item for sublist in app.control.inspect().active().values() for item in sublist])
-    if len(lock) == 1:
-        vm = VirtualMachine.objects.get(pk=vm_id)
-        vm_api_request(command='button', vm=vm, parameters={"action": "reboot", "vmid": vm.name})
-        return True
-    else:
-        return False
+    vm = VirtualMachine.objects.get(pk=vm_id)
+    try:
+        with vm_action_lock(vm_id, "reboot"):
+            vm_api_request(command='button', vm=vm, parameters={"action": "reboot", "vmid": vm.name})
+    except LockNotAcquired as e:
+        raise retry_locked_vm_action(reset_vm, e)
+    return True
+
+
+@shared_task(base=XenWithFailure)
+def batch_vm_button(vm_ids, action):
+    """Requests the same power action for many VMs (e.g. a mass reboot), with a single batch request per host"""
+    vms = list(VirtualMachine.objects.filter(pk__in=vm_ids).select_related('cluster').order_by('id'))
+    results = vm_api_batch([(vm, 'button', {"action": action, "vmid": vm.name}) for vm in vms])
+    failed = [vm.name for vm, result in zip(vms, results) if isinstance(result, VMAPIFailure)]
+    if failed:
+        raise VMAPIFailure("The action %s failed for the VMs %s" % (action, ", ".join(failed)))
+    return True
 
 
 @shared_task(base=XenWithFailure)
@@ -258,77 +450,19 @@ def destroy_vm(vm_id):
 @shared_task(base=XenWithFailure)
 def clone_vm_api_call(site):
     service = site.test_service
-    host_network_configuration = NetworkConfig.get_free_host_config()
-    parameters = {}
-    parameters["site-id"] = "mwssite-%d" % service.site.id
-    parameters["os"] = getattr(settings, 'OS_VERSION', "stretch")
-
-    if host_network_configuration:
-        netconf = {}
-        if host_network_configuration.IPv4:
-            netconf["IPv4"] = host_network_configuration.IPv4
-        if host_network_configuration.IPv6:
-            netconf["IPv6"] = host_network_configuration.IPv6
-        if host_network_configuration.name:
-            netconf["hostname"] = host_network_configuration.name
-        vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
-    else:
-        raise AttributeError("No host network configuration")
-
-    parameters["features"] = {
-        "cpu": vm.numcpu,
-        "ram": vm.sizeram*1024,
-        "disk": service.site.type.sizedisk,
-    }
-
-    parameters["netconf"] = netconf
-    parameters["callback"] = {
-        "endpoint": "%s%s" % (settings.MAIN_DOMAIN, reverse(post_installation)),
-        "vm_id": vm.id,
-        "secret": str(vm.token),
-    }
-
-    service.status = 'installing'
-    service.save()
-
-    response = vm_api_request(command='create', parameters=parameters, vm=vm)
-
-    try:
-        jresponse = json.loads(response)
-    except ValueError as e:
-        LOGGER.error("VM API response is not properly formated: %s", response)
-        vm.name = vm.network_configuration.name
-        vm.save()
-        raise e
-
-    try:
-        if 'vmid' in jresponse:
-            vm.name = jresponse['vmid']
-        else:
-            vm.name = vm.network_configuration.name
-    except Exception as e:
-        vm.name = vm.network_configuration.name
-    vm.save()
-    from apimws.models import AnsibleConfiguration
-    AnsibleConfiguration.objects.update_or_create(service=service, key='os',
-                                                  defaults={'value': getattr(settings,
-                                                                             "OS_VERSION", "stretch")})
-    secrets_prealocation_vm(vm)
-
-    # PHPLibs
-    for phplib in site.production_service.php_libs.all():
-        phplib.services.add(site.test_service)
-
-    # Call Ansible to update the state of the machine
-    launch_ansible(site.production_service)
-    launch_ansible(site.test_service)
-
+    # The cluster is chosen first so that no network configuration is allocated if there is no capacity left
+    cluster = which_cluster(site_requirements(site))
+    vm = new_vm(service, NetworkConfig.get_free_host_config(), cluster)
+    parameters = vm_create_parameters(vm, post_installation, getattr(settings, 'OS_VERSION', "stretch"))
+    start_pipeline(chain(vm_api_create.si(vm.id, parameters), finish_test_vm.si(vm.id)))
+    start_pipeline(secrets_prealocation_vm(vm))
     return True
 
 
-def which_cluster():
-    """This function decides which cluster to use when creating a new VM based on how busy each cluster is.
-    At present we only have one cluster, so the decision algorithm is pretty obvious. Returns a Cluster object.
+def which_cluster(requirements=None):
+    """This function decides which cluster to use when creating a new VM based on the resources still available in
+    each cluster (see apimws.placement). Returns a Cluster object.
     """
-    return Cluster.objects.first()
+    if requirements is None:
+        return Cluster.objects.first()
+    return place_vm(requirements)
@@ -14,6 +14,7 @@ from django.conf import settings
 from django.urls import reverse
 
 from apimws.models import Cluster
+from apimws.placement import place_vm, site_requirements
 from apimws.views import post_installation
 from libs.sshpubkey import SSHPubKey
 from sitesmanagement.models import NetworkConfig, VirtualMachine, SiteKey, Vhost, DomainName
@@ -48,7 +49,7 @@ def secrets_prealocation_vm(vm):
 
 
 @shared_task(base=XenWithFailure)
-def new_site_primary_vm(service, host_network_configuration=None):
+def new_site_primary_vm(service, host_network_configuration=None, cluster=None):
     parameters = {}
     parameters["site-id"] = "mwssite-%d" % service.site.id
     parameters["os"] = getattr(settings, 'OS_VERSION', "jessie")
@@ -62,7 +63,8 @@ def new_site_primary_vm(service, host_network_configuration=None):
         if host_network_configuration.name:
             netconf["hostname"] = host_network_configuration.name
         vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
+                                           network_configuration=host_network_configuration,
+                                           cluster=cluster or which_cluster(site_requirements(service.site)))
     else:
         raise AttributeError("No host network configuration")
 
@@ -108,6 +110,7 @@ def change_vm_power_state(vm_id, on):
 @shared_task(base=XenWithFailure)
 def clone_vm_api_call(site):
     service = site.test_service
+    cluster = which_cluster(site_requirements(site))
     host_network_configuration = NetworkConfig.get_free_host_config()
     parameters = {}
     parameters["site-id"] = "mwssite-%d" % service.site.id
@@ -122,7 +125,8 @@ def clone_vm_api_call(site):
         if host_network_configuration.name:
             netconf["hostname"] = host_network_configuration.name
         vm = VirtualMachine.objects.create(service=service, token=uuid.uuid4(),
-                                           network_configuration=host_network_configuration, cluster=which_cluster())
+                                           network_configuration=host_network_configuration,
+                                           cluster=cluster)
     else:
         raise AttributeError("No host network configuration")
 
@@ -151,11 +155,18 @@ def clone_vm_api_call(site):
     return True
 
 
-def which_cluster():
-    """This function decides which cluster to use when creating a new VM based on how busy each cluster is.
-    At present we only have one cluster, so the decision algorithm is pretty obvious. Returns a Cluster object.
+def which_cluster(requirements=None):
+    """This function decides which cluster to use when creating a new VM based on the resources still available in
+    each cluster (see apimws.placement). Returns a Cluster object.
     """
-    return Cluster.objects.first()
+    if requirements is None:
+        return Cluster.objects.first()
+    return place_vm(requirements)
+
+@shared_task(base=XenWithFailure)
+def batch_vm_button(vm_ids, action):
+    return True
+
 
 @shared_task(base=XenWithFailure)
 def destroy_vm(vm_id):
@@ -1,8 +1,8 @@
 from __future__ import absolute_import
 from celery import Celery
 
-# to launch the celery worker use the following command line:
-# DJANGO_SETTINGS_MODULE='mws.(production_)settings' celery -A mws worker -l info -B
+# to launch the celery workers use the following command lines, one per profile in CELERY_WORKER_PROFILES:
+# DJANGO_SETTINGS_MODULE='mws.(production_)settings' ./manage.py run_worker interactive|provisioning|scheduled
 
 app = Celery('mws')
 
@@ -1,6 +1,7 @@
 import os
 from django.conf import global_settings
 import dns.resolver
+from mws import task_routing
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -161,9 +162,26 @@ NEXT_OS = 'stretch'
 
 FINANCE_EMAIL = 'finance@uis.cam.ac.uk'
 
-CELERY_IMPORTS = ('apimws.xen', 'apimws.utils', 'apimws.jackdaw', 'apimws.ansible',
+CELERY_IMPORTS = ('apimws.xen', 'apimws.utils', 'apimws.jackdaw', 'apimws.ansible', 'apimws.inventory',
                   'sitesmanagement.cronjobs', 'apimws.ipreg')
 IP_REG_API_END_POINT = ['userv', 'mws-admin', 'mws_ipreg']
+# Send the IPREG changes that go together with a single "batch" call, only once mws_ipreg supports it
+IP_REG_BATCH = False
+
+# Tasks are sent to separate queues, see mws/task_routing.py
+CELERY_QUEUES = task_routing.QUEUES
+CELERY_DEFAULT_QUEUE = task_routing.DEFAULT_QUEUE
+CELERY_ROUTES = ('mws.task_routing.TaskRouter', )
+# Workers only reserve the task they are executing, so that priorities are respected
+CELERYD_PREFETCH_MULTIPLIER = 1
+# Workers started with the run_worker management command: queues consumed, number of processes and whether the
+# worker also runs celery beat
+CELERY_WORKER_PROFILES = {
+    'interactive': {'queues': [task_routing.INTERACTIVE_QUEUE], 'concurrency': 8},
+    'provisioning': {'queues': [task_routing.PROVISIONING_QUEUE], 'concurrency': 4},
+    'scheduled': {'queues': [task_routing.SCHEDULED_QUEUE, task_routing.DEFAULT_QUEUE], 'concurrency': 2,
+                  'beat': True},
+}
 
 # Maximum length of time which a domain can remain unapproved.
 MWS_DOMAIN_NAME_GRACE_DAYS = 30
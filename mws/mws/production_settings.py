@@ -40,6 +40,19 @@ hAM+a6/30F5fdkWpE1smPyrfASyXRfWE4Ccn1RVgYX9u
 """}
 
 BROKER_URL = 'redis://localhost:6379/0'
+# Enables the message priorities (0 to 9) of the redis transport
+BROKER_TRANSPORT_OPTIONS = {'priority_steps': list(range(10))}
+# The chords of the provisioning pipeline (see apimws.provisioning) need the results of their tasks
+CELERY_RESULT_BACKEND = 'redis://localhost:6379/1'
+CELERY_TASK_RESULT_EXPIRES = 24*60*60  # 1 day
+# Cache shared by the web server and the celery workers, e.g. for the IPREG nameinfo cache (see apimws.ipreg), its
+# table is created by the apimws migrations
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'mws_cache',
+    }
+}
 CELERYD_TASK_SOFT_TIME_LIMIT = 120*60  # 2 hours
 CELERYD_TASK_TIME_LIMIT = 180*60  # 3 hours
 CELERYBEAT_SCHEDULE = {
@@ -70,7 +83,12 @@ CELERYBEAT_SCHEDULE = {
     },
     'check_num_preallocated_sites': {
         'task': 'sitesmanagement.cronjobs.check_num_preallocated_sites',
-        'schedule': crontab(hour=3, minute=25),
+        'schedule': timedelta(minutes=10),
+        'args': ()
+    },
+    'reconcile_fleet': {
+        'task': 'sitesmanagement.cronjobs.reconcile_fleet',
+        'schedule': timedelta(minutes=15),
         'args': ()
     },
     'send_warning_last_or_none_admin': {
@@ -83,9 +101,9 @@ CELERYBEAT_SCHEDULE = {
         'schedule': crontab(hour=7, minute=25),
         'args': ()
     },
-    'validate_domains': {
-        'task': 'sitesmanagement.cronjobs.validate_domains',
-        'schedule': crontab(hour=0, minute=55),
+    'revalidate_domains': {
+        'task': 'sitesmanagement.cronjobs.revalidate_domains',
+        'schedule': timedelta(minutes=5),
         'args': ()
     },
     'expire_domains': {
@@ -103,6 +121,16 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(minutes=30),
         'args': ()
     },
+    'refresh_inventory_snapshot': {
+        'task': 'apimws.inventory.refresh_inventory_snapshot',
+        'schedule': timedelta(hours=1),
+        'kwargs': {'force': True}
+    },
+    'refresh_lookup_group_members': {
+        'task': 'sitesmanagement.cronjobs.refresh_lookup_group_members',
+        'schedule': timedelta(hours=1),
+        'args': ()
+    },
 }
 
 MIDDLEWARE_CLASSES += (
@@ -112,6 +140,14 @@ MIDDLEWARE_CLASSES += (
 VM_END_POINT_COMMAND = ["userv", "mws-admin", "mws_xen_vm_api"]
 VM_API = "apimws.xen"
 
+# Materialized ansible inventory served by scripts/mws_inventory.py
+MWS_INVENTORY_SNAPSHOT = os.path.join(ROOT_DIR, 'inventory.json')
+# Revision of the ansible playbooks, written when they are deployed. The ansible runs of VMs whose configuration has
+# not changed are only skipped if it is known
+ANSIBLE_REVISION_FILE = os.path.join(ROOT_DIR, 'ansible_revision')
+# The output of the ansible runs is streamed to a file per host in this directory, to follow their progress
+ANSIBLE_LOG_DIR = '/var/log/mws/ansible'
+
 EMAIL_TIMEOUT = 60
 
 IP_REG_API_END_POINT = IP_REG_API_END_POINT + ['live']
@@ -40,6 +40,19 @@ hAM+a6/30F5fdkWpE1smPyrfASyXRfWE4Ccn1RVgYX9u
 """}
 
 BROKER_URL = 'redis://localhost:6379/0'
+# Enables the message priorities (0 to 9) of the redis transport
+BROKER_TRANSPORT_OPTIONS = {'priority_steps': list(range(10))}
+# The chords of the provisioning pipeline (see apimws.provisioning) need the results of their tasks
+CELERY_RESULT_BACKEND = 'redis://localhost:6379/1'
+CELERY_TASK_RESULT_EXPIRES = 24*60*60  # 1 day
+# Cache shared by the web server and the celery workers, e.g. for the IPREG nameinfo cache (see apimws.ipreg), its
+# table is created by the apimws migrations
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'mws_cache',
+    }
+}
 CELERYD_TASK_SOFT_TIME_LIMIT = 4*60*60  # 4 hours
 CELERYD_TASK_TIME_LIMIT = 5*60*60  # 5 hours
 CELERYBEAT_SCHEDULE = {
@@ -68,6 +81,16 @@ CELERYBEAT_SCHEDULE = {
         'schedule': crontab(hour=1, minute=5),
         'args': ()
     },
+    'refresh_inventory_snapshot': {
+        'task': 'apimws.inventory.refresh_inventory_snapshot',
+        'schedule': timedelta(hours=1),
+        'kwargs': {'force': True}
+    },
+    'refresh_lookup_group_members': {
+        'task': 'sitesmanagement.cronjobs.refresh_lookup_group_members',
+        'schedule': timedelta(hours=1),
+        'args': ()
+    },
 }
 
 MIDDLEWARE_CLASSES += (
@@ -76,6 +99,13 @@ MIDDLEWARE_CLASSES += (
 
 VM_END_POINT_COMMAND = ["userv", "mws-admin", "mws_xen_vm_api"]
 VM_API = "apimws.xen"
+# VM_API_CHANNEL (a persistent VM API channel to each host) stays off until mws_xen_vm_api accepts "serve"
+
+# Materialized ansible inventory served by scripts/mws_inventory.py
+MWS_INVENTORY_SNAPSHOT = os.path.join(ROOT_DIR, 'inventory.json')
+# Revision of the ansible playbooks, written when they are deployed. The ansible runs of VMs whose configuration has
+# not changed are only skipped if it is known
+ANSIBLE_REVISION_FILE = os.path.join(ROOT_DIR, 'ansible_revision')
 
 EMAIL_TIMEOUT = 60
 
@@ -0,0 +1,101 @@
+"""
+Routing of the celery tasks to separate queues, so that long running work (ansible runs, VM installations) and
+scheduled sweeps (domain validation, reminders) do not delay the short tasks requested by users (power changes,
+emails, DNS registrations).
+
+Each queue is consumed by its own worker, started with the run_worker management command using one of the
+profiles of the CELERY_WORKER_PROFILES setting::
+
+    ./manage.py run_worker interactive
+    ./manage.py run_worker provisioning
+    ./manage.py run_worker scheduled
+
+"""
+from kombu import Queue
+
+
+# Queue of the tasks not listed below
+DEFAULT_QUEUE = 'celery'
+
+# Short tasks requested by users
+INTERACTIVE_QUEUE = 'interactive'
+
+# Long running ansible and VM API work
+PROVISIONING_QUEUE = 'provisioning'
+
+# Periodic tasks launched by celery beat
+SCHEDULED_QUEUE = 'scheduled'
+
+QUEUES = (
+    Queue(DEFAULT_QUEUE, routing_key=DEFAULT_QUEUE),
+    Queue(INTERACTIVE_QUEUE, routing_key=INTERACTIVE_QUEUE),
+    Queue(PROVISIONING_QUEUE, routing_key=PROVISIONING_QUEUE),
+    Queue(SCHEDULED_QUEUE, routing_key=SCHEDULED_QUEUE),
+)
+
+# Message priorities, with the redis transport 0 is the highest priority
+USER_PRIORITY = 0
+BULK_PRIORITY = 9
+
+# Tasks are matched by their name without the module, so that the same routes apply to the implementations and to
+# the mocks used in development (e.g. apimws.xen and apimws.xen_mock)
+TASK_QUEUES = {
+    # VM power and email tasks
+    'change_vm_power_state': INTERACTIVE_QUEUE,
+    'reset_vm': INTERACTIVE_QUEUE,
+    'send_email_confirmation': INTERACTIVE_QUEUE,
+    'finished_installation_email_confirmation': INTERACTIVE_QUEUE,
+    'domain_confirmation_user': INTERACTIVE_QUEUE,
+    'ip_register_api_request': INTERACTIVE_QUEUE,
+    'delete_cname': INTERACTIVE_QUEUE,
+    'ip_reg_batch': INTERACTIVE_QUEUE,
+    'remove_supporter': INTERACTIVE_QUEUE,
+    'wait_for_ssh': INTERACTIVE_QUEUE,
+    # ansible and VM API
+    'launch_ansible_async': PROVISIONING_QUEUE,
+    'launch_ansible_batch': PROVISIONING_QUEUE,
+    'ansible_change_mysql_root_pwd': PROVISIONING_QUEUE,
+    'ansible_create_custom_snapshot': PROVISIONING_QUEUE,
+    'restore_snapshot': PROVISIONING_QUEUE,
+    'delete_snapshot': PROVISIONING_QUEUE,
+    'delete_vhost_ansible': PROVISIONING_QUEUE,
+    'vhost_enable_apache_owned': PROVISIONING_QUEUE,
+    'vhost_disable_apache_owned': PROVISIONING_QUEUE,
+    'new_site_primary_vm': PROVISIONING_QUEUE,
+    'clone_vm_api_call': PROVISIONING_QUEUE,
+    'vm_api_create': PROVISIONING_QUEUE,
+    'fetch_site_key': PROVISIONING_QUEUE,
+    'publish_site_sshfp': PROVISIONING_QUEUE,
+    'finish_test_vm': PROVISIONING_QUEUE,
+    'destroy_vm': PROVISIONING_QUEUE,
+    'batch_vm_button': PROVISIONING_QUEUE,
+    'post_installOS': PROVISIONING_QUEUE,
+    # periodic tasks outside sitesmanagement.cronjobs
+    'jackdaw_api': SCHEDULED_QUEUE,
+    'refresh_inventory_snapshot': SCHEDULED_QUEUE,
+}
+
+# Priority used when the caller does not give one. Tasks in the provisioning queue are mostly requested by users,
+# callers launching them in bulk pass BULK_PRIORITY so that they are consumed after the ones requested by users.
+QUEUE_PRIORITIES = {
+    INTERACTIVE_QUEUE: USER_PRIORITY,
+    PROVISIONING_QUEUE: USER_PRIORITY,
+    SCHEDULED_QUEUE: BULK_PRIORITY,
+}
+
+
+def task_queue(name):
+    """Returns the queue where the task with the given name is sent"""
+    if name.startswith('sitesmanagement.cronjobs.'):
+        return SCHEDULED_QUEUE
+    return TASK_QUEUES.get(name.rsplit('.', 1)[-1], DEFAULT_QUEUE)
+
+
+class TaskRouter(object):
+    """Celery router (see the CELERY_ROUTES setting) that sends each task to its queue"""
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        queue = task_queue(task)
+        if queue == DEFAULT_QUEUE:
+            return None
+        return {'queue': queue, 'routing_key': queue, 'priority': QUEUE_PRIORITIES[queue]}
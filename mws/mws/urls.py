@@ -84,6 +84,9 @@ urlpatterns = [
     url(r'^api/finance/billing/$', apimws.views.billing_total, name='apimws.views.billing_total'),
     url(r'^api/finance/billing/(?P<year>20[0-9]{2})/(?P<month>[0-9]{1,2})/$', apimws.views.billing_month, name='apimws.views.billing_month'),
     url(r'^confirm_email/(?P<ec_id>[0-9]+)/(?P<token>(\w|\-)+)/$', apimws.views.confirm_email, name='apimws.views.confirm_email'),
+    url(r'^api/ansible/stats/$', apimws.views.ansible_run_stats, name='apimws.views.ansible_run_stats'),
+    url(r'^api/clusters/capacity/$', apimws.views.cluster_capacity, name='apimws.views.cluster_capacity'),
+    url(r'^api/pool/$', apimws.views.site_pool, name='apimws.views.site_pool'),
     url(r'^api/post_installation/$', apimws.views.post_installation, name='apimws.views.post_installation'),
     url(r'^api/post_recreate/$', apimws.views.post_recreate, name='apimws.views.post_recreate'),
     url(r'^api/resend_email_confirmation/(?P<site_id>[0-9]+)/$', apimws.views.resend_email_confirmation_view, name='apimws.views.resend_email_confirmation_view'),
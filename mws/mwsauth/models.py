@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from django.db.models.signals import pre_save, post_save
 from django.dispatch import receiver
 from django.db import models
+from ucamlookup.models import LookupGroup
 
 
 class MWSUser(models.Model):
@@ -10,6 +11,16 @@ class MWSUser(models.Model):
     user = models.OneToOneField(User, to_field='username', related_name='mws_user', db_constraint=False)
 
 
+class LookupGroupMember(models.Model):
+    """Local copy of the membership of the Lookup groups used by sites, so that the sites of a user can be found
+    without querying Lookup. It is kept up to date by sitesmanagement.cronjobs.refresh_lookup_group_members"""
+    group = models.ForeignKey(LookupGroup, related_name='members', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='lookup_group_memberships', on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('user', 'group')
+
+
 @receiver(pre_save, sender=User)
 def add_name_to_user(instance, **kwargs):
     if len(MWSUser.objects.filter(user=instance.username)) == 0:
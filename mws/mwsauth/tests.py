@@ -209,38 +209,38 @@ class AuthTestCases(TestCase):
         with mock.patch("apimws.vm.change_vm_power_state") as mock_change_vm_power_state:
             mock_change_vm_power_state.return_value = True
             mock_change_vm_power_state.delay.return_value = True
-            with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-                mock_subprocess.check_output.return_value.returncode = 0
+            with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+                mock_run_ansible.return_value = ""
                 site_with_auth_users.enable()
 
         self.assertEqual(len(site_with_auth_users.users.all()), 1)
         self.assertEqual(site_with_auth_users.users.first(), amc203_user)
         self.assertEqual(len(site_with_auth_users.groups.all()), 0)
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.post(reverse(views.auth_change, kwargs={'site_id': site_with_auth_users.id}), {
                 'users_crsids': "amc203",
                 'groupids': "101888"
                 # we authorise amc203 user and 101888 group
             })
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site_with_auth_users.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         self.assertRedirects(response, expected_url=site_with_auth_users.get_absolute_url())
         self.assertEqual(len(site_with_auth_users.users.all()), 1)
         self.assertEqual(site_with_auth_users.users.first(), amc203_user)
         self.assertEqual(len(site_with_auth_users.groups.all()), 1)
         self.assertEqual(site_with_auth_users.groups.first(), information_systems_group)
 
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             # remove all users and groups authorised, we do not send any crsids or groupids
             response = self.client.post(reverse(views.auth_change, kwargs={'site_id': site_with_auth_users.id}), {})
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site_with_auth_users.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response.url.endswith(site_with_auth_users.get_absolute_url()))
         self.assertEqual(self.client.get(response.url).status_code, 403)  # User is no longer authorised
@@ -280,31 +280,31 @@ class AuthTestCases(TestCase):
         self.assertEqual(len(site_with_auth_groups.users.all()), 0)
         self.assertEqual(len(site_with_auth_groups.groups.all()), 1)
         self.assertEqual(site_with_auth_groups.groups.first(), information_systems_group)
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.post(reverse(views.auth_change, kwargs={'site_id': site_with_auth_groups.id}), {
                 'users_crsids': "amc203",
                 'groupids': "101888"
                 # we authorise amc203 user and 101888 group
             })
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site_with_auth_groups.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         self.assertRedirects(response, expected_url=site_with_auth_groups.get_absolute_url())
         self.assertEqual(len(site_with_auth_groups.users.all()), 1)
         self.assertEqual(site_with_auth_groups.users.first(), amc203_user)
         self.assertEqual(len(site_with_auth_groups.groups.all()), 1)
         self.assertEqual(site_with_auth_groups.groups.first(), information_systems_group)
 
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             # remove all users and groups authorised, we do not send any crsids or groupids
             response = self.client.post(reverse(views.auth_change, kwargs={'site_id': site_with_auth_groups.id}), {})
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site_with_auth_groups.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response.url.endswith(site_with_auth_groups.get_absolute_url()))
         self.assertEqual(self.client.get(response.url).status_code, 403)  # User is no longer authorised
@@ -35,6 +35,21 @@ def get_users_of_a_group(group):
                GroupMethods(get_connection()).getMembers(groupid=group.lookup_id))
 
 
+def sync_lookup_group_members(group, users=None):
+    """ Updates the local copy of the members of a LookupGroup (see mwsauth.models.LookupGroupMember)
+    :param group: The LookupGroup
+    :param users: The current list of Users of the group, queried to Lookup if not given
+    """
+    from mwsauth.models import LookupGroupMember
+    if users is None:
+        users = get_users_of_a_group(group)
+    user_ids = set(user.id for user in users)
+    current_ids = set(group.members.values_list('user_id', flat=True))
+    group.members.filter(user_id__in=current_ids - user_ids).delete()
+    LookupGroupMember.objects.bulk_create([LookupGroupMember(group=group, user_id=user_id)
+                                           for user_id in user_ids - current_ids])
+
+
 class ScheduledTaskWithFailure(Task):
     abstract = True
 
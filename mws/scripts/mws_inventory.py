@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Ansible dynamic inventory that serves the snapshot materialized by the web panel (see apimws.inventory).
+
+It does not import Django nor connects to the database, so it answers in milliseconds. The path of the snapshot is
+taken from the MWS_INVENTORY_SNAPSHOT environment variable and defaults to the one used by the panel settings.
+
+"""
+import argparse
+import json
+import os
+import sys
+
+
+DEFAULT_SNAPSHOT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))), 'inventory.json')
+
+
+def main(argv=None, outfile=None):
+    parser = argparse.ArgumentParser(description="Serves the ansible inventory materialized by the MWS web panel.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--list", action='store_true', help="emit a list of configured MWS clients")
+    group.add_argument("--host", action='store', help="emit the configuration of a single MWS client")
+    args = parser.parse_args(argv)
+    outfile = outfile or sys.stdout
+
+    path = os.environ.get('MWS_INVENTORY_SNAPSHOT', DEFAULT_SNAPSHOT)
+    try:
+        with open(path) as snapshot:
+            inventory = json.load(snapshot)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("Cannot read the inventory snapshot %s: %s\n" % (path, e))
+        return 1
+
+    if args.list:
+        json.dump(inventory, outfile)
+    else:
+        json.dump(inventory['_meta']['hostvars'].get(args.host, {}), outfile)
+    outfile.write("\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -60,7 +60,7 @@ recreate_vm.short_description = "Recreate VM"
 def execute_ansible(modeladmin, request, queryset):
     from apimws.ansible import launch_ansible
     for service in queryset:
-        launch_ansible(service)
+        launch_ansible(service, force=True)
 
 
 execute_ansible.short_description = "Launch Ansible"
@@ -161,7 +161,8 @@ class SnapshotAdmin(ModelAdmin):
 
 class VirtualMachineAdmin(VersionAdmin):
     # form = VirtualMachineForm
-    list_display = ('name', 'site', 'services')
+    list_display = ('name', 'site', 'services', 'power_state', 'power_state_checked')
+    list_filter = ('power_state', )
 
     def services(self, obj):
         return '<a href="/admin/sitesmanagement/service/%d/">%s</a>' % (obj.service.id, obj.service)
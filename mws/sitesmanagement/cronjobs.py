@@ -17,11 +17,17 @@ from django.db.models import F, Q
 from django.utils.timezone import now
 from django.core.urlresolvers import reverse
 
-from apimws.utils import preallocate_new_site
+from apimws.pool import replenish_pool
+from apimws.reconciliation import reconcile_fleet as reconcile_fleet_state
 from apimws.ansible import launch_ansible
 from apimws.models import QueueEntry
+from apimws.process import run_command
 from apimws.vm import clone_vm_api_call
+from mwsauth.models import LookupGroupMember
+from mwsauth.utils import sync_lookup_group_members
+from sitesmanagement.dns_validation import validate_domain_names, revalidate_due_domains
 from sitesmanagement.models import Billing, Site, Service, VirtualMachine, DomainName, ServerType
+from ucamlookup.models import LookupGroup
 
 
 LOGGER = logging.getLogger('mws')
@@ -173,7 +179,8 @@ def check_subscription():
 @shared_task(base=ScheduledTaskWithFailure)
 def check_backups():
     try:
-        result = subprocess.check_output(["userv", "mws-admin", "mws_check_backups"], stderr=subprocess.STDOUT)
+        result = run_command(["userv", "mws-admin", "mws_check_backups"],
+                             timeout=getattr(settings, 'CHECK_BACKUPS_TIMEOUT', 1800), max_lines=0)
     except subprocess.CalledProcessError as e:
         LOGGER.error("An error happened when checking ook backups in ent.\n\n"
                      "The output from the command was: %s\n", e.output)
@@ -223,15 +230,25 @@ def delete_cancelled():
 def check_num_preallocated_sites():
     """
     A :py:class:`~.ScheduledTaskWithFailure` which checks, for each
-    :py:class:`~sitesmanagement.models.ServerType` how many pre-allocated
-    :py:class:`~sitesmanagement.models.Site` instances there are. If that is
-    smaller than the number which should be pre-allocated, allocate a new one
-    via :py:func:`apimws.utils.preallocate_new_site`.
+    :py:class:`~sitesmanagement.models.ServerType`, how many pre-allocated
+    :py:class:`~sitesmanagement.models.Site` instances there are and how many
+    are being requested. If that is smaller than the target of the pool, it
+    allocates new ones via :py:func:`apimws.pool.replenish_pool`.
 
     """
-    for servertype in ServerType.objects.all():
-        if Site.objects.filter(preallocated=True, type=servertype).count() < servertype.preallocated:
-            preallocate_new_site(servertype=servertype)
+    return replenish_pool()
+
+
+@shared_task(base=ScheduledTaskWithFailure)
+def reconcile_fleet():
+    """
+    A :py:class:`~.ScheduledTaskWithFailure` which compares the
+    :py:class:`~sitesmanagement.models.VirtualMachine` instances with the
+    guests and power states reported by the Xen clusters, and reports (or
+    repairs) the differences via :py:func:`apimws.reconciliation.reconcile_fleet`.
+
+    """
+    return reconcile_fleet_state()
 
 
 @shared_task(base=ScheduledTaskWithFailure)
@@ -322,11 +339,20 @@ def validate_domains():
      - private if they are only available to the Cambridge nameservers
      - deleted if they are visible to none of the above.
     except for external and special domains which are set to deleted if invalid and not changed otherwise.
+
+    The domain names are validated concurrently, see :py:mod:`sitesmanagement.dns_validation`. All of them are
+    validated, the periodic validation is done in small batches by :py:func:`revalidate_domains`.
     '''
-    active_states = ['accepted', 'private', 'global', 'external', 'special', 'deleted']
+    return validate_domain_names()
 
-    for domainname in DomainName.objects.filter(status__in=active_states):
-            domainname.validate(update=True)
+
+@shared_task(base=ScheduledTaskWithFailure)
+def revalidate_domains():
+    '''
+    Validates the next batch of domain names whose validation is due, see
+    :py:func:`sitesmanagement.dns_validation.revalidate_due_domains`.
+    '''
+    return revalidate_due_domains()
 
 @shared_task(base=ScheduledTaskWithFailure)
 def expire_domains():
@@ -357,7 +383,7 @@ def expire_domains():
             ).send()
             LOGGER.warning('deleting DomainName {}'.format(domainname.name))
             domainname.delete()
-            launch_ansible(service)
+            launch_ansible(service, bulk=True)
         elif domainname.expired.days in notify_days:
             on = domainname.updated_at+timedelta(days=grace_days)
             LOGGER.info('sending warning email for {} to {}'.format(domainname.name, site.email))
@@ -428,3 +454,28 @@ def dequeue_upgrades():
                 headers={'Return-Path': getattr(settings, 'EMAIL_MWS3_SUPPORT', 'mws-support@uis.cam.ac.uk')}
             ).send()
             queue_entry.delete()
+
+
+@shared_task(base=ScheduledTaskWithFailure)
+def refresh_lookup_group_members(group_ids=None):
+    """
+    A :py:class:`~.ScheduledTaskWithFailure` which refreshes the local copy of the members of the Lookup groups
+    used by sites (see :py:class:`~mwsauth.models.LookupGroupMember`), used to find the sites of a user without
+    querying Lookup. If group_ids is given only those groups are refreshed.
+
+    """
+    groups = LookupGroup.objects.filter(Q(sites__isnull=False) | Q(sites_auth_as_user__isnull=False)).distinct()
+    if group_ids is None:
+        # Groups no longer used by any site are not kept up to date
+        LookupGroupMember.objects.exclude(group__in=groups).delete()
+    else:
+        groups = groups.filter(id__in=group_ids)
+    failed = []
+    for group in groups:
+        try:
+            sync_lookup_group_members(group)
+        except Exception as e:
+            failed.append(group.lookup_id)
+            LOGGER.error("Members of the Lookup group %s could not be refreshed: %s", group.lookup_id, e)
+    if failed:
+        raise Exception("Members of the Lookup groups %s could not be refreshed" % ", ".join(failed))
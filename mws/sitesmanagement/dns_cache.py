@@ -0,0 +1,135 @@
+"""
+Process-wide cache of DNS answers.
+
+The resolvers used to validate the domain names (see sitesmanagement.dns_validation and DomainName._resolve) do
+not cache anything, so the same names are queried again by every validation. :py:func:`cached_query` sends the
+queries through a cache shared by all the resolvers of the process:
+
+- answers are kept for their TTL, at most DNS_CACHE_MAX_TTL seconds;
+- NXDOMAIN and empty answers are kept for the negative caching TTL of the zone (the minimum of the TTL and of the
+  MINIMUM field of the SOA record in the response, RFC 2308), or DNS_CACHE_NEGATIVE_TTL seconds if the response
+  has no SOA record. Timeouts and server failures are not cached;
+- the cache keeps at most DNS_CACHE_SIZE answers, the least recently used are evicted first (0 disables it).
+
+The answers are stored per set of nameservers, so resolvers with different scopes (e.g. the global and the private
+resolvers of MWS_RESOLVERS) share the cache without seeing each other's answers. The hits and misses are counted
+in :py:meth:`DNSCache.stats`.
+
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+import dns.name
+import dns.rdatatype
+import dns.resolver
+from django.conf import settings
+
+
+class DNSCache(object):
+    """A thread-safe LRU cache whose entries expire"""
+
+    def __init__(self, max_size, max_ttl):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.entries = OrderedDict()  # key -> (expiration, value), the least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, now=None):
+        """Returns the value cached for key, or None if there is none or it has expired"""
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl, now=None):
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = ((now or time.time()) + ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_cache_pid = None
+
+
+def get_cache():
+    """Returns the DNS cache of this process"""
+    global _cache, _cache_pid
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            # The cache is not shared with forked processes (e.g. celery worker processes)
+            _cache = DNSCache(getattr(settings, 'DNS_CACHE_SIZE', 10000), getattr(settings, 'DNS_CACHE_MAX_TTL', 3600))
+            _cache_pid = os.getpid()
+        return _cache
+
+
+def negative_ttl(responses):
+    """The negative caching TTL of the responses of an NXDOMAIN or an empty answer (RFC 2308)"""
+    ttls = [min(rrset.ttl, rrset[0].minimum) for response in responses if response is not None
+            for rrset in response.authority if rrset.rdtype == dns.rdatatype.SOA]
+    return min(ttls) if ttls else getattr(settings, 'DNS_CACHE_NEGATIVE_TTL', 60)
+
+
+def cache_key(resolver, qname, rdtype):
+    if isinstance(rdtype, basestring):
+        rdtype = dns.rdatatype.from_text(rdtype)
+    return (tuple(resolver.nameservers), resolver.port, tuple(sorted(resolver.nameserver_ports.items())),
+            qname.to_text().lower(), rdtype)
+
+
+def cached_query(resolver, qname, rdtype, cache=None):
+    """
+    Resolver.query going through the DNS cache.
+
+    :raises: the same exceptions as Resolver.query, NXDOMAIN and NoAnswer are also raised from the cache
+    """
+    cache = cache or get_cache()
+    if not isinstance(qname, dns.name.Name):
+        qname = dns.name.from_text(qname)
+    key = cache_key(resolver, qname, rdtype)
+    cached = cache.get(key)
+    if isinstance(cached, Exception):
+        raise cached
+    if cached is not None:
+        return cached
+    try:
+        answer = resolver.query(qname, rdtype)
+    except dns.resolver.NXDOMAIN as e:
+        cache.put(key, e, negative_ttl(e.kwargs.get('responses', {}).values()))
+        raise
+    except dns.resolver.NoAnswer as e:
+        cache.put(key, e, negative_ttl([e.kwargs.get('response')]))
+        raise
+    cache.put(key, answer, answer.expiration - time.time())
+    return answer
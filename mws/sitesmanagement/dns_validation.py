@@ -0,0 +1,237 @@
+"""
+Concurrent validation of the domain names.
+
+:py:meth:`~sitesmanagement.models.DomainName.validate` queries the resolvers of MWS_RESOLVERS one after the other,
+AAAA first and then A, with the default timeouts of dnspython, so a nameserver that does not answer delays every
+domain name. :py:func:`validate_domain_names` validates many domain names at the same time instead:
+
+- the A and AAAA queries of all the domain names are sent concurrently to each resolver, at most
+  DNS_VALIDATION_CONCURRENCY at the same time per resolver (or the CONCURRENCY of the resolver in MWS_RESOLVERS);
+- each nameserver has DNS_VALIDATION_TIMEOUT seconds to answer a query before the next one is tried, and each
+  query DNS_VALIDATION_LIFETIME seconds in total;
+- the queries are sent from threads which do not access the database, and the changes of status are applied at
+  the end with one update per new status;
+- the answers are cached according to their TTL (see sitesmanagement.dns_cache).
+
+The status given to each domain name is the one that DomainName.validate would have given.
+
+Instead of validating all the domain names every night, each domain name has its own schedule: the validation
+sets when it has to be validated again, and :py:func:`revalidate_due_domains`, executed every few minutes,
+validates the ones due, at most DNS_CHECK_BATCH_SIZE at a time. Domain names whose status has just changed or
+that do not resolve anymore are validated again after DNS_CHECK_MIN_INTERVAL seconds, and the interval doubles
+after each validation that does not change their status, up to DNS_CHECK_MAX_INTERVALS[status] seconds
+(DNS_CHECK_MAX_INTERVAL for the status not listed). A random jitter spreads the validations over time.
+
+"""
+import copy
+import logging
+import random
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+import dns.name
+import dns.rdatatype
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, Value, F, Q, DateTimeField, IntegerField
+from django.utils import timezone
+from apimws.inventory import mark_snapshot_stale
+from apimws.locks import task_lock, LockNotAcquired
+from sitesmanagement.dns_cache import cached_query, get_cache
+from sitesmanagement.models import DomainName
+
+
+LOGGER = logging.getLogger('mws')
+
+# Status of the domain names that are validated periodically
+ACTIVE_STATES = ['accepted', 'private', 'global', 'external', 'special', 'deleted']
+
+# Status that validation never changes, unless the domain name stops resolving
+KEPT_STATES = ['external', 'special']
+
+RDTYPES = ('AAAA', 'A')
+
+# Domain names whose schedule is stored with each update, 5 parameters per domain name (sqlite accepts up to 999)
+SCHEDULE_BATCH_SIZE = 100
+
+# Longest interval between validations of the domain names with each status, in seconds
+DEFAULT_MAX_INTERVALS = {
+    'global': 7*24*60*60,
+}
+
+
+def validation_resolver(resolver):
+    """A copy of the dnspython resolver with the tight timeouts of the validation"""
+    resolver = copy.copy(resolver)
+    resolver.timeout = getattr(settings, 'DNS_VALIDATION_TIMEOUT', 1)
+    resolver.lifetime = getattr(settings, 'DNS_VALIDATION_LIFETIME', 3)
+    return resolver
+
+
+def query_addresses(resolver, name, rdtype):
+    """
+    Queries the addresses of a name, it does not access the database so that it can be used from several threads.
+
+    :return: list of the addresses in the answer or None if there was no answer (the name or the record does not
+             exist, or the nameservers did not answer)
+    """
+    try:
+        answer = cached_query(resolver, dns.name.from_text(name), rdtype)
+    except Exception:
+        return None
+    return [rdata.to_text() for rdata in answer.rrset.items if rdata.rdtype == dns.rdatatype.from_text(rdtype)]
+
+
+def addresses_match(addresses, address, proxies):
+    return address in addresses or any(answer in proxies for answer in addresses)
+
+
+def resolves_to(answers, ipv4, ipv6, proxies):
+    """
+    Whether the answers of a resolver point to the service, with the same rule as DomainName._resolve: the AAAA
+    answer decides if there is one, otherwise the A answer.
+
+    :param answers: dict rdtype -> addresses or None, as returned by query_addresses
+    """
+    if answers['AAAA'] is not None:
+        return addresses_match(answers['AAAA'], ipv6, proxies)
+    if answers['A'] is not None:
+        return addresses_match(answers['A'], ipv4, proxies)
+    return False
+
+
+def validated_status(status, scopes):
+    """The new status of a domain name given the scopes of the resolvers it resolves in, the broader first"""
+    if not scopes:
+        return 'deleted'
+    return scopes[0] if status not in KEPT_STATES else status
+
+
+def resolve_names(names, resolvers):
+    """
+    Sends the A and AAAA queries of all the names to all the resolvers, each resolver with its own pool of threads.
+
+    :param resolvers: list of MWS_RESOLVERS entries
+    :return: dict (resolver index, name, rdtype) -> addresses or None
+    """
+    pools = []
+    for index, resolver in enumerate(resolvers):
+        pool = ThreadPool(resolver.get('CONCURRENCY', getattr(settings, 'DNS_VALIDATION_CONCURRENCY', 10)))
+        dns_resolver = validation_resolver(resolver['RESOLVER'])
+        queries = [(name, rdtype) for name in names for rdtype in RDTYPES]
+        results = pool.map_async(lambda query, r=dns_resolver: query_addresses(r, *query), queries)
+        pools.append((index, pool, queries, results))
+    answers = {}
+    for index, pool, queries, results in pools:
+        try:
+            for (name, rdtype), addresses in zip(queries, results.get()):
+                answers[(index, name, rdtype)] = addresses
+        finally:
+            pool.close()
+            pool.join()
+    return answers
+
+
+def update_statuses(changes):
+    """Applies the new status of the domain names, with one update per status"""
+    batch_size = getattr(settings, 'DNS_VALIDATION_BATCH_SIZE', 500)
+    now = timezone.now()
+    with transaction.atomic():
+        for status, ids in changes.items():
+            for start in range(0, len(ids), batch_size):
+                # updated_at is set as save() would, it is the start of the grace period of deleted domain names
+                DomainName.objects.filter(pk__in=ids[start:start+batch_size]).update(status=status, updated_at=now)
+        if changes:
+            # The queryset updates do not send the signals that invalidate the ansible inventory
+            transaction.on_commit(mark_snapshot_stale)
+
+
+def check_interval(old_status, new_status, interval):
+    """Seconds until the next validation of a domain name, given the interval used until now"""
+    minimum = getattr(settings, 'DNS_CHECK_MIN_INTERVAL', 60*60)
+    if interval is None or new_status != old_status or new_status == 'deleted':
+        # Recently changed or failing
+        return minimum
+    maximum = getattr(settings, 'DNS_CHECK_MAX_INTERVALS', DEFAULT_MAX_INTERVALS).get(
+        new_status, getattr(settings, 'DNS_CHECK_MAX_INTERVAL', 24*60*60))
+    return max(min(interval * 2, maximum), minimum)
+
+
+def next_check(now, interval):
+    jitter = getattr(settings, 'DNS_CHECK_JITTER', 0.1)
+    return now + timedelta(seconds=interval * random.uniform(1 - jitter, 1 + jitter))
+
+
+def update_schedules(schedules, now):
+    """Stores when the domain names have to be validated again, with one update per batch of domain names"""
+    ids = sorted(schedules)
+    for start in range(0, len(ids), SCHEDULE_BATCH_SIZE):
+        batch = ids[start:start+SCHEDULE_BATCH_SIZE]
+        DomainName.objects.filter(pk__in=batch).update(
+            last_checked=now,
+            check_interval=Case(*[When(pk=pk, then=Value(schedules[pk][0])) for pk in batch],
+                                output_field=IntegerField()),
+            next_check=Case(*[When(pk=pk, then=Value(schedules[pk][1])) for pk in batch],
+                            output_field=DateTimeField()))
+
+
+def validate_domain_names(queryset=None, resolvers=None):
+    """
+    Validates domain names concurrently and updates their status.
+
+    :param queryset: the domain names to validate, all the domain names in ACTIVE_STATES by default
+    :param resolvers: list of resolvers with the format of MWS_RESOLVERS, the broader scope first
+    :return: dict new status -> number of domain names changed to that status
+    """
+    if queryset is None:
+        queryset = DomainName.objects.filter(status__in=ACTIVE_STATES)
+    if resolvers is None:
+        resolvers = settings.MWS_RESOLVERS
+    domains = list(queryset.values_list('id', 'name', 'status', 'check_interval',
+                                        'vhost__service__network_configuration__IPv4',
+                                        'vhost__service__network_configuration__IPv6'))
+    answers = resolve_names([name for _, name, _, _, _, _ in domains], resolvers)
+    proxies = getattr(settings, 'MWS_ALLOWED_PROXIES', [])
+    now = timezone.now()
+    changes = {}
+    schedules = {}
+    for domain_id, name, status, interval, ipv4, ipv6 in domains:
+        scopes = [resolver['SCOPE'] for index, resolver in enumerate(resolvers)
+                  if resolves_to(dict((rdtype, answers[(index, name, rdtype)]) for rdtype in RDTYPES),
+                                 ipv4, ipv6, proxies)]
+        new_status = validated_status(status, scopes)
+        if new_status != status:
+            changes.setdefault(new_status, []).append(domain_id)
+        interval = check_interval(status, new_status, interval)
+        schedules[domain_id] = (interval, next_check(now, interval))
+    update_statuses(changes)
+    update_schedules(schedules, now)
+    for status, ids in changes.items():
+        LOGGER.info("%d domain names validated as %s", len(ids), status)
+    LOGGER.info("%d domain names validated, DNS cache: %s", len(domains), get_cache().stats())
+    return dict((status, len(ids)) for status, ids in changes.items())
+
+
+def due_domains(now=None):
+    """The domain names whose validation is due, the ones never validated and the most overdue first"""
+    now = now or timezone.now()
+    return DomainName.objects.filter(Q(next_check__isnull=True) | Q(next_check__lte=now),
+                                     status__in=ACTIVE_STATES).order_by(F('next_check').asc(nulls_first=True), 'id')
+
+
+def revalidate_due_domains(batch_size=None):
+    """
+    Validates the next batch of domain names due.
+
+    :return: dict new status -> number of domain names changed to that status, None if another revalidation is
+             running
+    """
+    if batch_size is None:
+        batch_size = getattr(settings, 'DNS_CHECK_BATCH_SIZE', 100)
+    try:
+        with task_lock("domain-revalidation", ttl=getattr(settings, 'DNS_CHECK_LOCK_TTL', 600)):
+            ids = list(due_domains().values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return {}
+            return validate_domain_names(DomainName.objects.filter(pk__in=ids))
+    except LockNotAcquired:
+        return None
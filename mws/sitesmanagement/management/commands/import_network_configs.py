@@ -0,0 +1,82 @@
+import ipaddress
+from itertools import count
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from sitesmanagement.models import NetworkConfig
+
+
+class Command(BaseCommand):
+    help = 'Adds to the free list the network configurations of a range of addresses, e.g. import_network_configs ' \
+           'ipvxpub --ipv4 192.0.2.0/26 --ipv6 2001:db8::/122 --gateway4 192.0.2.1 --name "mws-{index}.example"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('type', choices=[choice[0] for choice in NetworkConfig.NETWORK_CONFIGURATION_TYPES])
+        parser.add_argument('--ipv4', help="IPv4 network whose addresses will be imported")
+        parser.add_argument('--ipv6', help="IPv6 network whose addresses will be imported, paired with the IPv4 "
+                                           "addresses for types with both")
+        parser.add_argument('--gateway4', help="IPv4 gateway of the network")
+        parser.add_argument('--exclude', action='append', default=[],
+                            help="Addresses not to import (e.g. the gateway or reserved ones), can be repeated")
+        parser.add_argument('--name',
+                            help="Template of the hostnames, with the fields {index}, {ipv4} and {ipv6}")
+        parser.add_argument('--start', type=int, default=1, help="First index of the hostnames")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        netconf_type = options['type']
+        if not options['name']:
+            raise CommandError("The template of the hostnames (--name) is required")
+        ipv4_network = self.network(options['ipv4'])
+        ipv6_network = self.network(options['ipv6'])
+        if netconf_type.startswith('ipv4') and not ipv4_network:
+            raise CommandError("The type %s needs an IPv4 network" % netconf_type)
+        if netconf_type == 'ipv6' and not ipv6_network:
+            raise CommandError("The type ipv6 needs an IPv6 network")
+        if netconf_type.startswith('ipvx') and not (ipv4_network and ipv6_network):
+            raise CommandError("The type %s needs both an IPv4 and an IPv6 network" % netconf_type)
+        if netconf_type.startswith('ipv4'):
+            ipv6_network = None
+        if netconf_type == 'ipv6':
+            ipv4_network = None
+
+        excluded = set(ipaddress.ip_address(unicode(address)) for address in options['exclude'])
+        if options['gateway4']:
+            excluded.add(ipaddress.ip_address(unicode(options['gateway4'])))
+        ipv4s = [address for address in ipv4_network.hosts() if address not in excluded] if ipv4_network else None
+        ipv6s = [address for address in ipv6_network.hosts() if address not in excluded] if ipv6_network else None
+        if ipv4s is not None and ipv6s is not None:
+            pairs = zip(ipv4s, ipv6s)  # Truncated to the smallest network
+        elif ipv4s is not None:
+            pairs = [(address, None) for address in ipv4s]
+        else:
+            pairs = [(None, address) for address in ipv6s]
+
+        existing_ipv4 = set(NetworkConfig.objects.filter(IPv4__isnull=False).values_list('IPv4', flat=True))
+        existing_ipv6 = set(ipaddress.ip_address(unicode(address)) for address in NetworkConfig.objects.filter(
+            IPv6__isnull=False).values_list('IPv6', flat=True))
+        existing_names = set(NetworkConfig.objects.values_list('name', flat=True))
+        netconfs = []
+        skipped = 0
+        for index, (ipv4, ipv6) in zip(count(options['start']), pairs):
+            name = options['name'].format(index=index, ipv4=ipv4, ipv6=ipv6)
+            if (ipv4 and str(ipv4) in existing_ipv4) or (ipv6 and ipv6 in existing_ipv6) or name in existing_names:
+                skipped += 1
+                continue
+            netconfs.append(NetworkConfig(
+                type=netconf_type, name=name, status='free',
+                IPv4=str(ipv4) if ipv4 else None, IPv6=str(ipv6) if ipv6 else None,
+                IPv4_netmask=str(ipv4_network.netmask) if ipv4 else None,
+                IPv4_gateway=options['gateway4'] if ipv4 else None))
+        with transaction.atomic():
+            NetworkConfig.objects.bulk_create(netconfs, batch_size=options['batch_size'])
+        self.stdout.write("%d network configurations imported, %d already existing skipped" %
+                          (len(netconfs), skipped))
+
+    @staticmethod
+    def network(network):
+        if not network:
+            return None
+        try:
+            return ipaddress.ip_network(unicode(network), strict=False)
+        except ValueError as e:
+            raise CommandError(str(e))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 00:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_allocated(apps, schema_editor):
+    NetworkConfig = apps.get_model('sitesmanagement', 'NetworkConfig')
+    NetworkConfig.objects.filter(models.Q(service__isnull=False) | models.Q(vm__isnull=False)) \
+        .update(status='allocated')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0083_virtualmachine_ansible_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='networkconfig',
+            name='status',
+            field=models.CharField(choices=[('free', 'Free'), ('allocated', 'Allocated')], default='free', max_length=20),
+        ),
+        migrations.AlterIndexTogether(
+            name='networkconfig',
+            index_together=set([('type', 'status')]),
+        ),
+        migrations.RunPython(mark_allocated, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 00:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0084_networkconfig_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='power_state',
+            field=models.CharField(blank=True, choices=[('running', 'Running'), ('paused', 'Paused'), ('stopped', 'Stopped'), ('crashed', 'Crashed'), ('missing', 'Missing')], max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='virtualmachine',
+            name='power_state_checked',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 01:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0085_virtualmachine_power_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='domainname',
+            name='check_interval',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='domainname',
+            name='last_checked',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='domainname',
+            name='next_check',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.20 on 2026-10-19 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitesmanagement', '0086_domainname_check_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='ansible_queued_force',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -29,24 +29,55 @@ class NetworkConfig(models.Model):
         ('ipv6', 'IPv6 Only'),
     )
 
+    STATUS_CHOICES = (
+        ('free', 'Free'),
+        ('allocated', 'Allocated'),
+    )
+
     IPv4 = models.GenericIPAddressField(protocol='IPv4', unique=True, null=True, blank=True)
     IPv4_netmask = models.GenericIPAddressField(protocol='IPv4', null=True, blank=True)
     IPv4_gateway = models.GenericIPAddressField(protocol='IPv4', null=True, blank=True)
     IPv6 = models.GenericIPAddressField(protocol='IPv6', unique=True, null=True, blank=True)
     name = models.CharField(max_length=250, unique=True)
     type = models.CharField(max_length=50, choices=NETWORK_CONFIGURATION_TYPES)
+    # Free list of the allocator, kept up to date when services and VMs are saved and deleted (see signals)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='free')
+
+    class Meta:
+        index_together = [['type', 'status']]
+
+    @classmethod
+    def allocate(cls, type):
+        """
+        Claims a free network configuration of the given type. Rows being claimed by concurrent transactions are
+        skipped instead of waited for, so concurrent allocations never get the same configuration.
+
+        :return: the NetworkConfig, already marked as allocated, or None if there are no free ones
+        """
+        with transaction.atomic():
+            netconf = cls.objects.select_for_update(skip_locked=True).filter(type=type, status='free') \
+                .order_by('id').first()
+            if netconf:
+                cls.objects.filter(pk=netconf.pk).update(status='allocated')
+                netconf.status = 'allocated'
+        return netconf
+
+    def release(self):
+        """Returns the network configuration to the free list"""
+        NetworkConfig.objects.filter(pk=self.pk).update(status='free')
+        self.status = 'free'
 
     @classmethod
     def get_free_prod_service_config(cls):
-        return cls.objects.filter(service=None, type='ipvxpub').first()
+        return cls.allocate('ipvxpub')
 
     @classmethod
     def get_free_test_service_config(cls):
-        return cls.objects.filter(service=None, type='ipv4priv').first()
+        return cls.allocate('ipv4priv')
 
     @classmethod
     def get_free_host_config(cls):
-        return cls.objects.filter(vm=None, type='ipv6').first()
+        return cls.allocate('ipv6')
 
     def __unicode__(self):
         return self.name
@@ -274,8 +305,9 @@ class Site(models.Model):
                 ug.service = test_service
                 ug.save()
 
-            # Switch network configuration
-            test_service.network_configuration = NetworkConfig.get_free_test_service_config()
+            # Switch network configuration, using a free one while they are swapped
+            placeholder = NetworkConfig.get_free_test_service_config()
+            test_service.network_configuration = placeholder
             test_service.type = "production"
             test_service.site = None
             test_service.save()
@@ -285,6 +317,8 @@ class Site(models.Model):
             test_service.site = self
             test_service.network_configuration = netconf_prod
             test_service.save()
+            if placeholder:
+                placeholder.release()
 
             from apimws.models import AnsibleConfiguration
             AnsibleConfiguration.objects.update_or_create(service=test_service, key="backup_first_date",
@@ -436,6 +470,8 @@ class Service(models.Model):
     site = models.ForeignKey(Site, null=True, blank=True, related_name="services")
     type = models.CharField(max_length=50, choices=SERVICE_TYPES)
     status = models.CharField(max_length=50, choices=STATUS_CHOICES)
+    # Whether the ansible run queued while another one is in flight (ansible_queued) has to be forced
+    ansible_queued_force = models.BooleanField(default=False)
     quarantined = models.BooleanField(default=False)
 
     @property
@@ -496,7 +532,8 @@ class Service(models.Model):
         self.status = 'ansible'
         self.save()
         from apimws.ansible import launch_ansible_async
-        launch_ansible_async.apply_async((self, ), countdown=120)
+        from apimws.readiness import when_ready
+        when_ready(self, launch_ansible_async.si(self, force=True))
 
     def power_off(self):
         for vm in self.virtual_machines.all():
@@ -528,6 +565,20 @@ class VirtualMachine(models.Model):
     from apimws.models import Cluster
     cluster = models.ForeignKey(Cluster, related_name='guests')
 
+    # Fingerprint of the ansible host variables of the last successful ansible run
+    ansible_fingerprint = models.CharField(max_length=64, blank=True, null=True)
+
+    POWER_STATES = (
+        ('running', 'Running'),
+        ('paused', 'Paused'),
+        ('stopped', 'Stopped'),
+        ('crashed', 'Crashed'),
+        ('missing', 'Missing'),
+    )
+    # Power state reported by the hypervisor in the last reconciliation of the fleet (see apimws.reconciliation)
+    power_state = models.CharField(max_length=20, choices=POWER_STATES, blank=True, null=True)
+    power_state_checked = models.DateTimeField(blank=True, null=True)
+
     def save(self, *args, **kwargs):
         # the primary VM may have had its parameters changed
         vm = self if self.service.primary else self.service.site.production_service.virtual_machines.first()
@@ -673,9 +724,17 @@ class DomainName(models.Model):
     reject_reason = models.CharField(max_length=250, blank=True, null=True)
     token = models.CharField(max_length=50, default=uuid.uuid4)
     authorised_by = models.ForeignKey(User, related_name='domain_names_authorised', blank=True, null=True)
+    # Schedule of the validation (see sitesmanagement.dns_validation), domain names without next_check are
+    # validated first
+    last_checked = models.DateTimeField(blank=True, null=True)
+    next_check = models.DateTimeField(blank=True, null=True, db_index=True)
+    check_interval = models.IntegerField(blank=True, null=True)  # In seconds
 
     def accept_it(self):
         self.status = 'accepted'
+        # Validated again once the new CNAME has been published by the hourly DNS refresh
+        self.next_check = timezone.now() + timedelta(seconds=getattr(settings, 'DNS_CHECK_MIN_INTERVAL', 3600))
+        self.check_interval = None
         self.save()
         if self.vhost.main_domain is None or \
                         self.vhost.main_domain.name == self.vhost.service.network_configuration.name:
@@ -725,6 +784,7 @@ class DomainName(models.Model):
         import dns.resolver
         import dns.name
         import dns.rdatatype
+        from sitesmanagement.dns_cache import cached_query
 
         if resolver and nameservers:
             raise ValueError('resolver and nameservers are mutually exclusive')
@@ -737,12 +797,12 @@ class DomainName(models.Model):
         ip6 = self.vhost.service.network_configuration.IPv6
 
         try:
-            answer = r.query(dnsname, 'AAAA')
+            answer = cached_query(r, dnsname, 'AAAA')
             return ip6 in [AAAA.to_text() for AAAA in answer.rrset.items if AAAA.rdtype == dns.rdatatype.AAAA] or \
                    any([AAAA.to_text() in proxies for AAAA in answer.rrset.items if AAAA.rdtype == dns.rdatatype.AAAA])
         except:
             try:
-                answer = r.query(dnsname, 'A')
+                answer = cached_query(r, dnsname, 'A')
                 return ip4 in [A.to_text() for A in answer.rrset.items if A.rdtype == dns.rdatatype.A] or \
                        any([A.to_text() in proxies for A in answer.rrset.items if A.rdtype == dns.rdatatype.A])
             except:
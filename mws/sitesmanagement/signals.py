@@ -1,8 +1,15 @@
 import logging
-from django.db.models.signals import post_save, pre_delete
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
-from apimws.ipreg import delete_sshfp, delete_cname
-from sitesmanagement.models import DomainName, SiteKey, Site, VirtualMachine
+from apimws.inventory import mark_snapshot_stale
+from apimws.ipreg import IPRegBatch, ip_reg_batch_on_commit
+from apimws.models import AnsibleConfiguration, PHPLib, PHPPackage
+from mwsauth.models import MWSUser
+from sitesmanagement.cronjobs import refresh_lookup_group_members
+from sitesmanagement.models import DomainName, SiteKey, Site, VirtualMachine, Service, NetworkConfig, Vhost, \
+    UnixGroup
 
 LOGGER = logging.getLogger('mws')
 
@@ -17,22 +24,29 @@ def check_main_domain_name(instance, **kwargs):
 
 @receiver(pre_delete, sender=SiteKey)
 def delete_sshfp_from_dns(instance, **kwargs):
-    '''Delete SSHFP records from the DNS using the DNS API when a SiteKey is deleted from the database'''
-    for service in instance.site.services.all():
+    '''Delete SSHFP records from the DNS using the DNS API when a SiteKey is deleted from the database, with a
+    single batch for all the SiteKeys deleted in the same transaction'''
+    batch = IPRegBatch()
+    hostnames = []
+    for service in instance.site.services.select_related('network_configuration'):
+        hostnames.append(service.network_configuration.name)
+        hostnames.extend(vm.network_configuration.name
+                         for vm in service.virtual_machines.select_related('network_configuration'))
+    for hostname in hostnames:
         for fptype in SiteKey.FP_TYPES:
-            delete_sshfp(service.network_configuration.name, SiteKey.ALGORITHMS[instance.type],
-                         SiteKey.FP_TYPES[fptype])
-        for vm in service.virtual_machines.all():
-            for fptype in SiteKey.FP_TYPES:
-                delete_sshfp(vm.network_configuration.name, SiteKey.ALGORITHMS[instance.type],
-                             SiteKey.FP_TYPES[fptype])
+            batch.delete_sshfp(hostname, SiteKey.ALGORITHMS[instance.type], SiteKey.FP_TYPES[fptype])
+    ip_reg_batch_on_commit(batch)
+
 
 @receiver(pre_delete, sender=DomainName)
 def delete_cname_from_dns(instance, **kwargs):
     """Delete the hostname entry from the DNS using the DNS API when a the DomainName is deleted from
-    the database and it is an internal cam.ac.uk hostname accepted by the owner of the domain."""
+    the database and it is an internal cam.ac.uk hostname accepted by the owner of the domain. The deletions of the
+    same transaction are sent in a single batch."""
     if instance.status == "accepted":
-        delete_cname.delay(instance.name)
+        batch = IPRegBatch()
+        batch.delete_cname(instance.name)
+        ip_reg_batch_on_commit(batch)
 
 
 @receiver(pre_delete, sender=Site)
@@ -43,3 +57,58 @@ def log_deleted_site(sender, instance, **kwargs):
 @receiver(pre_delete, sender=VirtualMachine)
 def log_deleted_site(sender, instance, **kwargs):
     LOGGER.info("Class %s deleted the Virtual Machine %s" % (str(sender), instance.name))
+
+
+def allocate_network_configuration(sender, instance, **kwargs):
+    """Keep the free list of the network configurations (see NetworkConfig.allocate) in sync with the services and
+    VMs using them, including the ones assigned without the allocator"""
+    if instance.network_configuration_id:
+        NetworkConfig.objects.filter(pk=instance.network_configuration_id).exclude(status='allocated') \
+            .update(status='allocated')
+
+
+def release_network_configuration(sender, instance, **kwargs):
+    if instance.network_configuration_id:
+        NetworkConfig.objects.filter(pk=instance.network_configuration_id).update(status='free')
+
+
+for model in (Service, VirtualMachine):
+    post_save.connect(allocate_network_configuration, sender=model)
+    post_delete.connect(release_network_configuration, sender=model)
+
+
+# Models and relations whose changes alter the ansible inventory
+INVENTORY_MODELS = (Site, Service, VirtualMachine, NetworkConfig, Vhost, DomainName, UnixGroup,
+                    AnsibleConfiguration, PHPLib, PHPPackage, MWSUser, User)
+INVENTORY_RELATIONS = (Site.users.through, Site.ssh_users.through, Site.supporters.through, Site.groups.through,
+                       Site.ssh_groups.through, UnixGroup.users.through, PHPLib.services.through)
+
+
+def invalidate_inventory_snapshot(sender, **kwargs):
+    """Flag the materialized ansible inventory as stale once the current transaction commits"""
+    if kwargs.get('action', 'post').startswith('pre'):
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields and set(update_fields) <= {'last_login'}:
+        # Users logging in do not change the inventory
+        return
+    transaction.on_commit(mark_snapshot_stale)
+
+
+for model in INVENTORY_MODELS:
+    post_save.connect(invalidate_inventory_snapshot, sender=model)
+    post_delete.connect(invalidate_inventory_snapshot, sender=model)
+for relation in INVENTORY_RELATIONS:
+    m2m_changed.connect(invalidate_inventory_snapshot, sender=relation)
+
+
+def refresh_added_lookup_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    """Load the members of the Lookup groups given access to a site, once the current transaction commits"""
+    if action != 'post_add':
+        return
+    group_ids = [instance.pk] if reverse else list(pk_set)
+    transaction.on_commit(lambda: refresh_lookup_group_members.delay(group_ids))
+
+
+m2m_changed.connect(refresh_added_lookup_groups, sender=Site.groups.through)
+m2m_changed.connect(refresh_added_lookup_groups, sender=Site.ssh_groups.through)
@@ -70,8 +70,8 @@ class BillingTests(TestCase):
         with patch("apimws.vm.change_vm_power_state") as mock_change_vm_power_state:
             mock_change_vm_power_state.return_value = True
             mock_change_vm_power_state.delay.return_value = True
-            with patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-                mock_subprocess.check_output.return_value.returncode = 0
+            with patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+                mock_run_ansible.return_value = ""
                 site.enable()
 
         suspension.start_date = datetime.today() - timedelta(days=2)
@@ -0,0 +1,71 @@
+import dns.resolver
+from django.test import SimpleTestCase, override_settings
+from mock import mock
+from sitesmanagement.dns_cache import DNSCache, cached_query, get_cache
+from sitesmanagement.tests.test_dns_validation import StubDNSServer, resolver
+
+
+class DNSCacheTests(SimpleTestCase):
+
+    def tearDown(self):
+        StubDNSServer.close_all()
+
+    def test_lru(self):
+        cache = DNSCache(max_size=2, max_ttl=3600)
+        cache.put('a', 1, 60, now=1000)
+        cache.put('b', 2, 60, now=1000)
+        self.assertEqual(cache.get('a', now=1001), 1)
+        # b is the least recently used
+        cache.put('c', 3, 60, now=1001)
+        self.assertIsNone(cache.get('b', now=1001))
+        self.assertEqual(cache.get('c', now=1001), 3)
+        # Entries expire with their TTL, capped to max_ttl
+        self.assertIsNone(cache.get('a', now=1060))
+        cache.put('d', 4, 7200, now=1000)
+        self.assertIsNone(cache.get('d', now=4601))
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 2, 'misses': 3, 'evictions': 1, 'hit_rate': 0.4})
+
+    def test_disabled(self):
+        cache = DNSCache(max_size=0, max_ttl=3600)
+        cache.put('a', 1, 60)
+        self.assertIsNone(cache.get('a'))
+
+    def test_cached_query(self):
+        server = StubDNSServer({"www.example": ['192.0.2.1'], "v6.example": ['2001:db8::1']}, ttl=300,
+                               negative_ttl=30)
+        global_resolver = resolver('global', server)['RESOLVER']
+        cache = DNSCache(max_size=100, max_ttl=3600)
+        for _ in range(3):
+            self.assertEqual(cached_query(global_resolver, "www.example", 'A', cache).rrset[0].to_text(),
+                             '192.0.2.1')
+            with self.assertRaises(dns.resolver.NXDOMAIN):
+                cached_query(global_resolver, "missing.example", 'A', cache)
+            with self.assertRaises(dns.resolver.NoAnswer):
+                cached_query(global_resolver, "v6.example", 'A', cache)
+        self.assertEqual(server.queries, 3)
+        self.assertEqual(cache.stats()['hits'], 6)
+
+        # Negative answers are cached for the SOA minimum, answers for their TTL
+        expirations = dict((key[3], expiration) for key, (expiration, value) in cache.entries.items())
+        self.assertAlmostEqual(expirations['missing.example.'] - expirations['www.example.'], -270, delta=2)
+        self.assertAlmostEqual(expirations['v6.example.'] - expirations['www.example.'], -270, delta=2)
+
+        # Resolvers with other nameservers do not see the answers
+        private_resolver = resolver('private', StubDNSServer({"www.example": ['10.0.0.1']}))['RESOLVER']
+        self.assertEqual(cached_query(private_resolver, "www.example", 'A', cache).rrset[0].to_text(), '10.0.0.1')
+
+    def test_failures_are_not_cached(self):
+        dead_resolver = resolver('global', StubDNSServer())['RESOLVER']
+        cache = DNSCache(max_size=100, max_ttl=3600)
+        with self.assertRaises(dns.exception.Timeout):
+            cached_query(dead_resolver, "www.example", 'A', cache)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    @override_settings(DNS_CACHE_SIZE=10)
+    def test_process_cache(self):
+        with mock.patch("sitesmanagement.dns_cache._cache", None):
+            cache = get_cache()
+            self.assertIs(get_cache(), cache)
+            self.assertEqual(cache.max_size, 10)
+            with mock.patch("sitesmanagement.dns_cache._cache_pid", -1):
+                self.assertIsNot(get_cache(), cache)
@@ -0,0 +1,248 @@
+import itertools
+from datetime import timedelta
+import socket
+import threading
+import time
+import dns.message
+import dns.rcode
+import dns.resolver
+import dns.rrset
+from django.db.models import Count
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mock import mock
+from apimws.management.test_ansible_inventory import FleetMixin
+from sitesmanagement.dns_validation import validate_domain_names, revalidate_due_domains, check_interval
+from sitesmanagement.models import DomainName
+
+
+class StubDNSServer(object):
+    """
+    A DNS server on localhost answering the A and AAAA queries of the names of records after latency seconds.
+    A server without records never answers, like a dead nameserver.
+    """
+    # Each server listens in its own loopback address, dnspython identifies the nameservers by their address
+    addresses = itertools.count(2)
+    servers = []
+
+    def __init__(self, records=None, latency=0.0, ttl=300, negative_ttl=30):
+        self.records = records
+        self.latency = latency
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.queries = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.%d' % next(self.addresses), 0))
+        self.host, self.port = self.socket.getsockname()
+        self.servers.append(self)
+        if records is not None:
+            self.thread = threading.Thread(target=self.serve)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                wire, client = self.socket.recvfrom(65535)
+            except socket.error:
+                return
+            self.queries += 1
+            answer = threading.Thread(target=self.answer, args=(wire, client))
+            answer.daemon = True
+            answer.start()
+
+    def answer(self, wire, client):
+        time.sleep(self.latency)
+        query = dns.message.from_wire(wire)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        name = question.name.to_text(omit_final_dot=True)
+        addresses = [address for address in self.records.get(name, []) if (':' in address) ==
+                     (question.rdtype == dns.rdatatype.AAAA)]
+        if addresses:
+            response.answer.append(dns.rrset.from_text_list(question.name, self.ttl, 'IN', question.rdtype,
+                                                            addresses))
+        else:
+            if name not in self.records:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(dns.rrset.from_text(
+                question.name.parent(), 3600, 'IN', 'SOA', 'ns.example. hostmaster.example. 1 3600 600 86400 %d'
+                % self.negative_ttl))
+        try:
+            self.socket.sendto(response.to_wire(), client)
+        except socket.error:
+            pass
+
+    @classmethod
+    def close_all(cls):
+        while cls.servers:
+            cls.servers.pop().socket.close()
+
+
+def resolver(scope, *servers, **kwargs):
+    """An entry of MWS_RESOLVERS using the stub servers, with the timeouts of the validation engine"""
+    r = dns.resolver.Resolver(configure=False)
+    r.timeout = 0.1
+    r.lifetime = 1
+    r.nameservers = [server.host for server in servers]
+    r.nameserver_ports = dict((server.host, server.port) for server in servers)
+    entry = {'SCOPE': scope, 'SERVERS': r.nameservers, 'RESOLVER': r}
+    entry.update(kwargs)
+    return entry
+
+
+@override_settings(DNS_VALIDATION_TIMEOUT=0.1, DNS_VALIDATION_LIFETIME=1, DNS_VALIDATION_CONCURRENCY=10,
+                   MWS_ALLOWED_PROXIES=['192.0.2.80'])
+class DNSValidationTests(FleetMixin, TestCase):
+
+    def tearDown(self):
+        StubDNSServer.close_all()
+
+    def test_validation(self):
+        self.create_fleet(6)
+        # bench0000.example resolves globally, bench0001.example resolves globally through an allowed proxy,
+        # bench0002.example has a wrong AAAA record (the AAAA answer decides even if the A record is right) except
+        # in the private resolver,
+        # bench0003.example only has an A record, bench0004.example only resolves privately and
+        # bench0005.example does not resolve anymore. All the .private.example names resolve privately.
+        public = {
+            "bench0000.example": ['2001:db8:1::0', '10.1.0.0'],
+            "bench0001.example": ['192.0.2.80'],
+            "bench0002.example": ['2001:db8:ffff::1', '10.1.0.2'],
+            "bench0003.example": ['10.1.0.3'],
+        }
+        private = dict(public, **{"bench0002.example": ['2001:db8:1::2'], "bench0004.example": ['10.1.0.4']})
+        private.update(("bench%04d.private.example" % i, ['10.1.0.%d' % i]) for i in range(6))
+        DomainName.objects.filter(name="bench0001.private.example").update(status='external')
+        DomainName.objects.filter(name="bench0003.private.example").update(status='accepted')
+        resolvers = [resolver('global', StubDNSServer(), StubDNSServer(public)),
+                     resolver('private', StubDNSServer(private))]
+
+        changes = validate_domain_names(resolvers=resolvers)
+        statuses = dict(DomainName.objects.values_list('name', 'status'))
+        self.assertEqual(statuses["bench0000.example"], 'global')
+        self.assertEqual(statuses["bench0001.example"], 'global')
+        self.assertEqual(statuses["bench0002.example"], 'private')
+        self.assertEqual(statuses["bench0003.example"], 'global')
+        self.assertEqual(statuses["bench0004.example"], 'private')
+        self.assertEqual(statuses["bench0005.example"], 'deleted')
+        self.assertEqual(statuses["bench0001.private.example"], 'external')
+        self.assertEqual(statuses["bench0003.private.example"], 'private')
+        self.assertEqual(changes, {'private': 3, 'deleted': 1})
+        self.assertEqual(dict(DomainName.objects.values_list('status').annotate(Count('id'))),
+                         {'global': 3, 'private': 7, 'external': 1, 'deleted': 1})
+
+        # The answers are cached, repeating the validation does not query the nameservers again
+        queries = [server.queries for server in StubDNSServer.servers]
+        self.assertEqual(validate_domain_names(resolvers=resolvers), {})
+        self.assertEqual([server.queries for server in StubDNSServer.servers], queries)
+
+        # The engine gives the same status as DomainName.validate
+        for domain_name in DomainName.objects.all():
+            with override_settings(MWS_RESOLVERS=resolvers):
+                self.assertEqual(domain_name.validate(), domain_name.status, domain_name.name)
+
+    def test_bulk_update(self):
+        self.create_fleet(20)
+        with mock.patch("sitesmanagement.dns_validation.resolve_names", return_value=dict(
+                ((index, name, rdtype), None) for index in range(2)
+                for name in DomainName.objects.values_list('name', flat=True) for rdtype in ('A', 'AAAA'))), \
+                mock.patch("sitesmanagement.dns_validation.transaction.on_commit") as on_commit:
+            with self.assertNumQueries(5):
+                changes = validate_domain_names(resolvers=[{'SCOPE': 'global'}, {'SCOPE': 'private'}])
+        self.assertEqual(changes, {'deleted': 40})
+        self.assertEqual(set(DomainName.objects.values_list('status', flat=True)), {'deleted'})
+        self.assertEqual(on_commit.call_count, 1)
+
+    def test_benchmark(self):
+        """The concurrent validation is faster than validating the domain names one after the other, especially
+        with a dead nameserver"""
+        self.create_fleet(10)
+        public = dict(("bench%04d.example" % i, ['2001:db8:1::%x' % i]) for i in range(10))
+        private = dict(("bench%04d.private.example" % i, ['10.1.0.%d' % i]) for i in range(10))
+        resolvers = [resolver('global', StubDNSServer(), StubDNSServer(public, latency=0.01)),
+                     resolver('private', StubDNSServer(private, latency=0.01))]
+        # The same timeouts, only the concurrency differs
+        serial_resolvers = [resolver('global', StubDNSServer(), StubDNSServer(public, latency=0.01)),
+                            resolver('private', StubDNSServer(private, latency=0.01))]
+
+        start = time.time()
+        validate_domain_names(resolvers=resolvers)
+        concurrent_time = time.time() - start
+        concurrent_statuses = dict(DomainName.objects.values_list('name', 'status'))
+
+        DomainName.objects.update(status='accepted')
+        start = time.time()
+        with override_settings(MWS_RESOLVERS=serial_resolvers):
+            for domain_name in DomainName.objects.all():
+                domain_name.validate(update=True)
+        serial_time = time.time() - start
+
+        self.assertEqual(dict(DomainName.objects.values_list('name', 'status')), concurrent_statuses)
+        self.assertEqual(set(concurrent_statuses.values()), {'global', 'private'})
+        self.assertLess(concurrent_time * 3, serial_time)
+
+
+@override_settings(DNS_CHECK_MIN_INTERVAL=3600, DNS_CHECK_MAX_INTERVAL=24*3600,
+                   DNS_CHECK_MAX_INTERVALS={'global': 7*24*3600}, DNS_CHECK_JITTER=0.1, DNS_CHECK_BATCH_SIZE=5)
+class DomainRevalidationTests(FleetMixin, TestCase):
+
+    def test_check_interval(self):
+        self.assertEqual(check_interval('global', 'global', None), 3600)
+        self.assertEqual(check_interval('global', 'global', 3600), 7200)
+        self.assertEqual(check_interval('global', 'global', 6*24*3600), 7*24*3600)
+        self.assertEqual(check_interval('private', 'private', 20*3600), 24*3600)
+        # Recently changed or failing
+        self.assertEqual(check_interval('private', 'global', 7*24*3600), 3600)
+        self.assertEqual(check_interval('deleted', 'deleted', 3600), 3600)
+
+    def resolve(self, resolved):
+        """resolve_names answering with the IPv6 address of the service for the names in resolved"""
+        addresses = dict(DomainName.objects.values_list('name', 'vhost__service__network_configuration__IPv6'))
+
+        def resolve_names(names, resolvers):
+            return dict(((0, name, rdtype), [addresses[name]] if name in resolved and rdtype == 'AAAA' else None)
+                        for name in names for rdtype in ('A', 'AAAA'))
+        return mock.patch("sitesmanagement.dns_validation.resolve_names", side_effect=resolve_names)
+
+    def test_revalidate_due_domains(self):
+        self.create_fleet(4)
+        names = set(DomainName.objects.values_list('name', flat=True))
+        with self.resolve(names), override_settings(MWS_RESOLVERS=[{'SCOPE': 'global'}]):
+            # The domain names never validated go first, in batches
+            self.assertEqual(revalidate_due_domains(), {'global': 2})
+            self.assertEqual(DomainName.objects.filter(next_check__isnull=True).count(), 3)
+            self.assertEqual(revalidate_due_domains(), {'global': 2})
+            self.assertFalse(DomainName.objects.filter(next_check__isnull=True).exists())
+            self.assertEqual(revalidate_due_domains(), {})
+
+            now = timezone.now()
+            for domain_name in DomainName.objects.all():
+                self.assertEqual(domain_name.check_interval, 3600)
+                self.assertTrue(now + timedelta(seconds=3240) <= domain_name.next_check <=
+                                now + timedelta(seconds=3960))
+                self.assertIsNotNone(domain_name.last_checked)
+
+            # Stable domain names back off
+            DomainName.objects.filter(name="bench0000.example").update(next_check=now - timedelta(minutes=1))
+            revalidate_due_domains()
+            self.assertEqual(DomainName.objects.get(name="bench0000.example").check_interval, 7200)
+
+        # A domain name that breaks is validated again soon
+        DomainName.objects.filter(name="bench0000.example").update(next_check=now - timedelta(minutes=1))
+        with self.resolve(names - {"bench0000.example"}), override_settings(MWS_RESOLVERS=[{'SCOPE': 'global'}]):
+            self.assertEqual(revalidate_due_domains(), {'deleted': 1})
+        domain_name = DomainName.objects.get(name="bench0000.example")
+        self.assertEqual(domain_name.status, 'deleted')
+        self.assertEqual(domain_name.check_interval, 3600)
+
+    def test_accepted_domains_are_checked_after_the_dns_refresh(self):
+        self.create_fleet(1)
+        domain_name = DomainName.objects.get(name="bench0000.example")
+        domain_name.check_interval = 7*24*3600
+        with mock.patch("apimws.ipreg.set_cname"), mock.patch("apimws.ansible.launch_ansible"), \
+                mock.patch("apimws.utils.domain_confirmation_user"):
+            domain_name.accept_it()
+        domain_name = DomainName.objects.get(name="bench0000.example")
+        self.assertIsNone(domain_name.check_interval)
+        self.assertGreater(domain_name.next_check, timezone.now() + timedelta(minutes=59))
@@ -0,0 +1,76 @@
+from datetime import datetime
+from StringIO import StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from sitesmanagement.models import NetworkConfig, Service, Site, ServerType
+
+
+class NetworkAllocatorTests(TestCase):
+
+    def setUp(self):
+        for i in range(1, 4):
+            NetworkConfig.objects.create(IPv4='10.2.0.%d' % i, type='ipv4priv', name="mws-test-%d.example" % i)
+
+    def test_allocate(self):
+        first = NetworkConfig.allocate('ipv4priv')
+        second = NetworkConfig.get_free_test_service_config()
+        self.assertEqual(first.status, 'allocated')
+        self.assertNotEqual(first, second)
+        self.assertEqual(NetworkConfig.objects.get(pk=first.pk).status, 'allocated')
+        self.assertEqual(NetworkConfig.objects.filter(type='ipv4priv', status='free').count(), 1)
+        NetworkConfig.allocate('ipv4priv')
+        self.assertIsNone(NetworkConfig.allocate('ipv4priv'))
+        self.assertIsNone(NetworkConfig.allocate('ipv6'))
+
+    def test_release(self):
+        netconf = NetworkConfig.allocate('ipv4priv')
+        netconf.release()
+        self.assertEqual(NetworkConfig.objects.get(pk=netconf.pk).status, 'free')
+        self.assertEqual(NetworkConfig.allocate('ipv4priv'), netconf)
+
+    def test_services_keep_the_free_list(self):
+        site = Site.objects.create(name="testSite", start_date=datetime.today(), type=ServerType.objects.get(id=1),
+                                   email="test@example.com")
+        # Configurations assigned without the allocator are also taken out of the free list
+        netconf = NetworkConfig.objects.get(name="mws-test-1.example")
+        service = Service.objects.create(site=site, type='test', network_configuration=netconf)
+        self.assertEqual(NetworkConfig.objects.get(pk=netconf.pk).status, 'allocated')
+        self.assertNotEqual(NetworkConfig.allocate('ipv4priv'), netconf)
+        service.delete()
+        self.assertEqual(NetworkConfig.objects.get(pk=netconf.pk).status, 'free')
+
+
+class ImportNetworkConfigsTests(TestCase):
+
+    def test_import(self):
+        NetworkConfig.objects.create(IPv4='192.0.2.3', IPv6='2001:db8::2', type='ipvxpub', name="mws-existing.example")
+        out = StringIO()
+        call_command('import_network_configs', 'ipvxpub', ipv4='192.0.2.0/29', ipv6='2001:db8::/125',
+                     gateway4='192.0.2.1', name="mws-{index:03d}.example", start=10, stdout=out)
+        # Hosts 192.0.2.2-6 without the gateway, the existing address is skipped
+        self.assertIn("4 network configurations imported, 1 already existing skipped", out.getvalue())
+        netconf = NetworkConfig.objects.get(name="mws-010.example")
+        self.assertEqual(netconf.IPv4, '192.0.2.2')
+        self.assertEqual(netconf.IPv6, '2001:db8::1')
+        self.assertEqual(netconf.IPv4_netmask, '255.255.255.248')
+        self.assertEqual(netconf.IPv4_gateway, '192.0.2.1')
+        self.assertEqual(netconf.status, 'free')
+        self.assertEqual(NetworkConfig.objects.filter(type='ipvxpub', status='free').count(), 5)
+
+        # Importing again does not duplicate anything
+        out = StringIO()
+        call_command('import_network_configs', 'ipvxpub', ipv4='192.0.2.0/29', ipv6='2001:db8::/125',
+                     gateway4='192.0.2.1', name="mws-{index:03d}.example", start=10, stdout=out)
+        self.assertIn("0 network configurations imported, 5 already existing skipped", out.getvalue())
+
+    def test_import_ipv6(self):
+        call_command('import_network_configs', 'ipv6', ipv6='2001:db8:2::/126', name="mws-client-{index}.example",
+                     stdout=StringIO())
+        self.assertEqual(sorted(NetworkConfig.objects.values_list('IPv6', flat=True)),
+                         ['2001:db8:2::1', '2001:db8:2::2', '2001:db8:2::3'])
+        self.assertEqual(NetworkConfig.allocate('ipv6').name, "mws-client-1.example")
+
+    def test_missing_network(self):
+        with self.assertRaises(CommandError):
+            call_command('import_network_configs', 'ipvxpub', ipv4='192.0.2.0/29', name="mws-{index}.example")
@@ -33,7 +33,7 @@ def pre_create_site():
     NetworkConfig.objects.create(IPv6='2001:630:212:8::8c:ff2', name='mws-client3', type='ipv6')
     NetworkConfig.objects.create(IPv6='2001:630:212:8::8c:ff1', name='mws-client4', type='ipv6')
 
-    with mock.patch("apimws.xen.subprocess") as mock_subprocess:
+    with mock.patch("apimws.xen.subprocess") as mock_subprocess, mock.patch("apimws.xen.run_command") as mock_run:
         def fake_subprocess_output(*args, **kwargs):
             if (set(args[0]) & set(['vmmanager', 'create'])) == set(['vmmanager', 'create']):
                 return '{"vmid": "mws-client1"}'
@@ -45,6 +45,7 @@ def pre_create_site():
                        "replacehostname IN SSHFP 1 2 " \
                        "2f27ce76295fdffb576d714fea586dd0a87a5a2ffa621b4064e225e36c8cf83c\n"
         mock_subprocess.check_output.side_effect = fake_subprocess_output
+        mock_run.side_effect = fake_subprocess_output
         mock_subprocess.Popen().communicate.return_value = (
             '{"pubkey": "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQClBKpj+/WXlxJMY2iYw1mB1qYLM8YDjFS6qSiT6UmNLLhXJ' \
             'BEfd6vOMErM1IfDsYN+W3604hukxwC859TU4ZLQYD6wFI2D+qMhb2UTcoLlOYD7TG436RXKbxK4iAT7ll3XUT8VxZUq/AZKVs' \
@@ -52,20 +53,25 @@ def pre_create_site():
             '+5HQ16wf3x3fUFeMTOYfsbvwQ9T5pkKpFoiUYRxjsz7bXdPQPT4A1UrfgmGnTLJGSUh+uvHYLe7izWoMCCDCV0+Zyn0Ilrlfm' \
             'N+cD"}', '')
 
-        # We create a new server that will be used in the preallocation list
-        preallocate_new_site()
+        # We create a new server that will be used in the preallocation list, running its provisioning stages
+        # straight away as the test transaction is never committed
+        with mock.patch("apimws.xen.transaction.on_commit", side_effect=lambda stages: stages()), \
+                mock.patch("apimws.ipreg.ip_reg_batch_call"):
+            preallocate_new_site()
 
     # We simulate the VM finishing installing
     vm = VirtualMachine.objects.first()
-    with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+    with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
         with mock.patch("apimws.vm.change_vm_power_state") as mock_change_vm_power_state:
-            mock_subprocess.check_output.return_value.returncode = 0
+            mock_run_ansible.return_value = ""
             mock_change_vm_power_state.return_value = True
             mock_change_vm_power_state.delay.return_value = True
             mock_request = mock.Mock()
             mock_request.method = 'POST'
             mock_request.POST = {'vm': vm.id, 'token': vm.token}
-            post_installation(mock_request)
+            # The SSH server goes down with the reboot after the installation and then answers
+            with mock.patch("apimws.readiness.ssh_ready", side_effect=[False, True]):
+                post_installation(mock_request)
 
 
 def assign_a_site(test_interface, pre_create=True):
@@ -74,7 +80,7 @@ def assign_a_site(test_interface, pre_create=True):
     response = test_interface.client.get(reverse('listsites'))
     test_interface.assertInHTML("<p><a href=\"%s\" class=\"campl-primary-cta\">Register new server</a></p>" %
                                 reverse('newsite'), response.content)
-    with mock.patch("apimws.xen.subprocess") as mock_subprocess:
+    with mock.patch("apimws.xen.subprocess") as mock_subprocess, mock.patch("apimws.xen.run_command") as mock_run:
         def fake_subprocess_output(*args, **kwargs):
             if (set(args[0]) & set(['vmmanager', 'create'])) == set(['vmmanager', 'create']):
                 return '{"vmid": "mws-client1"}'
@@ -86,6 +92,7 @@ def assign_a_site(test_interface, pre_create=True):
                        "replacehostname IN SSHFP 1 2 " \
                        "2f27ce76295fdffb576d714fea586dd0a87a5a2ffa621b4064e225e36c8cf83c\n"
         mock_subprocess.check_output.side_effect = fake_subprocess_output
+        mock_run.side_effect = fake_subprocess_output
         mock_subprocess.Popen().communicate.return_value = (
             '{"pubkey": "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQClBKpj+/WXlxJMY2iYw1mB1qYLM8YDjFS6qSiT6UmNLLhXJ' \
             'BEfd6vOMErM1IfDsYN+W3604hukxwC859TU4ZLQYD6wFI2D+qMhb2UTcoLlOYD7TG436RXKbxK4iAT7ll3XUT8VxZUq/AZKVs' \
@@ -97,9 +104,10 @@ def assign_a_site(test_interface, pre_create=True):
                 return True
             mock_subprocess2.side_effect = fake_output_api
 
-            with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-                with mock.patch("apimws.vm.change_vm_power_state") as mock_change_vm_power_state:
-                    mock_subprocess.check_output.return_value.returncode = 0
+            with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+                with mock.patch("apimws.vm.change_vm_power_state") as mock_change_vm_power_state, \
+                        mock.patch("apimws.readiness.ssh_ready", return_value=True):
+                    mock_run_ansible.return_value = ""
                     mock_change_vm_power_state.return_value = True
                     mock_change_vm_power_state.delay.return_value = True
                     response = test_interface.client.post(reverse('newsite'), {'siteform-name': 'Test Site',
@@ -108,7 +116,7 @@ def assign_a_site(test_interface, pre_create=True):
                                                                                'siteform-type': 1})
                     test_interface.assertIn(response.status_code, [200, 302])
                 # TODO create the checks of how the mock was called
-                # mock_subprocess.check_output.assert_called_with(["userv", "mws-admin", "mws_xen_vm_api",
+                # mock_run_ansible.assert_called_with(["userv", "mws-admin", "mws_xen_vm_api",
                 #                                                  settings.VM_END_POINT[0],
                 #                                                  "create",
                 #                                                  "{}"])
@@ -225,9 +233,9 @@ class SiteManagementTests(TestCase):
         # TODO test that views are restricted
         self.assertTrue(Site.objects.get(pk=test_site.id).disabled)
         # Enable site
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
             with mock.patch("apimws.vm.change_vm_power_state") as mock_change_vm_power_state:
-                mock_subprocess.check_output.return_value.returncode = 0
+                mock_run_ansible.return_value = ""
                 mock_change_vm_power_state.return_value = True
                 mock_change_vm_power_state.delay.return_value = True
                 self.client.post(reverse('enablesite', kwargs={'site_id': test_site.id}))
@@ -454,16 +462,16 @@ class SiteManagement2Tests(TestCase):
         site = self.create_site()
         site.users.add(User.objects.create(username='amc203'))
         site.users.add(User.objects.create(username='jw35'))
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.post(reverse('createunixgroup',
                                                 kwargs={'service_id': site.production_service.id}),
                                         {'unix_users': ['amc203', 'jw35'], 'name': 'TESTUNIXGROUP'})
             self.assertIn(response.status_code, [200, 302])
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         response = self.client.get(response.url)
         self.assertInHTML('<td>TESTUNIXGROUP</td>', response.content)
         self.assertInHTML('<td>amc203, jw35</td>', response.content)
@@ -477,42 +485,42 @@ class SiteManagement2Tests(TestCase):
         self.assertContains(response, '<option selected=selected value="amc203">')
         self.assertContains(response, '<option selected=selected value="jw35">')
 
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.post(reverse('updateunixgroup', kwargs={'ug_id': unix_group.id}),
                                         {'unix_users': 'jw35', 'name': 'NEWTEST'})
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         response = self.client.get(response.url)
         self.assertInHTML('<td>NEWTEST</td>', response.content, count=1)
         self.assertInHTML('<td>TESTUNIXGROUP</td>', response.content, count=0)
         self.assertInHTML('<td>jw35</td>', response.content, count=1)
         self.assertInHTML('<td>amc203</td>', response.content, count=0)
 
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.delete(reverse('deleteunixgroup', kwargs={'ug_id': unix_group.id}))
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         response = self.client.get(reverse('listunixgroups', kwargs={'service_id': site.production_service.id}))
         self.assertInHTML('<td>NEWTEST</td>', response.content, count=0)
         self.assertInHTML('<td>jw35</td>', response.content, count=0)
 
     def test_vhosts_list(self):
         site = self.create_site()
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.post(reverse('createvhost', kwargs={'service_id': site.production_service.id}),
                                         {'name': 'testVhost'})
             self.assertIn(response.status_code, [200, 302])
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         self.assertRedirects(response,
                              expected_url=reverse('listvhost', kwargs={'service_id': site.production_service.id}))
         response = self.client.get(reverse('listvhost', kwargs={'service_id': site.production_service.id}))
@@ -520,13 +528,13 @@ class SiteManagement2Tests(TestCase):
         vhost = Vhost.objects.get(name='testVhost')
         self.assertSequenceEqual([vhost], site.production_service.vhosts.all())
 
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.delete(reverse('deletevhost', kwargs={'vhost_id': vhost.id}))
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         self.assertEqual(response.status_code, 200)
         response = self.client.get(reverse('listvhost', kwargs={'service_id': site.production_service.id}))
         self.assertInHTML('<td>testVhost</td>', response.content, count=0)
@@ -534,8 +542,8 @@ class SiteManagement2Tests(TestCase):
     def test_domains_management(self):
         site = self.create_site()
 
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             self.client.post(reverse('createvhost', kwargs={'service_id': site.production_service.id}),
                              {'name': 'testVhost'})
 
@@ -553,10 +561,10 @@ class SiteManagement2Tests(TestCase):
                 response = self.client.post(reverse(views.add_domain, kwargs={'vhost_id': vhost.id}),
                                             {'name': 'test.mws3test.csx.cam.ac.uk'})
             self.assertIn(response.status_code, [200, 302])
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
 
         response = self.client.get(reverse('listdomains', kwargs={'vhost_id': vhost.id}))
         self.assertInHTML(
@@ -608,13 +616,13 @@ class SiteManagement2Tests(TestCase):
                         </td>
                     </tr>
                 </tbody>''', response.content, count=1)
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.post(reverse(views.set_dn_as_main, kwargs={'domain_id': 1}))
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         response = self.client.get(reverse('listdomains', kwargs={'vhost_id': vhost.id}))
         self.assertInHTML(
             '''<tbody>
@@ -642,23 +650,23 @@ class SiteManagement2Tests(TestCase):
                         </td>
                     </tr>
                 </tbody>''', response.content, count=1)
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.delete(reverse('deletedomain', kwargs={'domain_id': 1}))
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         response = self.client.get(reverse('listdomains', kwargs={'vhost_id': vhost.id}))
         self.assertInHTML('''test.mws3test.csx.cam.ac.uk''', response.content, count=0)
-        with mock.patch("apimws.ansible_impl.subprocess") as mock_subprocess:
-            mock_subprocess.check_output.return_value.returncode = 0
+        with mock.patch("apimws.ansible_impl.run_ansible") as mock_run_ansible:
+            mock_run_ansible.return_value = ""
             response = self.client.post(reverse(views.add_domain, kwargs={'vhost_id': vhost.id}),
                                         {'name': 'externaldomain.com'})
-            mock_subprocess.check_output.assert_called_with([
+            mock_run_ansible.assert_called_with([
                 "userv", "mws-admin", "mws_ansible_host",
                 site.production_service.virtual_machines.first().network_configuration.name
-            ], stderr=mock_subprocess.STDOUT)
+            ])
         response = self.client.get(response.url)
         self.assertInHTML(
             ''' <tbody>
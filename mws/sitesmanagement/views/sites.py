@@ -13,6 +13,7 @@ from django.views.generic.detail import SingleObjectMixin, DetailView
 from ucamlookup import user_in_groups, get_user_lookupgroups
 from apimws.ansible import launch_ansible_site
 from apimws.models import AnsibleConfiguration
+from apimws.pool import record_event
 from apimws.utils import email_confirmation
 from sitesmanagement.cronjobs import check_num_preallocated_sites
 from sitesmanagement.forms import SiteForm, SiteEmailForm, SiteFormEdit
@@ -145,11 +146,14 @@ class SiteCreate(LoginRequiredMixin, FormView):
         siteform = form.save(commit=False)
         preallocated_site = Site.objects.filter(preallocated=True, disabled=True, type=siteform.type).first()
         if not preallocated_site:
+            record_event(siteform.type, 'unavailable')
+            check_num_preallocated_sites.delay()
             form.add_error("type", "No MWS Servers available at this moment with this configuration as they are "
                                    "currently being built, please try again later (they usually take 20 minutes to "
                                    "build) or email %s if you have any question."
                            % getattr(django_settings, 'EMAIL_MWS3_SUPPORT', 'mws-support@uis.cam.ac.uk'))
             return self.form_invalid(form)
+        record_event(siteform.type, 'requested', preallocated_site)
         preallocated_site.start_date = datetime.date.today()
         preallocated_site.name = siteform.name
         preallocated_site.description = siteform.description
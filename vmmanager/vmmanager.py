@@ -1,6 +1,8 @@
 import click
 import json
 import six
+import sys
+import threading
 import ipaddress
 from subprocess import Popen, PIPE, STDOUT
 from jsonschema import validate
@@ -18,7 +20,11 @@ default_options = {
 
 
 OS_SUPPORTED = ['jessie', 'stretch']
+# Operations of a batch executed at the same time
+BATCH_WORKERS = 4
 BUTTON_ACTIONS_ALLOWED = ['shutdown', 'reboot', 'poweroff', 'poweron']
+# Power states reported by the list and status commands
+POWER_STATES = ['running', 'paused', 'stopped', 'crashed']
 
 
 create_parameters_json_schema = {
@@ -138,6 +144,19 @@ button_parameters_json_schema = {
 }
 
 
+status_parameters_json_schema = {
+    "title": "JSON Schema for the status command",
+    "type": "object",
+    "properties": {
+        "vmid": {
+            "description": "The VM id whose power state is requested, currently, the host fqdn",
+            "type": "string",
+        },
+    },
+    "required": ["vmid"]
+}
+
+
 class OSNotSupportedException(Exception):
     pass
 
@@ -227,6 +246,37 @@ class VirtualMachinesManager(object):
         else:
             raise click.ClickException(str(output))
 
+    @classmethod
+    def list(self):
+        """This function returns all the guests of the host with their power state, a list of
+        {"vmid": ..., "state": ...} where the state is one of POWER_STATES"""
+
+        p = Popen(["userv", "root", "vm_list"], stdout=PIPE, stdin=PIPE, stderr=PIPE)
+        output = p.communicate()
+        if p.returncode != 0:
+            raise click.ClickException(str(output))
+        try:
+            guests = json.loads(output[0])
+        except ValueError:
+            raise click.ClickException("The list of guests is not properly formatted: %s" % output[0])
+        return [{"vmid": guest['vmid'], "state": guest['state'] if guest['state'] in POWER_STATES else 'crashed'}
+                for guest in guests]
+
+    @classmethod
+    def status(self, parameters):
+        """This function returns the power state of the vm with id = vmid, or "missing" if the host does not
+        have it"""
+
+        try:
+            validate(parameters, status_parameters_json_schema)
+        except ValueError:
+            self.fail("The JSON parameter needs to be properly formatted")
+
+        for guest in self.list():
+            if guest['vmid'] == parameters['vmid']:
+                return guest
+        return {"vmid": parameters['vmid'], "state": "missing"}
+
     @classmethod
     def copy(self, vmid_o, vmid_d):
         """This function replicates the content of the disk from the VM with id = vmid_o to the VM with
@@ -234,11 +284,133 @@ class VirtualMachinesManager(object):
         pass
 
 
+# Commands accepted in batches and the schema of their parameters
+BATCH_COMMANDS = {
+    'create': create_parameters_json_schema,
+    'delete': delete_parameters_json_schema,
+    'button': button_parameters_json_schema,
+}
+
+
+def validate_batch(operations):
+    """Validates all the operations of a batch before any of them is executed"""
+    if not isinstance(operations, list):
+        raise click.ClickException("The batch needs to be a list of operations")
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('command') not in BATCH_COMMANDS:
+            raise click.ClickException("Operation %d: the command needs to be one of %s"
+                                       % (index, ", ".join(sorted(BATCH_COMMANDS))))
+        try:
+            validate(operation.get('parameters'), BATCH_COMMANDS[operation['command']])
+        except Exception as e:
+            raise click.ClickException("Operation %d: %s" % (index, e))
+
+
+def run_batch(operations, workers):
+    """Executes the operations of a batch, at most workers at the same time. Returns the result of each operation,
+    in the same order, with the output of the command or the error."""
+    validate_batch(operations)
+    results = [None] * len(operations)
+    semaphore = threading.BoundedSemaphore(workers)
+
+    def run(index, operation):
+        try:
+            results[index] = {'output': execute_request(operation)}
+        except click.ClickException as e:
+            results[index] = {'error': e.format_message()}
+        except Exception as e:
+            results[index] = {'error': "%s: %s" % (e.__class__.__name__, e)}
+        finally:
+            semaphore.release()
+
+    threads = []
+    for index, operation in enumerate(operations):
+        semaphore.acquire()
+        thread = threading.Thread(target=run, args=(index, operation))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def execute_request(request):
+    """Executes a request received in server mode and returns the output that the equivalent command would print"""
+    command = request['command']
+    parameters = request['parameters']
+    if command == 'create':
+        return json.dumps(VirtualMachinesManager.create(parameters))
+    elif command == 'delete':
+        VirtualMachinesManager.delete(parameters)
+    elif command == 'button':
+        VirtualMachinesManager.button(parameters)
+    elif command == 'list':
+        return json.dumps(VirtualMachinesManager.list())
+    elif command == 'status':
+        return json.dumps(VirtualMachinesManager.status(parameters))
+    elif command == 'batch':
+        return json.dumps(run_batch(parameters, BATCH_WORKERS))
+    else:
+        raise click.ClickException("Unknown command %s" % command)
+    return ""
+
+
+class Server(object):
+    """Server mode: reads one JSON request per line from the input and writes one JSON response per line to the
+    output. Requests are executed concurrently and each response carries the id of its request."""
+
+    def __init__(self, infile, outfile, workers):
+        self.infile = infile
+        self.outfile = outfile
+        self.workers = threading.BoundedSemaphore(workers)
+        self.output_lock = threading.Lock()
+
+    def respond(self, response):
+        with self.output_lock:
+            self.outfile.write(json.dumps(response) + "\n")
+            self.outfile.flush()
+
+    def handle(self, request):
+        try:
+            self.respond({'id': request['id'], 'output': execute_request(request)})
+        except click.ClickException as e:
+            self.respond({'id': request['id'], 'error': e.format_message()})
+        except Exception as e:
+            self.respond({'id': request['id'], 'error': "%s: %s" % (e.__class__.__name__, e)})
+        finally:
+            self.workers.release()
+
+    def run(self):
+        threads = []
+        for line in iter(self.infile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                request['id'], request['command'], request['parameters']
+            except (ValueError, KeyError, TypeError):
+                self.respond({'id': None, 'error': "The request needs to be properly formatted: %s" % line})
+                continue
+            self.workers.acquire()
+            thread = threading.Thread(target=self.handle, args=(request, ))
+            thread.start()
+            threads = [t for t in threads if t.is_alive()] + [thread]
+        # The client closed the channel, finish the requests in flight before exiting
+        for thread in threads:
+            thread.join()
+
+
 @click.group()
 def cli():
     pass
 
 
+@cli.command()
+@click.option('--workers', default=8, help="maximum number of requests executed at the same time")
+def serve(workers):
+    Server(sys.stdin, sys.stdout, workers).run()
+
+
 @cli.command()
 @click.argument('json-parameters', required=True, type=JSONTYPE)
 def create(json_parameters):
@@ -258,6 +430,21 @@ def button(json_parameters):
     VirtualMachinesManager.button(json_parameters)
 
 
+@cli.command(name='list')
+@click.argument('json-parameters', required=False, type=JSONTYPE)
+def list_guests(json_parameters):
+    """Prints all the guests of the host and their power state. It has no parameters, the JSON parameters are
+    accepted and ignored so that it can be invoked like the rest of the commands"""
+    click.echo(json.dumps(VirtualMachinesManager.list()))
+
+
+@cli.command()
+@click.argument('json-parameters', required=True, type=JSONTYPE)
+def status(json_parameters):
+    """Prints the power state of a guest"""
+    click.echo(json.dumps(VirtualMachinesManager.status(json_parameters)))
+
+
 @cli.command()
 @click.argument('vmid', required=True, type=click.STRING)
 @click.argument('json-parameters', required=True, type=JSONTYPE)
@@ -265,3 +452,11 @@ def clone(vmid, json_parameters):
     response = VirtualMachinesManager.create(json_parameters)
     VirtualMachinesManager.copy(vmid, response['vmid'])
     click.echo(json.dumps(response))
+
+
+@cli.command()
+@click.option('--workers', default=BATCH_WORKERS, help="maximum number of operations executed at the same time")
+@click.argument('json-parameters', required=True, type=JSONTYPE)
+def batch(json_parameters, workers):
+    """Executes a list of operations ({"command": ..., "parameters": ...}) and prints the result of each one"""
+    click.echo(json.dumps(run_batch(json_parameters, workers)))